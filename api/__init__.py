@@ -13,11 +13,13 @@ from api.dependencies import (
     get_air_quality_client,
     get_repository,
     get_validation_service,
-    get_air_quality_service
+    get_air_quality_service,
+    get_async_air_quality_client,
+    get_async_air_quality_service
 )
-from api.services import AirQualityService, ValidationService
-from api.repository import InMemoryRepository
-from api.client import AirQualityClient
+from api.services import AirQualityService, AsyncAirQualityService, ValidationService
+from api.repository import InMemoryRepository, ColumnarRepository, SQLiteRepository
+from api.client import AirQualityClient, AsyncAirQualityClient
 
 __all__ = [
     'bp',
@@ -33,8 +35,14 @@ __all__ = [
     'get_repository',
     'get_validation_service',
     'get_air_quality_service',
+    'get_async_air_quality_client',
+    'get_async_air_quality_service',
     'AirQualityClient',
+    'AsyncAirQualityClient',
     'InMemoryRepository',
+    'ColumnarRepository',
+    'SQLiteRepository',
     'AirQualityService',
+    'AsyncAirQualityService',
     'ValidationService'
 ]
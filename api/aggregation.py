@@ -0,0 +1,468 @@
+from api.models import EnvironmentalReading, WEATHER_FIELDS, POLLUTANT_FIELDS
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+from datetime import datetime, timedelta, tzinfo
+from array import array
+import threading
+import bisect
+import math
+import re
+
+MEASUREMENT_FIELDS = WEATHER_FIELDS + POLLUTANT_FIELDS
+
+HOUR = 3600
+DAY = 24 * HOUR
+BUCKET_UNITS = {"h": HOUR, "d": DAY, "w": 7 * DAY}
+
+_EPOCH = datetime(1970, 1, 1)
+# buckets are counted from a Monday at UTC midnight, so weeks start on Mondays and days at 00:00 UTC
+_ORIGIN = 4 * DAY
+
+
+def parse_bucket(value: str) -> int:
+    match = re.fullmatch(r"([1-9][0-9]*)([hdw])", value)
+    if match is None:
+        raise ValueError(f"Invalid bucket: {value}")
+
+    return int(match.group(1)) * BUCKET_UNITS[match.group(2)]
+
+
+def epoch_seconds(timestamp: datetime) -> float:
+    # naive timestamps are treated as UTC, like the columnar and SQLite backends do
+    offset = timestamp.utcoffset() or timedelta(0)
+    return (timestamp.replace(tzinfo=None) - offset - _EPOCH).total_seconds()
+
+
+def reading_values(reading: EnvironmentalReading) -> Tuple[Optional[float], ...]:
+    weather, pollutants = reading.weather, reading.pollutants
+    return (
+        tuple(getattr(weather, name) for name in WEATHER_FIELDS) if weather is not None
+        else (None,) * len(WEATHER_FIELDS)
+    ) + (
+        tuple(getattr(pollutants, name) for name in POLLUTANT_FIELDS) if pollutants is not None
+        else (None,) * len(POLLUTANT_FIELDS)
+    )
+
+
+def bucket_range(start: datetime, end: datetime, bucket_seconds: int) -> range:
+    # every bucket overlapping [start, end), so the window is widened to whole buckets
+    first = math.floor((epoch_seconds(start) - _ORIGIN) / bucket_seconds)
+    last = math.ceil((epoch_seconds(end) - _ORIGIN) / bucket_seconds)
+    return range(first, max(last, first))
+
+
+def bucket_start(index: int, bucket_seconds: int, tz: Optional[tzinfo] = None) -> datetime:
+    return (_EPOCH + timedelta(seconds=_ORIGIN + index * bucket_seconds)).replace(tzinfo=tz)
+
+
+def _percentile(values: List[float], percentile: float) -> float:
+    rank = (len(values) - 1) * percentile / 100
+    lower = math.floor(rank)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+
+def _summarise(values: List[float], percentiles: Sequence[float]) -> Optional[Dict[str, float]]:
+    # values must be sorted
+    if not values:
+        return None
+
+    stats = {"count": len(values), "min": values[0], "max": values[-1], "mean": math.fsum(values) / len(values)}
+    for percentile in percentiles:
+        stats[f"p{percentile:g}"] = _percentile(values, percentile)
+
+    return stats
+
+
+def _bucket(index: int, bucket_seconds: int, stats: Dict[str, Dict[str, float]]) -> Dict[str, Any]:
+    return {
+        "start": bucket_start(index, bucket_seconds).isoformat(),
+        "end": bucket_start(index + 1, bucket_seconds).isoformat(),
+        "fields": stats
+    }
+
+
+def aggregate_readings(
+        readings: Iterable[EnvironmentalReading],
+        start: datetime,
+        end: datetime,
+        bucket_seconds: int,
+        fields: Sequence[str] = MEASUREMENT_FIELDS,
+        percentiles: Sequence[float] = ()
+) -> List[Dict[str, Any]]:
+    # straight from the readings; used for buckets shorter than the day partials kept by RollupIndex
+    positions = [(name, MEASUREMENT_FIELDS.index(name)) for name in fields]
+    buckets = bucket_range(start, end, bucket_seconds)
+    grouped: Dict[int, Dict[str, List[float]]] = {}
+
+    for reading in readings:
+        index = math.floor((epoch_seconds(reading.timestamp) - _ORIGIN) / bucket_seconds)
+        if index not in buckets:
+            continue
+        values = reading_values(reading)
+        columns = grouped.setdefault(index, {})
+        for name, position in positions:
+            if values[position] is not None:
+                columns.setdefault(name, []).append(values[position])
+
+    result = []
+    for index in sorted(grouped):
+        stats = {}
+        for name, values in grouped[index].items():
+            values.sort()
+            stats[name] = _summarise(values, percentiles)
+        result.append(_bucket(index, bucket_seconds, stats))
+
+    return result
+
+
+_Rows = Callable[[float, float], Iterable[Tuple[float, Sequence[Optional[float]]]]]
+
+
+class _Partial:
+    __slots__ = ("count", "total", "minimum", "maximum")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.minimum = math.inf
+        self.maximum = -math.inf
+
+
+class RollupIndex:
+    # per location and UTC day, a count, sum, min and max of every field, kept in step with writes so a rollup
+    # over whole days merges one partial per day instead of rescanning the readings. Removing a day's min or
+    # max cannot be undone from the partial alone, so that day is marked stale and rebuilt from its rows on the
+    # next query; percentiles are never kept and come from the bucket's rows when asked for
+    def __init__(self):
+        self._days: Dict[str, Dict[int, Dict[str, _Partial]]] = {}
+        self._stale: Dict[str, Set[int]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, location: str, epoch: float, values: Sequence[Optional[float]]) -> None:
+        with self._lock:
+            days = self._days.setdefault(location, {})
+            day = self._day(epoch)
+            partials = days.get(day)
+            if partials is None:
+                partials = days[day] = {}
+            for name, value in zip(MEASUREMENT_FIELDS, values):
+                if value is None:
+                    continue
+                partial = partials.get(name)
+                if partial is None:
+                    partial = partials[name] = _Partial()
+                partial.count += 1
+                partial.total += value
+                if value < partial.minimum:
+                    partial.minimum = value
+                if value > partial.maximum:
+                    partial.maximum = value
+
+    def add_many(self, location: str, rows: Iterable[Tuple[float, Sequence[Optional[float]]]]) -> None:
+        # the batch is summarised without the lock, which is then held for one merge per day
+        built = self._partials(rows)
+        with self._lock:
+            days = self._days.setdefault(location, {})
+            for day, partials in built.items():
+                existing = days.get(day)
+                if existing is None:
+                    days[day] = partials
+                    continue
+                for name, partial in partials.items():
+                    current = existing.get(name)
+                    if current is None:
+                        existing[name] = partial
+                        continue
+                    current.count += partial.count
+                    current.total += partial.total
+                    current.minimum = min(current.minimum, partial.minimum)
+                    current.maximum = max(current.maximum, partial.maximum)
+
+    def remove(self, location: str, epoch: float, values: Sequence[Optional[float]]) -> None:
+        with self._lock:
+            day = self._day(epoch)
+            partials = self._days.get(location, {}).get(day)
+            if partials is None:
+                return
+            for name, value in zip(MEASUREMENT_FIELDS, values):
+                partial = partials.get(name) if value is not None else None
+                if partial is None or not partial.count:
+                    continue
+                partial.count -= 1
+                if not partial.count:
+                    partials[name] = _Partial()
+                    continue
+                partial.total -= value
+                if value <= partial.minimum or value >= partial.maximum:
+                    self._stale.setdefault(location, set()).add(day)
+
+    def clear(self, location: str) -> None:
+        with self._lock:
+            self._days.pop(location, None)
+            self._stale.pop(location, None)
+
+    def aggregate(
+            self,
+            location: str,
+            start: datetime,
+            end: datetime,
+            bucket_days: int,
+            rows: _Rows,
+            fields: Sequence[str] = MEASUREMENT_FIELDS,
+            percentiles: Sequence[float] = ()
+    ) -> List[Dict[str, Any]]:
+        # rows(lo, hi) yields (epoch, values) for every stored reading of the location with lo <= epoch < hi.
+        # Callers keep writers of the location out while this runs, so its partials are read without the lock;
+        # the lock only guards the maps shared by all locations, and row scans never run under it
+        bucket_seconds = bucket_days * DAY
+        buckets = bucket_range(start, end, bucket_seconds)
+
+        with self._lock:
+            days = self._days.get(location, {})
+            stale = [
+                day for day in self._stale.get(location, ())
+                if buckets.start * bucket_days <= day < buckets.stop * bucket_days
+            ]
+
+        if stale:
+            rebuilt = {
+                day: self._partials(rows(_ORIGIN + day * DAY, _ORIGIN + (day + 1) * DAY)).get(day, {})
+                for day in stale
+            }
+            with self._lock:
+                pending = self._stale.get(location, set())
+                for day, partials in rebuilt.items():
+                    if day in pending:
+                        pending.discard(day)
+                        days[day] = partials
+
+        ranked = self._ranked(buckets, bucket_seconds, rows, fields) if percentiles else {}
+
+        result = []
+        for index in buckets:
+            partials = [days[day] for day in range(index * bucket_days, (index + 1) * bucket_days) if day in days]
+
+            stats = {}
+            for name in fields:
+                runs = [partial[name] for partial in partials if name in partial and partial[name].count]
+                if not runs:
+                    continue
+                count = sum(run.count for run in runs)
+                stats[name] = {
+                    "count": count,
+                    "min": min(run.minimum for run in runs),
+                    "max": max(run.maximum for run in runs),
+                    "mean": sum(run.total for run in runs) / count
+                }
+                values = ranked.get((index, name))
+                for percentile in percentiles:
+                    stats[name][f"p{percentile:g}"] = _percentile(values, percentile)
+
+            if stats:
+                result.append(_bucket(index, bucket_seconds, stats))
+
+        return result
+
+    @staticmethod
+    def _ranked(buckets: range, bucket_seconds: int, rows: _Rows,
+                fields: Sequence[str]) -> Dict[Tuple[int, str], List[float]]:
+        positions = [(name, MEASUREMENT_FIELDS.index(name)) for name in fields]
+        ranked: Dict[Tuple[int, str], List[float]] = {}
+
+        for epoch, values in rows(_ORIGIN + buckets.start * bucket_seconds, _ORIGIN + buckets.stop * bucket_seconds):
+            index = math.floor((epoch - _ORIGIN) / bucket_seconds)
+            for name, position in positions:
+                if values[position] is not None:
+                    ranked.setdefault((index, name), []).append(values[position])
+
+        for values in ranked.values():
+            values.sort()
+        return ranked
+
+    @classmethod
+    def _partials(cls, rows: Iterable[Tuple[float, Sequence[Optional[float]]]]) -> Dict[int, Dict[str, _Partial]]:
+        # rows are grouped by day first, so each field's partial is built once per day with builtins
+        # over the day's column rather than once per value
+        grouped: Dict[int, List[Sequence[Optional[float]]]] = {}
+        for epoch, values in rows:
+            day = cls._day(epoch)
+            day_rows = grouped.get(day)
+            if day_rows is None:
+                day_rows = grouped[day] = []
+            day_rows.append(values)
+
+        days: Dict[int, Dict[str, _Partial]] = {}
+        for day, day_rows in grouped.items():
+            partials = days[day] = {}
+            for name, column in zip(MEASUREMENT_FIELDS, zip(*day_rows)):
+                present = [value for value in column if value is not None]
+                if not present:
+                    continue
+                partial = partials[name] = _Partial()
+                partial.count = len(present)
+                partial.total = sum(present)
+                partial.minimum = min(present)
+                partial.maximum = max(present)
+        return days
+
+    @staticmethod
+    def _day(epoch: float) -> int:
+        return math.floor((epoch - _ORIGIN) / DAY)
+
+
+class _FieldTree:
+    # prefix sums and counts answer a range's mean in O(1); min and max come from two segment trees in O(log n).
+    # The trees are padded to a power of two with +/-inf, which also stands in for missing values
+    __slots__ = ("sums", "counts", "minima", "maxima", "capacity", "size")
+
+    def __init__(self, values: Sequence[Optional[float]]):
+        self.sums = array('d', [0.0])
+        self.counts = array('q', [0])
+        self.size = 0
+        self.capacity = 1
+        while self.capacity < len(values):
+            self.capacity *= 2
+
+        self.minima = array('d', [math.inf]) * (2 * self.capacity)
+        self.maxima = array('d', [-math.inf]) * (2 * self.capacity)
+
+        total, count = 0.0, 0
+        for position, value in enumerate(values):
+            if value is not None:
+                total += value
+                count += 1
+                self.minima[self.capacity + position] = self.maxima[self.capacity + position] = value
+            self.sums.append(total)
+            self.counts.append(count)
+        self.size = len(values)
+
+        self._build()
+
+    def append(self, value: Optional[float]) -> None:
+        if self.size == self.capacity:
+            self._grow()
+
+        self.sums.append(self.sums[-1] + (value if value is not None else 0.0))
+        self.counts.append(self.counts[-1] + (value is not None))
+
+        node = self.capacity + self.size
+        self.size += 1
+        if value is None:
+            return
+
+        self.minima[node] = self.maxima[node] = value
+        node //= 2
+        while node:
+            self.minima[node] = min(self.minima[2 * node], self.minima[2 * node + 1])
+            self.maxima[node] = max(self.maxima[2 * node], self.maxima[2 * node + 1])
+            node //= 2
+
+    def query(self, lo: int, hi: int) -> Optional[Dict[str, float]]:
+        count = self.counts[hi] - self.counts[lo]
+        if count <= 0:
+            return None
+        mean = (self.sums[hi] - self.sums[lo]) / count
+
+        low, high = math.inf, -math.inf
+        lo += self.capacity
+        hi += self.capacity
+        while lo < hi:
+            if lo & 1:
+                low, high = min(low, self.minima[lo]), max(high, self.maxima[lo])
+                lo += 1
+            if hi & 1:
+                hi -= 1
+                low, high = min(low, self.minima[hi]), max(high, self.maxima[hi])
+            lo //= 2
+            hi //= 2
+
+        return {"count": count, "min": low, "max": high, "mean": mean}
+
+    def _grow(self) -> None:
+        leaves_min = self.minima[self.capacity:self.capacity + self.size]
+        leaves_max = self.maxima[self.capacity:self.capacity + self.size]
+        self.capacity *= 2
+        self.minima = array('d', [math.inf]) * (2 * self.capacity)
+        self.maxima = array('d', [-math.inf]) * (2 * self.capacity)
+        self.minima[self.capacity:self.capacity + self.size] = leaves_min
+        self.maxima[self.capacity:self.capacity + self.size] = leaves_max
+        self._build()
+
+    def _build(self) -> None:
+        for node in range(self.capacity - 1, 0, -1):
+            self.minima[node] = min(self.minima[2 * node], self.minima[2 * node + 1])
+            self.maxima[node] = max(self.maxima[2 * node], self.maxima[2 * node + 1])
+
+
+class _SeriesIndex:
+    __slots__ = ("epochs", "fields")
+
+    def __init__(self, epochs: array):
+        self.epochs = epochs
+        self.fields: Dict[str, _FieldTree] = {}
+
+
+class RangeStatsIndex:
+    # per location, the rows' epochs in order plus a _FieldTree per field, built on the first query that needs
+    # them. Appends past the newest row are applied in O(log n); anything else (an overwrite, an out-of-order
+    # insert, a bulk load) drops the location's index and the next query rebuilds it from the repository
+    def __init__(self):
+        self._series: Dict[str, _SeriesIndex] = {}
+        self._lock = threading.Lock()
+
+    def append(self, location: str, epoch: float, values: Sequence[Optional[float]]) -> None:
+        with self._lock:
+            series = self._series.get(location)
+            if series is None:
+                return
+            if series.epochs and epoch <= series.epochs[-1]:
+                del self._series[location]
+                return
+
+            series.epochs.append(epoch)
+            for name, tree in series.fields.items():
+                tree.append(values[MEASUREMENT_FIELDS.index(name)])
+
+    def invalidate(self, location: str) -> None:
+        with self._lock:
+            self._series.pop(location, None)
+
+    def stats(
+            self,
+            location: str,
+            start: datetime,
+            end: datetime,
+            fields: Sequence[str],
+            rows: Callable[[], Iterable[Tuple[float, Sequence[Optional[float]]]]]
+    ) -> Dict[str, Dict[str, float]]:
+        # rows() yields (epoch, values) for every stored reading of the location in ascending epoch order.
+        # Callers keep writers of the location out while this runs, so the lock only guards looking up and
+        # installing an index; the O(n) build and the query run without it and never stall other locations
+        with self._lock:
+            series = self._series.get(location)
+            missing = [name for name in fields if series is None or name not in series.fields]
+
+        if missing:
+            loaded = list(rows())
+            if series is None or len(loaded) != len(series.epochs):
+                series = _SeriesIndex(array('d', (epoch for epoch, _ in loaded)))
+                missing = list(fields)
+            trees = {}
+            for name in missing:
+                position = MEASUREMENT_FIELDS.index(name)
+                trees[name] = _FieldTree([values[position] for _, values in loaded])
+
+            with self._lock:
+                series.fields.update(trees)
+                self._series[location] = series
+
+        lo = bisect.bisect_left(series.epochs, epoch_seconds(start))
+        hi = max(bisect.bisect_left(series.epochs, epoch_seconds(end)), lo)
+
+        result = {}
+        for name in fields:
+            summary = series.fields[name].query(lo, hi)
+            if summary is not None:
+                result[name] = summary
+
+        return result
@@ -0,0 +1,177 @@
+from typing import Any, Callable, Dict, Hashable, Optional
+from api.concurrency import SingleFlight
+from collections import OrderedDict
+import threading
+import time
+import os
+
+SHARED_CACHE_TYPES = ("RedisCache", "FileSystemCache")
+
+
+def build_cache_config() -> Dict[str, Any]:
+    cache_type = os.getenv("CACHE_TYPE", "SimpleCache")
+    config: Dict[str, Any] = {
+        "CACHE_TYPE": cache_type,
+        "CACHE_DEFAULT_TIMEOUT": int(os.getenv("CACHE_DEFAULT_TIMEOUT", 3600)),
+        "CACHE_KEY_PREFIX": os.getenv("CACHE_KEY_PREFIX", "air_quality:")
+    }
+
+    if cache_type == "RedisCache":
+        redis_url = os.getenv("CACHE_REDIS_URL")
+        if not redis_url:
+            raise ValueError("CACHE_REDIS_URL is required for RedisCache")
+        config["CACHE_REDIS_URL"] = redis_url
+    elif cache_type == "FileSystemCache":
+        cache_dir = os.getenv("CACHE_DIR")
+        if not cache_dir:
+            raise ValueError("CACHE_DIR is required for FileSystemCache")
+        config["CACHE_DIR"] = cache_dir
+        config["CACHE_THRESHOLD"] = int(os.getenv("CACHE_THRESHOLD", 5000))
+    elif cache_type == "SimpleCache":
+        config["CACHE_THRESHOLD"] = int(os.getenv("CACHE_THRESHOLD", 5000))
+    elif cache_type != "NullCache":
+        raise ValueError(f"Unknown cache type: {cache_type}")
+
+    return config
+
+
+class VersionedCache:
+    # wraps the flask-caching backend; keys carry the data version of their location, so a write
+    # makes every older entry unreachable and TTLs only bound memory, not staleness
+    def __init__(self, cache):
+        self.cache = cache
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._versions: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._fills = SingleFlight()
+
+    def get(self, namespace: str, version: int, key: str) -> Optional[Any]:
+        self._observe(namespace, version)
+        value = self.cache.get(self._key(namespace, version, key))
+
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        return value
+
+    def set(self, namespace: str, version: int, key: str, value: Any) -> None:
+        self.cache.set(self._key(namespace, version, key), value)
+
+    def get_or_fill(self, namespace: str, version: int, key: str, fill: Callable[[], Any]) -> Any:
+        value = self.get(namespace, version, key)
+        if value is not None:
+            return value
+
+        # concurrent misses for the same entry wait for a single fill instead of each recomputing it
+        return self._fills.do(self._key(namespace, version, key), lambda: self._fill(namespace, version, key, fill))
+
+    def _fill(self, namespace: str, version: int, key: str, fill: Callable[[], Any]) -> Any:
+        value = fill()
+        self.set(namespace, version, key, value)
+        return value
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "coalesced": self._fills.coalesced,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+    def _observe(self, namespace: str, version: int) -> None:
+        with self._lock:
+            seen = self._versions.get(namespace)
+            if seen is not None and version != seen:
+                self.invalidations += 1
+            self._versions[namespace] = version
+
+    @staticmethod
+    def _key(namespace: str, version: int, key: str) -> str:
+        return f"{namespace}:v{version}:{key}"
+
+
+class UpstreamEntry:
+    __slots__ = ("payloads", "expires_at", "etag", "last_modified")
+
+    def __init__(self, payloads: Any, expires_at: float, etag: Optional[str], last_modified: Optional[str]):
+        self.payloads = payloads
+        self.expires_at = expires_at
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def is_fresh(self) -> bool:
+        return time.monotonic() < self.expires_at
+
+    def validators(self) -> Dict[str, str]:
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class UpstreamCache:
+    # bounded LRU of upstream responses; expired entries stay until evicted so they can be revalidated
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self._entries: "OrderedDict[Hashable, UpstreamEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[UpstreamEntry]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+
+            if entry is not None and entry.is_fresh():
+                self.hits += 1
+            else:
+                self.misses += 1
+
+            return entry
+
+    def store(
+            self,
+            key: Hashable,
+            payloads: Any,
+            ttl: float,
+            etag: Optional[str] = None,
+            last_modified: Optional[str] = None
+    ) -> None:
+        with self._lock:
+            self._entries[key] = UpstreamEntry(payloads, time.monotonic() + ttl, etag, last_modified)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def revalidated(self, key: Hashable, ttl: float) -> None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.expires_at = time.monotonic() + ttl
+                self.revalidations += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "revalidations": self.revalidations
+            }
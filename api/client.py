@@ -1,19 +1,217 @@
-from typing import Dict, Any, Optional, List
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional, List, Tuple
+from datetime import datetime, date, timedelta, timezone
+from requests.adapters import HTTPAdapter
+from email.utils import parsedate_to_datetime
+from api.cache import UpstreamCache
+from api.models import default_coordinates
 import requests
+import asyncio
+import aiohttp
+import weakref
+import math
+import time
 import os
 
+DEFAULT_POLLUTANTS = ["pm10", "pm2_5", "carbon_monoxide", "nitrogen_dioxide", "sulphur_dioxide", "ozone"]
 
-class AirQualityClient:
+# the upstream keeps revising the last two days, so only windows ending before them count as closed
+SETTLED_AFTER_DAYS = 2
+
+
+class _AirQualityClientBase:
     BASE_URL = "https://air-quality-api.open-meteo.com/v1/air-quality"
+    RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+    def __init__(
+            self,
+            latitude: Optional[float] = None,
+            longitude: Optional[float] = None,
+            base_url: Optional[str] = None,
+            chunk_days: Optional[int] = None,
+            max_workers: Optional[int] = None,
+            chunk_retries: Optional[int] = None,
+            retry_delay: float = 0.5,
+            connect_timeout: Optional[float] = None,
+            read_timeout: Optional[float] = None,
+            locations_per_request: Optional[int] = None,
+            max_retry_after: Optional[float] = None
+    ):
+        default_latitude, default_longitude = default_coordinates()
+        self.latitude = latitude or default_latitude
+        self.longitude = longitude or default_longitude
+        self.base_url = base_url or os.getenv("AIR_QUALITY_API_URL", self.BASE_URL)
+        self.chunk_days = chunk_days or int(os.getenv("FETCH_CHUNK_DAYS", "31"))
+        self.max_workers = max_workers or int(os.getenv("FETCH_MAX_WORKERS", "4"))
+        self.chunk_retries = chunk_retries if chunk_retries is not None else int(os.getenv("FETCH_CHUNK_RETRIES", "2"))
+        self.retry_delay = retry_delay
+        self.max_retry_after = (
+            max_retry_after if max_retry_after is not None else float(os.getenv("FETCH_MAX_RETRY_AFTER", "30"))
+        )
+        self.timeout = (
+            connect_timeout or float(os.getenv("FETCH_CONNECT_TIMEOUT", "5")),
+            read_timeout or float(os.getenv("FETCH_READ_TIMEOUT", "30"))
+        )
+        self.locations_per_request = locations_per_request or int(os.getenv("FETCH_LOCATIONS_PER_REQUEST", "100"))
+
+    def _backoff(self, attempt: int, retry_after: Optional[str]) -> float:
+        # a window is the only retry layer; Retry-After wins over the exponential delay, but is capped so a
+        # long hint cannot hold a worker
+        delay = self._retry_after_seconds(retry_after)
+        if delay is None:
+            return self.retry_delay * 2 ** attempt
+        return min(max(delay, 0.0), self.max_retry_after)
+
+    @staticmethod
+    def _retry_after_seconds(retry_after: Optional[str]) -> Optional[float]:
+        # Retry-After is either delay-seconds or an HTTP-date; anything unparseable or non-finite is ignored
+        if retry_after is None:
+            return None
+
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            try:
+                retry_at = parsedate_to_datetime(retry_after)
+            except (TypeError, ValueError):
+                return None
+            if retry_at.tzinfo is None:
+                retry_at = retry_at.replace(tzinfo=timezone.utc)
+            delay = (retry_at - datetime.now(timezone.utc)).total_seconds()
+
+        return delay if math.isfinite(delay) else None
+
+    def _split_range(self, start: date, end: date) -> List[Tuple[date, date]]:
+        windows = []
+        window_start = start
+
+        while True:
+            window_end = min(window_start + timedelta(days=self.chunk_days - 1), end)
+            windows.append((window_start, window_end))
+
+            if window_end >= end:
+                return windows
+
+            window_start = window_end + timedelta(days=1)
+
+    def _batch_coordinates(self, coordinates: List[Tuple[float, float]]) -> List[List[Tuple[float, float]]]:
+        size = self.locations_per_request
+        return [coordinates[i:i + size] for i in range(0, len(coordinates), size)]
+
+    def _window_params(
+            self,
+            start: date,
+            end: date,
+            pollutants: List[str],
+            coordinates: List[Tuple[float, float]]
+    ) -> Dict[str, Any]:
+        # Open-Meteo accepts comma-separated coordinate lists and answers with one payload per coordinate
+        return {
+            "latitude": ",".join(str(latitude) for latitude, _ in coordinates),
+            "longitude": ",".join(str(longitude) for _, longitude in coordinates),
+            "start_date": start.strftime("%Y-%m-%d"),
+            "end_date": end.strftime("%Y-%m-%d"),
+            "hourly": ",".join(pollutants),
+            "timezone": "auto"
+        }
 
+    @staticmethod
+    def _split_payloads(body: Any, coordinates: List[Tuple[float, float]]) -> List[Dict[str, Any]]:
+        payloads = body if isinstance(body, list) else [body]
+
+        if len(payloads) != len(coordinates):
+            raise ValueError(f"Expected {len(coordinates)} location payloads, got {len(payloads)}")
+
+        return payloads
+
+    def _assemble_locations(
+            self,
+            batches: List[List[Tuple[float, float]]],
+            windows: List[Tuple[date, date]],
+            results: List[List[Dict[str, Any]]]
+    ) -> List[Dict[str, Any]]:
+        # results arrive batch-major, one list of per-location payloads for each window of each batch
+        payloads = []
+        batch_results = iter(results)
+
+        for batch in batches:
+            per_window = [next(batch_results) for _ in windows]
+            for index in range(len(batch)):
+                payloads.append(self._merge_payloads([window_payloads[index] for window_payloads in per_window]))
+
+        return payloads
+
+    @staticmethod
+    def _merge_payloads(payloads: List[Dict[str, Any]]) -> Dict[str, Any]:
+        if len(payloads) == 1:
+            return payloads[0]
+
+        merged = dict(payloads[0])
+        hourly: Dict[str, List[Any]] = {}
+
+        for payload in payloads:
+            for key, values in payload.get("hourly", {}).items():
+                hourly.setdefault(key, []).extend(values)
+
+        merged["hourly"] = hourly
+        return merged
+
+
+class AirQualityClient(_AirQualityClientBase):
     def __init__(
             self,
             latitude: Optional[float] = None,
             longitude: Optional[float] = None,
+            base_url: Optional[str] = None,
+            chunk_days: Optional[int] = None,
+            max_workers: Optional[int] = None,
+            chunk_retries: Optional[int] = None,
+            retry_delay: float = 0.5,
+            pool_size: Optional[int] = None,
+            connect_timeout: Optional[float] = None,
+            read_timeout: Optional[float] = None,
+            locations_per_request: Optional[int] = None,
+            max_retry_after: Optional[float] = None,
+            cache_size: Optional[int] = None,
+            cache_ttl: Optional[float] = None,
+            cache_recent_ttl: Optional[float] = None
     ):
-        self.latitude = latitude or float(os.getenv("LATITUDE", "52.2297"))
-        self.longitude = longitude or float(os.getenv("LONGITUDE", "21.0122"))
+        super().__init__(
+            latitude, longitude, base_url, chunk_days, max_workers, chunk_retries,
+            retry_delay, connect_timeout, read_timeout, locations_per_request, max_retry_after
+        )
+
+        cache_size = cache_size if cache_size is not None else int(os.getenv("FETCH_CACHE_SIZE", "256"))
+        self.response_cache = UpstreamCache(cache_size) if cache_size > 0 else None
+        self.cache_ttl = cache_ttl if cache_ttl is not None else float(os.getenv("FETCH_CACHE_TTL", "86400"))
+        self.cache_recent_ttl = (
+            cache_recent_ttl if cache_recent_ttl is not None else float(os.getenv("FETCH_CACHE_RECENT_TTL", "300"))
+        )
+
+        # no transport-level retries: _fetch_window retries the whole window, so backoffs do not compound
+        pool_size = pool_size or int(os.getenv("FETCH_POOL_SIZE", str(self.max_workers)))
+        self._adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+
+        self.session = requests.Session()
+        self.session.mount("https://", self._adapter)
+        self.session.mount("http://", self._adapter)
+
+    def close(self) -> None:
+        self.session.close()
+
+    def connection_stats(self) -> Dict[str, int]:
+        stats = {"requests": 0, "new_connections": 0, "reused_connections": 0}
+        pools = self._adapter.poolmanager.pools
+
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            stats["requests"] += pool.num_requests
+            stats["new_connections"] += pool.num_connections
+
+        stats["reused_connections"] = stats["requests"] - stats["new_connections"]
+        return stats
 
     def get_air_quality_data(
             self,
@@ -21,19 +219,197 @@ class AirQualityClient:
             end_date: datetime,
             pollutants: Optional[List[str]] = None
     ) -> Dict[str, Any]:
+        return self.get_air_quality_data_for_locations(
+            [(self.latitude, self.longitude)], start_date, end_date, pollutants
+        )[0]
+
+    def get_air_quality_data_for_locations(
+            self,
+            coordinates: List[Tuple[float, float]],
+            start_date: datetime,
+            end_date: datetime,
+            pollutants: Optional[List[str]] = None
+    ) -> List[Dict[str, Any]]:
         if pollutants is None:
-            pollutants = ["pm10", "pm2_5", "carbon_monoxide", "nitrogen_dioxide", "sulphur_dioxide", "ozone"]
+            pollutants = DEFAULT_POLLUTANTS
 
-        params = {
-            "latitude": self.latitude,
-            "longitude": self.longitude,
-            "start_date": start_date.strftime("%Y-%m-%d"),
-            "end_date": end_date.strftime("%Y-%m-%d"),
-            "hourly": ",".join(pollutants),
-            "timezone": "auto"
-        }
+        windows = self._split_range(start_date.date(), end_date.date())
+        batches = self._batch_coordinates(coordinates)
+        tasks = [(window, batch) for batch in batches for window in windows]
+
+        if len(tasks) == 1:
+            results = [self._fetch_window(windows[0][0], windows[0][1], pollutants, batches[0])]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(tasks))) as executor:
+                results = list(executor.map(
+                    lambda task: self._fetch_window(task[0][0], task[0][1], pollutants, task[1]), tasks
+                ))
+
+        return self._assemble_locations(batches, windows, results)
+
+    def _fetch_window(
+            self,
+            start: date,
+            end: date,
+            pollutants: List[str],
+            coordinates: List[Tuple[float, float]]
+    ) -> List[Dict[str, Any]]:
+        params = self._window_params(start, end, pollutants, coordinates)
+        cache_key = (tuple(coordinates), start, end, tuple(pollutants))
+
+        entry = self.response_cache.get(cache_key) if self.response_cache is not None else None
+        if entry is not None and entry.is_fresh():
+            return entry.payloads
+        headers = entry.validators() if entry is not None else {}
+
+        attempt = 0
+        while True:
+            try:
+                response = self.session.get(self.base_url, params=params, headers=headers, timeout=self.timeout)
+
+                if response.status_code == 304 and entry is not None:
+                    self.response_cache.revalidated(cache_key, self._cache_ttl(end))
+                    return entry.payloads
+
+                response.raise_for_status()
+                payloads = self._split_payloads(response.json(), coordinates)
+
+                if self.response_cache is not None:
+                    self.response_cache.store(
+                        cache_key, payloads, self._cache_ttl(end),
+                        response.headers.get("ETag"), response.headers.get("Last-Modified")
+                    )
+
+                return payloads
+            except requests.RequestException as error:
+                if attempt >= self.chunk_retries or not self._is_retryable(error):
+                    raise
+                retry_after = error.response.headers.get("Retry-After") if error.response is not None else None
+                time.sleep(self._backoff(attempt, retry_after))
+                attempt += 1
+
+    def _cache_ttl(self, end: date) -> float:
+        settled = datetime.now(timezone.utc).date() - timedelta(days=SETTLED_AFTER_DAYS)
+        return self.cache_ttl if end < settled else self.cache_recent_ttl
+
+    def _is_retryable(self, error: requests.RequestException) -> bool:
+        if isinstance(error, requests.HTTPError):
+            return error.response is not None and error.response.status_code in self.RETRYABLE_STATUS_CODES
+        return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+
+class AsyncAirQualityClient(_AirQualityClientBase):
+    def __init__(
+            self,
+            latitude: Optional[float] = None,
+            longitude: Optional[float] = None,
+            base_url: Optional[str] = None,
+            chunk_days: Optional[int] = None,
+            max_workers: Optional[int] = None,
+            chunk_retries: Optional[int] = None,
+            retry_delay: float = 0.5,
+            connect_timeout: Optional[float] = None,
+            read_timeout: Optional[float] = None,
+            locations_per_request: Optional[int] = None,
+            max_retry_after: Optional[float] = None,
+            session: Optional[aiohttp.ClientSession] = None
+    ):
+        super().__init__(
+            latitude, longitude, base_url, chunk_days, max_workers, chunk_retries,
+            retry_delay, connect_timeout, read_timeout, locations_per_request, max_retry_after
+        )
+        # an ASGI deployment can hand in a session bound to its long-lived loop; otherwise each loop gets one,
+        # shared by every call made on it, so windows and gap fetches reuse its keep-alive connections
+        self.session = session
+        self._sessions: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, aiohttp.ClientSession]" = (
+            weakref.WeakKeyDictionary()
+        )
+
+    async def close(self) -> None:
+        # closes the running loop's own session; a loop that ends with the request must close it before it goes
+        session = self._sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+    def _session(self) -> aiohttp.ClientSession:
+        if self.session is not None:
+            return self.session
+
+        loop = asyncio.get_running_loop()
+        session = self._sessions.get(loop)
+        if session is None or session.closed:
+            timeout = aiohttp.ClientTimeout(sock_connect=self.timeout[0], sock_read=self.timeout[1])
+            connector = aiohttp.TCPConnector(limit=self.max_workers)
+            session = self._sessions[loop] = aiohttp.ClientSession(timeout=timeout, connector=connector)
+        return session
+
+    async def get_air_quality_data(
+            self,
+            start_date: datetime,
+            end_date: datetime,
+            pollutants: Optional[List[str]] = None
+    ) -> Dict[str, Any]:
+        payloads = await self.get_air_quality_data_for_locations(
+            [(self.latitude, self.longitude)], start_date, end_date, pollutants
+        )
+        return payloads[0]
+
+    async def get_air_quality_data_for_locations(
+            self,
+            coordinates: List[Tuple[float, float]],
+            start_date: datetime,
+            end_date: datetime,
+            pollutants: Optional[List[str]] = None
+    ) -> List[Dict[str, Any]]:
+        if pollutants is None:
+            pollutants = DEFAULT_POLLUTANTS
+
+        windows = self._split_range(start_date.date(), end_date.date())
+        batches = self._batch_coordinates(coordinates)
+        tasks = [(window, batch) for batch in batches for window in windows]
+        semaphore = asyncio.Semaphore(self.max_workers)
+
+        results = await self._fetch_tasks(self._session(), semaphore, tasks, pollutants)
+
+        return self._assemble_locations(batches, windows, results)
+
+    async def _fetch_tasks(
+            self,
+            session: aiohttp.ClientSession,
+            semaphore: asyncio.Semaphore,
+            tasks: List[Tuple[Tuple[date, date], List[Tuple[float, float]]]],
+            pollutants: List[str]
+    ) -> List[List[Dict[str, Any]]]:
+        return await asyncio.gather(*(
+            self._fetch_window(session, semaphore, start, end, pollutants, batch) for (start, end), batch in tasks
+        ))
+
+    async def _fetch_window(
+            self,
+            session: aiohttp.ClientSession,
+            semaphore: asyncio.Semaphore,
+            start: date,
+            end: date,
+            pollutants: List[str],
+            coordinates: List[Tuple[float, float]]
+    ) -> List[Dict[str, Any]]:
+        params = {key: str(value) for key, value in self._window_params(start, end, pollutants, coordinates).items()}
 
-        response = requests.get(self.BASE_URL, params=params)
-        response.raise_for_status()
+        attempt = 0
+        async with semaphore:
+            while True:
+                try:
+                    async with session.get(self.base_url, params=params) as response:
+                        response.raise_for_status()
+                        return self._split_payloads(await response.json(content_type=None), coordinates)
+                except aiohttp.ClientResponseError as error:
+                    if attempt >= self.chunk_retries or error.status not in self.RETRYABLE_STATUS_CODES:
+                        raise
+                    delay = self._backoff(attempt, error.headers.get("Retry-After") if error.headers else None)
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                    if attempt >= self.chunk_retries:
+                        raise
+                    delay = self.retry_delay * 2 ** attempt
 
-        return response.json()
\ No newline at end of file
+                await asyncio.sleep(delay)
+                attempt += 1
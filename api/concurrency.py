@@ -0,0 +1,114 @@
+from typing import Any, Callable, Dict, Hashable, Iterator, Optional, TypeVar
+from contextlib import contextmanager
+import threading
+
+T = TypeVar("T")
+
+
+class _Flight:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    # concurrent calls with the same key wait for the first one and share its result or exception
+    def __init__(self):
+        self.coalesced = 0
+        self._flights: Dict[Hashable, _Flight] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, fn: Callable[[], T]) -> T:
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = fn()
+            return flight.result
+        except BaseException as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+
+class RWLock:
+    # any number of readers or one writer; waiting writers hold back new readers so writes are not starved
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writing = False
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read(self) -> Iterator[None]:
+        with self._condition:
+            while self._writing or self._waiting_writers:
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def write(self) -> Iterator[None]:
+        with self._condition:
+            self._waiting_writers += 1
+            while self._writing or self._readers:
+                self._condition.wait()
+            self._waiting_writers -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writing = False
+                self._condition.notify_all()
+
+
+class KeyedRWLocks:
+    # one RWLock per key, so writers to one location never stall readers of another
+    def __init__(self):
+        self._locks: Dict[Hashable, RWLock] = {}
+
+    @contextmanager
+    def write(self, key: Hashable) -> Iterator[None]:
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks.setdefault(key, RWLock())
+        with lock.write():
+            yield
+
+    @contextmanager
+    def read(self, key: Hashable) -> Iterator[bool]:
+        # only writes create a lock, so reads of arbitrary keys cannot grow the map; a key that was never
+        # written has nothing to read, and the caller gets False instead of a lock
+        lock = self._locks.get(key)
+        if lock is None:
+            yield False
+            return
+        with lock.read():
+            yield True
+
+    def __len__(self) -> int:
+        return len(self._locks)
@@ -0,0 +1,99 @@
+from typing import Dict, List, Tuple
+from api.models import DEFAULT_LOCATION
+from datetime import date
+from time import monotonic
+import bisect
+
+
+class IntervalSet:
+    # disjoint, sorted half-open [start, end) integer intervals; touching intervals are merged on insert
+    def __init__(self):
+        self._starts: List[int] = []
+        self._ends: List[int] = []
+
+    def __len__(self) -> int:
+        return len(self._starts)
+
+    def add(self, start: int, end: int) -> None:
+        if start >= end:
+            return
+
+        first = bisect.bisect_left(self._ends, start)
+        last = bisect.bisect_right(self._starts, end)
+
+        if first < last:
+            start = min(start, self._starts[first])
+            end = max(end, self._ends[last - 1])
+
+        self._starts[first:last] = [start]
+        self._ends[first:last] = [end]
+
+    def missing(self, start: int, end: int) -> List[Tuple[int, int]]:
+        gaps = []
+        cursor = start
+        index = bisect.bisect_right(self._ends, start)
+
+        while cursor < end and index < len(self._starts) and self._starts[index] < end:
+            if self._starts[index] > cursor:
+                gaps.append((cursor, self._starts[index]))
+            cursor = max(cursor, self._ends[index])
+            index += 1
+
+        if cursor < end:
+            gaps.append((cursor, end))
+
+        return gaps
+
+    def intervals(self) -> List[Tuple[int, int]]:
+        return list(zip(self._starts, self._ends))
+
+
+class CoverageIndex:
+    # which calendar days have been fetched from upstream, per location; days are the upstream's granularity
+    def __init__(self):
+        self._days: Dict[str, IntervalSet] = {}
+
+    def mark_covered(self, start: date, end: date, location: str = DEFAULT_LOCATION) -> None:
+        self._days.setdefault(location, IntervalSet()).add(start.toordinal(), end.toordinal() + 1)
+
+    def get_missing_ranges(self, start: date, end: date, location: str = DEFAULT_LOCATION) -> List[Tuple[date, date]]:
+        days = self._days.get(location)
+        if days is None:
+            return [(start, end)] if start <= end else []
+
+        return [
+            (date.fromordinal(gap_start), date.fromordinal(gap_end - 1))
+            for gap_start, gap_end in days.missing(start.toordinal(), end.toordinal() + 1)
+        ]
+
+    def get_covered_ranges(self, location: str = DEFAULT_LOCATION) -> List[Tuple[date, date]]:
+        days = self._days.get(location)
+        if days is None:
+            return []
+
+        return [(date.fromordinal(start), date.fromordinal(end - 1)) for start, end in days.intervals()]
+
+
+class RefreshIndex:
+    # the days a background refresh re-fetched, per location, with the monotonic time they stop counting as
+    # fresh. Recent days are never marked covered, but while a refresher keeps them current they need not be
+    # re-fetched; one instance is shared by every service reading the same repository
+    def __init__(self):
+        self._windows: Dict[str, Tuple[int, int, float]] = {}
+
+    def mark_refreshed(self, start: date, end: date, location: str, ttl: float) -> None:
+        self._windows[location] = (start.toordinal(), end.toordinal() + 1, monotonic() + ttl)
+
+    def get_stale_ranges(self, ranges: List[Tuple[date, date]],
+                         location: str = DEFAULT_LOCATION) -> List[Tuple[date, date]]:
+        window = self._windows.get(location)
+        if window is None or window[2] < monotonic():
+            return ranges
+
+        fresh = IntervalSet()
+        fresh.add(window[0], window[1])
+        return [
+            (date.fromordinal(gap_start), date.fromordinal(gap_end - 1))
+            for start, end in ranges
+            for gap_start, gap_end in fresh.missing(start.toordinal(), end.toordinal() + 1)
+        ]
@@ -1,21 +1,57 @@
-from api.services import AirQualityService, ValidationService
-from api.repository import InMemoryRepository
-from api.client import AirQualityClient
+from api.services import AirQualityService, AsyncAirQualityService, ValidationService
+from api.repository import InMemoryRepository, ColumnarRepository, SQLiteRepository
+from api.client import AirQualityClient, AsyncAirQualityClient
+from api.coverage import RefreshIndex
+import os
 
 def get_air_quality_client():
     return AirQualityClient()
 
 
+def get_async_air_quality_client():
+    return AsyncAirQualityClient()
+
+
 def get_repository():
-    return InMemoryRepository()
+    backend = os.getenv("REPOSITORY_BACKEND", "memory")
+
+    if backend == "columnar":
+        return ColumnarRepository()
+    if backend == "sqlite":
+        return SQLiteRepository(os.getenv("SQLITE_PATH", "air_quality.db"))
+    if backend == "memory":
+        return InMemoryRepository()
+
+    raise ValueError(f"Unknown repository backend: {backend}")
+
+
+# the sync and async services must read and write the same store, and agree on which of its days are fresh
+shared_repository = get_repository()
+shared_refresh_index = RefreshIndex()
 
 
 def get_validation_service():
     return ValidationService()
 
 
+shared_air_quality_client = get_air_quality_client()
+# the service is shared as well, so state kept on it (such as in-flight fetches) spans requests
+shared_air_quality_service = AirQualityService(shared_repository, shared_air_quality_client, shared_refresh_index)
+
+
 def get_air_quality_service(
-        repository: InMemoryRepository = get_repository(),
-        client: AirQualityClient = get_air_quality_client()
+        repository: InMemoryRepository = shared_repository,
+        client: AirQualityClient = shared_air_quality_client
+):
+    if repository is shared_repository and client is shared_air_quality_client:
+        return shared_air_quality_service
+    return AirQualityService(repository, client)
+
+
+def get_async_air_quality_service(
+        repository: InMemoryRepository = shared_repository,
+        client: AsyncAirQualityClient = get_async_air_quality_client()
 ):
-    return AirQualityService(repository, client)
\ No newline at end of file
+    if repository is shared_repository:
+        return AsyncAirQualityService(repository, client, shared_refresh_index)
+    return AsyncAirQualityService(repository, client)
@@ -1,12 +1,152 @@
-from api.dependencies import get_air_quality_service, get_validation_service
-from flask import Blueprint, request, jsonify, abort, views, current_app, Response
-from api.models import EnvironmentalReadingSchema
+from api.dependencies import get_air_quality_service, get_async_air_quality_service, get_validation_service
+from flask import Blueprint, request, jsonify, abort, views, current_app, Response, stream_with_context
+from api.models import EnvironmentalReadingSchema, DEFAULT_LOCATION, canonical_location
+from api.serializers import (
+    dump_reading,
+    dump_columns,
+    encode,
+    compress,
+    content_encodings,
+    response_mimetypes,
+    JSON_MIMETYPE,
+    MSGPACK_MIMETYPE
+)
+from api.aggregation import MEASUREMENT_FIELDS, bucket_range, parse_bucket
+from api.services import AsyncAirQualityService
+from api.cache import VersionedCache
 from marshmallow import ValidationError
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 from datetime import datetime
+import itertools
+import json
+import os
 
 bp = Blueprint('environmental', __name__)
 
 environmental_schema = EnvironmentalReadingSchema()
+environmental_schema_many = EnvironmentalReadingSchema(many=True)
+
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/jsonl')
+BULK_MAX_READINGS = int(os.getenv("BULK_MAX_READINGS", "10000"))
+BULK_MAX_BYTES = int(os.getenv("BULK_MAX_BYTES", str(BULK_MAX_READINGS * 1024)))
+RANGE_MAX_READINGS = 10000
+AGGREGATE_MAX_BUCKETS = 10000
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+READING_FORMATS = ('rows', 'columns')
+
+
+def _response_cache() -> VersionedCache:
+    extensions = current_app.extensions
+    if 'response_cache' not in extensions:
+        backend = extensions['cache']
+        # flask-caching registers {Cache: backend}; versioned entries are written to the backend itself
+        if isinstance(backend, dict):
+            backend = next(iter(backend.values()))
+        extensions.setdefault('response_cache', VersionedCache(backend))
+
+    return extensions['response_cache']
+
+
+def _json_response(body: bytes, mimetype: str = JSON_MIMETYPE) -> Response:
+    return current_app.response_class(body, mimetype=mimetype)
+
+
+@bp.after_request
+def _compress_response(response: Response) -> Response:
+    # streamed bodies are sent as they are produced and are left alone, like anything already encoded
+    if (response.is_streamed or response.status_code != 200 or response.content_encoding
+            or response.mimetype not in (JSON_MIMETYPE, MSGPACK_MIMETYPE)):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(content_encodings())
+    if encoding is None or response.calculate_content_length() < COMPRESS_MIN_SIZE:
+        return response
+
+    response.set_data(compress(response.get_data(), encoding))
+    response.content_encoding = encoding
+    return response
+
+
+def _negotiate_mimetype() -> str:
+    return request.accept_mimetypes.best_match(response_mimetypes()) or JSON_MIMETYPE
+
+
+def _parse_format() -> bool:
+    value = request.args.get('format', 'rows')
+    if value not in READING_FORMATS:
+        abort(400, description=f"Invalid format, expected one of: {', '.join(READING_FORMATS)}")
+    return value == 'columns'
+
+
+def _dump_readings(readings: List, columnar: bool) -> Any:
+    return dump_columns(readings) if columnar else [dump_reading(reading) for reading in readings]
+
+
+def _bulk_response(data: Any, mimetype: str) -> Response:
+    response = _json_response(encode(data, mimetype), mimetype)
+    response.vary.add('Accept')
+    return response
+
+
+def _not_modified(etag: str, last_modified: Optional[datetime]) -> bool:
+    # If-None-Match wins when both are sent; Last-Modified only has whole seconds, the ETag does not
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if last_modified is not None and request.if_modified_since is not None:
+        return last_modified.replace(microsecond=0) <= request.if_modified_since
+    return False
+
+
+def _cached_response(air_quality_service, location: str, cache_key: str, render: Callable[[], bytes],
+                     mimetype: Optional[str] = None) -> Response:
+    # validators come from the location's write version, so a poll that has seen it is answered
+    # before the cache, the repository or the serialiser is touched
+    version = air_quality_service.get_data_version(location)
+    last_modified = air_quality_service.get_last_modified(location)
+    etag = f"{version}-{int(last_modified.timestamp() * 1_000_000)}" if last_modified is not None else str(version)
+
+    # a negotiated media type is part of the entry: the same URL can be JSON or MessagePack
+    if mimetype is not None and mimetype != JSON_MIMETYPE:
+        etag = f"{etag}-{mimetype.rsplit('/', 1)[-1]}"
+        cache_key = f"{cache_key}_{mimetype}"
+
+    if _not_modified(etag, last_modified):
+        response = current_app.response_class(status=304)
+    else:
+        # versions are only comparable within one repository, so its scope keeps a shared backend's entries apart
+        namespace = f"{air_quality_service.get_cache_scope()}:{location}"
+        response = _json_response(
+            _response_cache().get_or_fill(namespace, version, cache_key, render), mimetype or JSON_MIMETYPE
+        )
+
+    response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    if mimetype is not None:
+        response.vary.add('Accept')
+    return response
+
+
+def _parse_location(value: Optional[str]) -> str:
+    if not value:
+        return DEFAULT_LOCATION
+
+    try:
+        return canonical_location(value)
+    except ValueError:
+        abort(400, description="Invalid location, expected 'latitude,longitude'")
+
+
+def _parse_locations() -> List[str]:
+    locations = []
+    for value in request.args.getlist('location'):
+        location = _parse_location(value)
+        if location not in locations:
+            locations.append(location)
+
+    return locations
+
 
 class ReadingView(views.MethodView):
     def post(self) -> tuple[Response, int]:
@@ -25,11 +165,90 @@ class ReadingView(views.MethodView):
         if not validation_service.validate_reading(reading):
             abort(400, description="Invalid reading data")
 
-        air_quality_service.save_reading(reading)
+        air_quality_service.save_reading(reading, _parse_location(request.args.get('location')))
 
         return jsonify(environmental_schema.dump(reading)), 201
 
 
+def _parse_bulk_body() -> Tuple[List[Tuple[int, Any]], Dict[int, Any]]:
+    # werkzeug refuses a body over the limit before reading it, or as soon as a chunked one passes it
+    request.max_content_length = BULK_MAX_BYTES
+
+    if request.mimetype in NDJSON_MIMETYPES:
+        items, errors = [], {}
+        index = 0
+        # read line by line, so a body with too many readings is refused without buffering the rest of it
+        for line in request.stream:
+            if not line.strip():
+                continue
+            if index == BULK_MAX_READINGS:
+                abort(413, description=f"At most {BULK_MAX_READINGS} readings per request")
+            try:
+                items.append((index, json.loads(line)))
+            except ValueError:
+                errors[index] = {"_schema": ["Invalid JSON"]}
+            index += 1
+        return items, errors
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, list):
+        abort(400, description="Expected a JSON array or NDJSON body")
+
+    return list(enumerate(data)), {}
+
+
+def _load_readings(items: List[Tuple[int, Any]], errors: Dict[int, Any]) -> List[Tuple[int, Any]]:
+    positions = [index for index, _ in items]
+    data = [item for _, item in items]
+
+    # a clean batch is loaded in a single call; only a batch with errors is revisited item by item
+    try:
+        return list(zip(positions, environmental_schema_many.load(data)))
+    except ValidationError as err:
+        failed = err.messages
+        loaded = []
+        for offset, (index, item) in enumerate(items):
+            if offset in failed:
+                errors[index] = failed[offset]
+            else:
+                loaded.append((index, environmental_schema.load(item)))
+        return loaded
+
+
+class BulkReadingView(views.MethodView):
+    def post(self) -> tuple[Response, int]:
+        air_quality_service = get_air_quality_service()
+        validation_service = get_validation_service()
+
+        location = _parse_location(request.args.get('location'))
+        items, errors = _parse_bulk_body()
+
+        if not items and not errors:
+            abort(400, description="No input data provided")
+        if len(items) + len(errors) > BULK_MAX_READINGS:
+            abort(413, description=f"At most {BULK_MAX_READINGS} readings per request")
+
+        loaded = _load_readings(items, errors)
+        valid = validation_service.validate_readings([reading for _, reading in loaded])
+
+        readings = []
+        for (index, reading), is_valid in zip(loaded, valid):
+            if is_valid:
+                readings.append(reading)
+            else:
+                errors[index] = {"_schema": ["Invalid reading data"]}
+
+        if readings:
+            air_quality_service.save_readings(readings, location)
+
+        status = 201 if not errors else 207 if readings else 400
+
+        return jsonify({
+            "saved": len(readings),
+            "errors": {str(index): errors[index] for index in sorted(errors)}
+        }), status
+
+
 class ClosestReadingView(views.MethodView):
     def get(self) -> Response:
         air_quality_service = get_air_quality_service()
@@ -43,46 +262,143 @@ class ClosestReadingView(views.MethodView):
         except ValueError:
             abort(400, description="Invalid timestamp format")
 
-        cache_key = f"closest_reading_{timestamp.isoformat()}"
-        cached_result = current_app.extensions['cache'].get(cache_key)
+        location = _parse_location(request.args.get('location'))
+        cache_key = f"closest_reading_{location}_{timestamp.isoformat()}"
 
-        if cached_result:
-            return jsonify(cached_result)
+        return _cached_response(
+            air_quality_service, location, cache_key, lambda: self._render(air_quality_service, timestamp, location)
+        )
 
-        reading = air_quality_service.get_reading_closest_to_timestamp(timestamp)
+    def _render(self, air_quality_service, timestamp: datetime, location: str) -> bytes:
+        reading = air_quality_service.get_reading_closest_to_timestamp(timestamp, location)
 
         if not reading:
             abort(404, description="No readings available")
 
-        result = environmental_schema.dump(reading)
+        return encode(dump_reading(reading))
+
+
+def _parse_date_range() -> tuple[datetime, datetime]:
+    start_date_str = request.args.get('start_date')
+    end_date_str = request.args.get('end_date')
+
+    if not start_date_str or not end_date_str:
+        abort(400, description="Both start_date and end_date parameters are required")
+
+    try:
+        start_date = datetime.fromisoformat(start_date_str.replace("Z", "+00:00"))
+        end_date = datetime.fromisoformat(end_date_str.replace("Z", "+00:00"))
+    except ValueError:
+        abort(400, description="Invalid date format")
+
+    return start_date, end_date
 
-        current_app.extensions['cache'].set(cache_key, result)
 
-        return jsonify(result)
+def _parse_flag(name: str) -> bool:
+    return request.args.get(name, '').lower() in ('1', 'true', 'yes')
+
+
+def _wants_stream() -> bool:
+    return _parse_flag('stream') or request.accept_mimetypes.best_match(
+        ['application/json', 'application/x-ndjson']
+    ) == 'application/x-ndjson'
+
+
+def _ndjson_lines(readings: Iterator, location: Optional[str] = None) -> Iterator[bytes]:
+    for reading in readings:
+        data = dump_reading(reading)
+        if location is not None:
+            data["location"] = location
+        yield encode(data)
+
+
+def _stream_readings(air_quality_service, start_date: datetime, end_date: datetime,
+                     locations: List[str], refresh: bool) -> Response:
+    if len(locations) > 1:
+        lines = itertools.chain.from_iterable(
+            _ndjson_lines(air_quality_service.stream_air_quality_data(start_date, end_date, location, refresh), location)
+            for location in locations
+        )
+    else:
+        location = locations[0] if locations else DEFAULT_LOCATION
+        lines = _ndjson_lines(air_quality_service.stream_air_quality_data(start_date, end_date, location, refresh))
+
+    # pull the first window before the headers go out, so an upstream failure still gets a proper error status
+    first = next(lines, None)
+    if first is not None:
+        lines = itertools.chain([first], lines)
+
+    return Response(stream_with_context(lines), mimetype='application/x-ndjson')
 
 
 class FetchDataView(views.MethodView):
     def get(self) -> Response:
         air_quality_service = get_air_quality_service()
 
-        start_date_str = request.args.get('start_date')
-        end_date_str = request.args.get('end_date')
+        start_date, end_date = _parse_date_range()
+        locations = _parse_locations()
+        refresh = _parse_flag('refresh')
 
-        if not start_date_str or not end_date_str:
-            abort(400, description="Both start_date and end_date parameters are required")
+        if _wants_stream():
+            return _stream_readings(air_quality_service, start_date, end_date, locations, refresh)
 
+        columnar = _parse_format()
+        mimetype = _negotiate_mimetype()
+
+        if len(locations) > 1:
+            stored = air_quality_service.fetch_and_store_for_locations(
+                start_date, end_date, locations, refresh=refresh
+            )
+            return _bulk_response({"locations": {
+                location: _dump_readings(readings, columnar)
+                for location, readings in stored.items()
+            }}, mimetype)
+
+        if locations:
+            readings = air_quality_service.fetch_and_store_air_quality_data(
+                start_date, end_date, locations[0], refresh=refresh
+            )
+        else:
+            readings = air_quality_service.fetch_and_store_air_quality_data(start_date, end_date, refresh=refresh)
+
+        return _bulk_response({"readings": _dump_readings(readings, columnar)}, mimetype)
+
+
+class AsyncFetchDataView(views.MethodView):
+    async def get(self) -> Response:
+        air_quality_service = get_async_air_quality_service()
+
+        # under WSGI the event loop only lives for this request, so its upstream session is closed with it
         try:
-            start_date = datetime.fromisoformat(start_date_str.replace("Z", "+00:00"))
-            end_date = datetime.fromisoformat(end_date_str.replace("Z", "+00:00"))
-        except ValueError:
-            abort(400, description="Invalid date format")
+            return await self._fetch(air_quality_service)
+        finally:
+            await air_quality_service.close()
 
-        readings = air_quality_service.fetch_and_store_air_quality_data(
-            start_date,
-            end_date
-        )
+    async def _fetch(self, air_quality_service: AsyncAirQualityService) -> Response:
+        start_date, end_date = _parse_date_range()
+        locations = _parse_locations()
+        refresh = _parse_flag('refresh')
 
-        return jsonify({"readings": [environmental_schema.dump(reading) for reading in readings]})
+        columnar = _parse_format()
+        mimetype = _negotiate_mimetype()
+
+        if len(locations) > 1:
+            stored = await air_quality_service.fetch_and_store_for_locations(
+                start_date, end_date, locations, refresh=refresh
+            )
+            return _bulk_response({"locations": {
+                location: _dump_readings(readings, columnar)
+                for location, readings in stored.items()
+            }}, mimetype)
+
+        if locations:
+            readings = await air_quality_service.fetch_and_store_air_quality_data(
+                start_date, end_date, locations[0], refresh=refresh
+            )
+        else:
+            readings = await air_quality_service.fetch_and_store_air_quality_data(start_date, end_date, refresh=refresh)
+
+        return _bulk_response({"readings": _dump_readings(readings, columnar)}, mimetype)
 
 
 class ReadingsListView(views.MethodView):
@@ -101,20 +417,37 @@ class ReadingsListView(views.MethodView):
         except ValueError:
             abort(400, description="Invalid pagination parameters")
 
-        cache_key = f"readings_list_page_{page}_per_page_{per_page}"
-        cached_response = current_app.extensions['cache'].get(cache_key)
+        location = _parse_location(request.args.get('location'))
+        columnar = _parse_format()
+        mimetype = _negotiate_mimetype()
 
-        if cached_response:
-            return jsonify(cached_response)
+        before_str = request.args.get('before')
+        if before_str:
+            try:
+                before = datetime.fromisoformat(before_str.replace("Z", "+00:00"))
+            except ValueError:
+                abort(400, description="Invalid before timestamp format")
 
-        readings, total = air_quality_service.get_paginated_readings(page, per_page)
+            return self._get_before(air_quality_service, before, per_page, location, columnar, mimetype)
+
+        cache_key = f"readings_list_{location}_page_{page}_per_page_{per_page}_columns_{columnar}"
+
+        return _cached_response(
+            air_quality_service, location, cache_key,
+            lambda: self._render_page(air_quality_service, page, per_page, location, columnar, mimetype),
+            mimetype
+        )
+
+    def _render_page(self, air_quality_service, page: int, per_page: int, location: str, columnar: bool,
+                     mimetype: str) -> bytes:
+        readings, total = air_quality_service.get_paginated_readings(page, per_page, location)
 
         total_pages = (total + per_page - 1) // per_page if total > 0 else 0
         has_next = page < total_pages
         has_prev = page > 1
 
         response = {
-            "readings": [environmental_schema.dump(reading) for reading in readings],
+            "readings": _dump_readings(readings, columnar),
             "pagination": {
                 "page": page,
                 "per_page": per_page,
@@ -125,11 +458,179 @@ class ReadingsListView(views.MethodView):
             }
         }
 
-        current_app.extensions['cache'].set(cache_key, response)
+        return encode(response, mimetype)
+
+    def _get_before(self, air_quality_service, before: datetime, per_page: int, location: str, columnar: bool,
+                    mimetype: str) -> Response:
+        cache_key = f"readings_list_{location}_before_{before.isoformat()}_per_page_{per_page}_columns_{columnar}"
+
+        return _cached_response(
+            air_quality_service, location, cache_key,
+            lambda: self._render_before(air_quality_service, before, per_page, location, columnar, mimetype),
+            mimetype
+        )
+
+    def _render_before(self, air_quality_service, before: datetime, per_page: int, location: str, columnar: bool,
+                       mimetype: str) -> bytes:
+        # one extra row tells us whether an older page exists without counting everything
+        readings = air_quality_service.get_readings_before(before, per_page + 1, location)
+        has_next = len(readings) > per_page
+        readings = readings[:per_page]
+
+        response = {
+            "readings": _dump_readings(readings, columnar),
+            "pagination": {
+                "per_page": per_page,
+                "before": before.isoformat(),
+                "next_before": readings[-1].timestamp.isoformat() if has_next else None,
+                "has_next": has_next
+            }
+        }
+
+        return encode(response, mimetype)
+
+class RangeReadingsView(views.MethodView):
+    def get(self) -> Response:
+        air_quality_service = get_air_quality_service()
+
+        start_date, end_date = _parse_date_range()
+        location = _parse_location(request.args.get('location'))
+
+        try:
+            limit = int(request.args.get('limit', 1000))
+        except ValueError:
+            abort(400, description="Invalid limit parameter")
+
+        if limit < 1 or limit > RANGE_MAX_READINGS:
+            abort(400, description=f"Limit must be between 1 and {RANGE_MAX_READINGS}")
+
+        columnar = _parse_format()
+        mimetype = _negotiate_mimetype()
+        cache_key = (
+            f"readings_range_{location}_{start_date.isoformat()}_{end_date.isoformat()}_limit_{limit}_columns_{columnar}"
+        )
+
+        return _cached_response(
+            air_quality_service, location, cache_key,
+            lambda: self._render(air_quality_service, start_date, end_date, limit, location, columnar, mimetype),
+            mimetype
+        )
+
+    def _render(self, air_quality_service, start_date: datetime, end_date: datetime, limit: int,
+                location: str, columnar: bool, mimetype: str) -> bytes:
+        # oldest first; one extra row tells us where the next page starts
+        readings = air_quality_service.get_readings_in_range(start_date, end_date, location, limit + 1)
+        next_start = readings[limit].timestamp.isoformat() if len(readings) > limit else None
+
+        return encode({
+            "readings": _dump_readings(readings[:limit], columnar),
+            "next_start": next_start
+        }, mimetype)
+
+
+def _parse_fields() -> List[str]:
+    fields = [name.strip() for name in request.args.get('fields', '').split(',') if name.strip()]
+    if not fields:
+        return list(MEASUREMENT_FIELDS)
+
+    unknown = [name for name in fields if name not in MEASUREMENT_FIELDS]
+    if unknown:
+        abort(400, description=f"Unknown fields: {', '.join(unknown)}")
+
+    return fields
+
+
+def _parse_percentiles() -> List[float]:
+    value = request.args.get('percentiles')
+    if not value:
+        return []
+
+    try:
+        percentiles = [float(item) for item in value.split(',')]
+    except ValueError:
+        abort(400, description="Invalid percentiles parameter")
+
+    if any(not 0 <= percentile <= 100 for percentile in percentiles):
+        abort(400, description="Percentiles must be between 0 and 100")
+
+    return percentiles
+
+
+class AggregateView(views.MethodView):
+    def get(self) -> Response:
+        air_quality_service = get_air_quality_service()
+
+        start_date, end_date = _parse_date_range()
+        location = _parse_location(request.args.get('location'))
+        fields = _parse_fields()
+        percentiles = _parse_percentiles()
+
+        bucket = request.args.get('bucket', '1d')
+        try:
+            bucket_seconds = parse_bucket(bucket)
+        except ValueError:
+            abort(400, description="Invalid bucket, expected a size like 1h, 1d or 1w")
+
+        if len(bucket_range(start_date, end_date, bucket_seconds)) > AGGREGATE_MAX_BUCKETS:
+            abort(400, description=f"At most {AGGREGATE_MAX_BUCKETS} buckets per request")
+
+        cache_key = (
+            f"readings_aggregate_{location}_{start_date.isoformat()}_{end_date.isoformat()}_{bucket}_"
+            f"{','.join(fields)}_{','.join(f'{percentile:g}' for percentile in percentiles)}"
+        )
+
+        return _cached_response(
+            air_quality_service, location, cache_key,
+            lambda: encode({
+                "bucket": bucket,
+                "buckets": air_quality_service.aggregate_readings(
+                    start_date, end_date, bucket_seconds, location, fields, percentiles
+                )
+            })
+        )
+
+
+class RangeStatsView(views.MethodView):
+    def get(self) -> Response:
+        air_quality_service = get_air_quality_service()
+
+        start_date, end_date = _parse_date_range()
+        location = _parse_location(request.args.get('location'))
+        fields = _parse_fields()
+
+        cache_key = f"readings_stats_{location}_{start_date.isoformat()}_{end_date.isoformat()}_{','.join(fields)}"
+
+        return _cached_response(
+            air_quality_service, location, cache_key,
+            lambda: encode({
+                "start": start_date.isoformat(),
+                "end": end_date.isoformat(),
+                "fields": air_quality_service.get_range_stats(start_date, end_date, location, fields)
+            })
+        )
+
+
+class CacheStatsView(views.MethodView):
+    def get(self) -> Response:
+        return jsonify(_response_cache().stats())
+
+
+class SchedulerStatusView(views.MethodView):
+    def get(self) -> Response:
+        scheduler = current_app.extensions.get('refresh_scheduler')
+        if scheduler is None:
+            return jsonify({"running": False, "locations": {}})
 
-        return jsonify(response)
+        return jsonify(scheduler.status())
 
 bp.add_url_rule('/readings', view_func=ReadingView.as_view('reading'))
+bp.add_url_rule('/readings/bulk', view_func=BulkReadingView.as_view('readings_bulk'))
 bp.add_url_rule('/readings/closest', view_func=ClosestReadingView.as_view('closest_reading'))
 bp.add_url_rule('/readings/list', view_func=ReadingsListView.as_view('readings_list'))
-bp.add_url_rule('/fetch-data', view_func=FetchDataView.as_view('fetch_data'))
\ No newline at end of file
+bp.add_url_rule('/readings/range', view_func=RangeReadingsView.as_view('readings_range'))
+bp.add_url_rule('/readings/aggregate', view_func=AggregateView.as_view('readings_aggregate'))
+bp.add_url_rule('/readings/stats', view_func=RangeStatsView.as_view('readings_stats'))
+bp.add_url_rule('/fetch-data', view_func=FetchDataView.as_view('fetch_data'))
+bp.add_url_rule('/fetch-data/async', view_func=AsyncFetchDataView.as_view('fetch_data_async'))
+bp.add_url_rule('/cache/stats', view_func=CacheStatsView.as_view('cache_stats'))
+bp.add_url_rule('/scheduler/status', view_func=SchedulerStatusView.as_view('scheduler_status'))
\ No newline at end of file
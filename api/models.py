@@ -1,9 +1,63 @@
-from marshmallow import Schema, fields, validates, ValidationError, post_load
-from typing import List, Optional
+from marshmallow import Schema, fields, validate, post_load
+from typing import Dict, Iterator, List, Optional, Tuple
 from datetime import datetime
+import os
+
+WEATHER_FIELDS = ("temperature", "precipitation", "pressure", "wind_speed")
+POLLUTANT_FIELDS = ("pm10", "pm2_5", "carbon_monoxide", "nitrogen_dioxide", "sulphur_dioxide", "ozone")
+
+# readings saved or fetched without an explicit location belong to the configured default site
+DEFAULT_LOCATION = "default"
+
+# (minimum, maximum, message) for every range-checked field; drives both the schemas and ValidationService
+FIELD_BOUNDS: Dict[str, Tuple[Optional[float], Optional[float], str]] = {
+    "temperature": (-100, 60, "Temperature must be between -100 and 60°C"),
+    "pressure": (800, 1200, "Pressure must be between 800 and 1200 hPa"),
+    "wind_speed": (0, None, "Wind speed cannot be negative"),
+    "pm10": (0, 1000, "PM10 value must be between 0 and 1000 μg/m³"),
+    "pm2_5": (0, 500, "PM2.5 value must be between 0 and 500 μg/m³"),
+    "carbon_monoxide": (0, 50, "Carbon Monoxide value must be between 0 and 50 mg/m³")
+}
+
+
+def _measurement(name: str) -> fields.Float:
+    if name not in FIELD_BOUNDS:
+        return fields.Float(allow_none=True)
+
+    minimum, maximum, message = FIELD_BOUNDS[name]
+    return fields.Float(allow_none=True, validate=validate.Range(min=minimum, max=maximum, error=message))
+
+
+def format_location(latitude: float, longitude: float) -> str:
+    return f"{latitude:.4f},{longitude:.4f}"
+
+
+def parse_location(location: str) -> Tuple[float, float]:
+    latitude, longitude = (float(part) for part in location.split(","))
+
+    if not -90 <= latitude <= 90 or not -180 <= longitude <= 180:
+        raise ValueError(f"Coordinates out of range: {location}")
+
+    return latitude, longitude
+
+
+def default_coordinates() -> Tuple[float, float]:
+    return float(os.getenv("LATITUDE", "52.2297")), float(os.getenv("LONGITUDE", "21.0122"))
+
+
+def canonical_location(location: str) -> str:
+    # the configured site is one location whether it is named 'default' or addressed by its coordinates,
+    # so its readings are stored, cached and fetched once under DEFAULT_LOCATION
+    if location == DEFAULT_LOCATION:
+        return location
+
+    location = format_location(*parse_location(location))
+    return DEFAULT_LOCATION if location == format_location(*default_coordinates()) else location
 
 
 class WeatherReading:
+    __slots__ = ("timestamp",) + WEATHER_FIELDS
+
     def __init__(self, timestamp: datetime, temperature: Optional[float] = None,
                  precipitation: Optional[float] = None, pressure: Optional[float] = None,
                  wind_speed: Optional[float] = None):
@@ -15,26 +69,10 @@ class WeatherReading:
 
 class WeatherReadingSchema(Schema):
     timestamp = fields.DateTime(required=True)
-    temperature = fields.Float(allow_none=True)
-    precipitation = fields.Float(allow_none=True)
-    pressure = fields.Float(allow_none=True)
-    wind_speed = fields.Float(allow_none=True)
-
-    # this decorator validates a single field during serialization (in this case 'temperature')
-    @validates('temperature')
-    def validate_temperature(self, value, **kwargs):
-        if value is not None and (value < -100 or value > 60):
-            raise ValidationError("Temperature must be between -100 and 60°C")
-
-    @validates('pressure')
-    def validate_pressure(self, value, **kwargs):
-        if value is not None and (value < 800 or value > 1200):
-            raise ValidationError("Pressure must be between 800 and 1200 hPa")
-
-    @validates('wind_speed')
-    def validate_wind_speed(self, value, **kwargs):
-        if value is not None and value < 0:
-            raise ValidationError("Wind speed cannot be negative")
+    temperature = _measurement("temperature")
+    precipitation = _measurement("precipitation")
+    pressure = _measurement("pressure")
+    wind_speed = _measurement("wind_speed")
 
     @post_load
     def make_weather_reading(self, data, **kwargs):
@@ -42,6 +80,8 @@ class WeatherReadingSchema(Schema):
 
 
 class PollutantReading:
+    __slots__ = ("timestamp",) + POLLUTANT_FIELDS
+
     def __init__(self, timestamp: datetime, pm10: Optional[float] = None,
                  pm2_5: Optional[float] = None, carbon_monoxide: Optional[float] = None,
                  nitrogen_dioxide: Optional[float] = None, sulphur_dioxide: Optional[float] = None,
@@ -57,27 +97,12 @@ class PollutantReading:
 
 class PollutantReadingSchema(Schema):
     timestamp = fields.DateTime(required=True)
-    pm10 = fields.Float(allow_none=True)
-    pm2_5 = fields.Float(allow_none=True)
-    carbon_monoxide = fields.Float(allow_none=True)
-    nitrogen_dioxide = fields.Float(allow_none=True)
-    sulphur_dioxide = fields.Float(allow_none=True)
-    ozone = fields.Float(allow_none=True)
-
-    @validates('pm10')
-    def validate_pm10(self, value, **kwargs):
-        if value is not None and (value < 0 or value > 1000):
-            raise ValidationError("PM10 value must be between 0 and 1000 μg/m³")
-
-    @validates('pm2_5')
-    def validate_pm2_5(self, value, **kwargs):
-        if value is not None and (value < 0 or value > 500):
-            raise ValidationError("PM2.5 value must be between 0 and 500 μg/m³")
-
-    @validates('carbon_monoxide')
-    def validate_carbon_monoxide(self, value, **kwargs):
-        if value is not None and (value < 0 or value > 50):
-            raise ValidationError("Carbon Monoxide value must be between 0 and 50 mg/m³")
+    pm10 = _measurement("pm10")
+    pm2_5 = _measurement("pm2_5")
+    carbon_monoxide = _measurement("carbon_monoxide")
+    nitrogen_dioxide = _measurement("nitrogen_dioxide")
+    sulphur_dioxide = _measurement("sulphur_dioxide")
+    ozone = _measurement("ozone")
 
     @post_load
     def make_pollutant_reading(self, data, **kwargs):
@@ -85,6 +110,8 @@ class PollutantReadingSchema(Schema):
 
 
 class EnvironmentalReading:
+    __slots__ = ("timestamp", "weather", "pollutants")
+
     def __init__(self, timestamp: datetime, weather: Optional[WeatherReading] = None,
                  pollutants: Optional[PollutantReading] = None):
         self.timestamp = timestamp
@@ -102,6 +129,38 @@ class EnvironmentalReadingSchema(Schema):
         return EnvironmentalReading(**data)
 
 
+class ReadingColumns:
+    # column-per-field batch of readings; every column is padded to len(timestamps)
+    __slots__ = ("timestamps", "weather", "pollutants", "_readings")
+
+    def __init__(self, timestamps: List[datetime],
+                 weather: Optional[Dict[str, List[Optional[float]]]] = None,
+                 pollutants: Optional[Dict[str, List[Optional[float]]]] = None):
+        self.timestamps = timestamps
+        self.weather = weather
+        self.pollutants = pollutants
+        self._readings: Optional[List[EnvironmentalReading]] = None
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def iter_readings(self) -> Iterator[EnvironmentalReading]:
+        weather_rows = zip(*(self.weather[name] for name in WEATHER_FIELDS)) if self.weather is not None else None
+        pollutant_rows = zip(*(self.pollutants[name] for name in POLLUTANT_FIELDS)) if self.pollutants is not None else None
+
+        for timestamp in self.timestamps:
+            weather = WeatherReading(timestamp, *next(weather_rows)) if weather_rows is not None else None
+            pollutants = PollutantReading(timestamp, *next(pollutant_rows)) if pollutant_rows is not None else None
+
+            yield EnvironmentalReading(timestamp=timestamp, weather=weather, pollutants=pollutants)
+
+    def to_readings(self) -> List[EnvironmentalReading]:
+        # built once, so a repository that stores reading objects and the caller returning them share one set
+        if self._readings is None:
+            self._readings = list(self.iter_readings())
+        return self._readings
+
+
 class AirQualityResponse:
     def __init__(self, readings: List[PollutantReading]):
         self.readings = readings
@@ -1,31 +1,952 @@
-from typing import Dict, List, Optional, Tuple
-from api.models import EnvironmentalReading
-from datetime import datetime
+from api.models import (
+    EnvironmentalReading,
+    WeatherReading,
+    PollutantReading,
+    ReadingColumns,
+    WEATHER_FIELDS,
+    POLLUTANT_FIELDS,
+    DEFAULT_LOCATION
+)
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+from api.aggregation import RollupIndex, RangeStatsIndex, MEASUREMENT_FIELDS, epoch_seconds, reading_values
+from api.coverage import CoverageIndex, IntervalSet
+from api.concurrency import KeyedRWLocks
+from contextlib import contextmanager
+from array import array
+import threading
+import sqlite3
+import bisect
+import math
+import uuid
+import os
+
+_EPOCH = datetime(1970, 1, 1)
+_NAIVE_OFFSET = -(2 ** 31)
 
 
 class InMemoryRepository:
     def __init__(self):
-        self.readings: Dict[datetime, EnvironmentalReading] = {}
+        # versions count this instance's writes only, so entries in a cache other processes share are kept apart
+        self.cache_scope = uuid.uuid4().hex
+        # keyed by epoch seconds, so naive timestamps are ordered as UTC like the columnar and SQLite backends
+        # do, and a naive and an aware timestamp for the same instant are the same reading
+        self.readings: Dict[Tuple[str, float], EnvironmentalReading] = {}
+        # sorted copy of each location's keys, kept next to the dict so lookups can bisect instead of scanning
+        self._epochs: Dict[str, List[float]] = {}
+        # insertion order of each key, used to break ties the same way min() over the dict does
+        self._sequence: Dict[Tuple[str, float], int] = {}
+        self.coverage = CoverageIndex()
+        self.rollups = RollupIndex()
+        self.range_index = RangeStatsIndex()
+        # bumped on every write to a location so caches keyed by it go stale without explicit deletes
+        self._versions: Dict[str, int] = {}
+        self._modified: Dict[str, datetime] = {}
+        # every method touches a single location, so each location gets its own readers-writer lock
+        self._locks = KeyedRWLocks()
+
+    def save_reading(self, reading: EnvironmentalReading, location: str = DEFAULT_LOCATION) -> None:
+        with self._locks.write(location):
+            rows = []
+            self._save_reading(reading, location, rows)
+            self.rollups.add_many(location, rows)
+            self.range_index.append(location, *rows[0])
+            self._bump_version(location)
+
+    def save_columns(self, columns: ReadingColumns, location: str = DEFAULT_LOCATION) -> None:
+        self.save_readings(columns.to_readings(), location)
+
+    def save_readings(self, readings: Iterable[EnvironmentalReading], location: str = DEFAULT_LOCATION) -> None:
+        with self._locks.write(location):
+            rows: List[Tuple[float, Tuple[Optional[float], ...]]] = []
+            for reading in readings:
+                self._save_reading(reading, location, rows)
+            self.rollups.add_many(location, rows)
+            self.range_index.invalidate(location)
+            self._bump_version(location)
+
+    def _save_reading(self, reading: EnvironmentalReading, location: str,
+                      pending: List[Tuple[float, Tuple[Optional[float], ...]]]) -> None:
+        # the rollup rows are queued in `pending` and added in one batch by the caller
+        epoch = epoch_seconds(reading.timestamp)
+        key = (location, epoch)
+        previous = self.readings.get(key)
+
+        if previous is None:
+            epochs = self._epochs.setdefault(location, [])
+            if not epochs or epoch > epochs[-1]:
+                epochs.append(epoch)
+            else:
+                bisect.insort(epochs, epoch)
+            self._sequence[key] = len(self._sequence)
+        else:
+            # the reading being replaced may still be queued, so the queue is flushed before it is taken out
+            self.rollups.add_many(location, pending)
+            pending.clear()
+            self.rollups.remove(location, epoch, reading_values(previous))
+
+        self.readings[key] = reading
+        pending.append((epoch, reading_values(reading)))
+
+    def _bump_version(self, location: str) -> None:
+        self._versions[location] = self._versions.get(location, 0) + 1
+        self._modified[location] = datetime.now(timezone.utc)
+
+    def get_locations(self) -> List[str]:
+        return list(self._epochs)
+
+    def get_version(self, location: str = DEFAULT_LOCATION) -> int:
+        return self._versions.get(location, 0)
+
+    def get_last_modified(self, location: str = DEFAULT_LOCATION) -> Optional[datetime]:
+        return self._modified.get(location)
+
+    def get_reading_closest_to_timestamp(
+            self,
+            timestamp: datetime,
+            location: str = DEFAULT_LOCATION
+    ) -> Optional[EnvironmentalReading]:
+        with self._locks.read(location) as known:
+            if not known:
+                return None
+            epochs = self._epochs.get(location)
+            if not epochs:
+                return None
+
+            target = epoch_seconds(timestamp)
+            index = bisect.bisect_left(epochs, target)
+            candidates = epochs[max(index - 1, 0):index + 1]
+
+            closest_epoch = min(candidates, key=lambda x: (abs(x - target), self._sequence[(location, x)]))
+
+            return self.readings[(location, closest_epoch)]
+
+    def get_all_readings(self, location: str = DEFAULT_LOCATION) -> List[EnvironmentalReading]:
+        with self._locks.read(location) as known:
+            if not known:
+                return []
+            # walking the location's own index in save order avoids iterating the dict other locations write to
+            epochs = sorted(self._epochs.get(location, []), key=lambda epoch: self._sequence[(location, epoch)])
+            return [self.readings[(location, epoch)] for epoch in epochs]
+
+    def get_paginated_readings(
+            self,
+            page: int = 1,
+            per_page: int = 10,
+            location: str = DEFAULT_LOCATION
+    ) -> Tuple[List[EnvironmentalReading], int]:
+        with self._locks.read(location) as known:
+            if not known:
+                return [], 0
+            epochs = self._epochs.get(location, [])
+            total = len(epochs)
+
+            start_idx = (page - 1) * per_page
+            end_idx = start_idx + per_page
+
+            # the index is ascending while pages are newest-first, so page offsets count from the end
+            page_epochs = epochs[max(total - end_idx, 0):max(total - start_idx, 0)]
+
+            return [self.readings[(location, epoch)] for epoch in reversed(page_epochs)], total
+
+    def get_readings_before(
+            self,
+            before: datetime,
+            limit: int = 10,
+            location: str = DEFAULT_LOCATION
+    ) -> List[EnvironmentalReading]:
+        with self._locks.read(location) as known:
+            if not known:
+                return []
+            epochs = self._epochs.get(location, [])
+            end_idx = bisect.bisect_left(epochs, epoch_seconds(before))
+            page_epochs = epochs[max(end_idx - limit, 0):end_idx]
+
+            return [self.readings[(location, epoch)] for epoch in reversed(page_epochs)]
+
+    def get_readings_in_range(
+            self,
+            start: datetime,
+            end: datetime,
+            location: str = DEFAULT_LOCATION,
+            limit: Optional[int] = None
+    ) -> List[EnvironmentalReading]:
+        with self._locks.read(location) as known:
+            if not known:
+                return []
+            epochs = self._epochs.get(location, [])
+            start_idx = bisect.bisect_left(epochs, epoch_seconds(start))
+            end_idx = bisect.bisect_left(epochs, epoch_seconds(end))
+            if limit is not None:
+                end_idx = min(end_idx, start_idx + limit)
+
+            return [self.readings[(location, epoch)] for epoch in epochs[start_idx:end_idx]]
+
+    def get_daily_rollups(
+            self,
+            start: datetime,
+            end: datetime,
+            bucket_days: int = 1,
+            location: str = DEFAULT_LOCATION,
+            fields: Sequence[str] = MEASUREMENT_FIELDS,
+            percentiles: Sequence[float] = ()
+    ) -> List[Dict[str, Any]]:
+        with self._locks.read(location) as known:
+            if not known:
+                return []
+            return self.rollups.aggregate(
+                location, start, end, bucket_days, lambda lo, hi: self._rows(location, lo, hi), fields, percentiles
+            )
+
+    def get_range_stats(
+            self,
+            start: datetime,
+            end: datetime,
+            location: str = DEFAULT_LOCATION,
+            fields: Sequence[str] = MEASUREMENT_FIELDS
+    ) -> Dict[str, Dict[str, float]]:
+        with self._locks.read(location) as known:
+            if not known:
+                return {}
+            return self.range_index.stats(location, start, end, fields, lambda: (
+                (epoch, reading_values(self.readings[(location, epoch)])) for epoch in self._epochs.get(location, [])
+            ))
+
+    def mark_covered(self, start: date, end: date, location: str = DEFAULT_LOCATION) -> None:
+        with self._locks.write(location):
+            self.coverage.mark_covered(start, end, location)
+
+    def get_missing_ranges(self, start: date, end: date, location: str = DEFAULT_LOCATION) -> List[Tuple[date, date]]:
+        with self._locks.read(location) as known:
+            if not known:
+                return [(start, end)] if start <= end else []
+            return self.coverage.get_missing_ranges(start, end, location)
+
+    def _rows(self, location: str, lo: float, hi: float) -> Iterable[Tuple[float, Tuple[Optional[float], ...]]]:
+        epochs = self._epochs.get(location, [])
+        return (
+            (epoch, reading_values(self.readings[(location, epoch)]))
+            for epoch in epochs[bisect.bisect_left(epochs, lo):bisect.bisect_left(epochs, hi)]
+        )
+
+
+# one location's readings: a contiguous float64 column plus null mask per field, rows ordered by an int64
+# epoch-second index; naive timestamps are ordered as UTC and come back naive, sub-second precision is not kept
+class ColumnSeries:
+    def __init__(self, location: str = DEFAULT_LOCATION, rollups: Optional[RollupIndex] = None):
+        self.location = location
+        self.rollups = rollups if rollups is not None else RollupIndex()
+        self._epochs = array('q')
+        self._offsets = array('i')
+        self._sequence = array('q')
+        self._has_weather = bytearray()
+        self._has_pollutants = bytearray()
+        self._values: Dict[str, array] = {name: array('d') for name in WEATHER_FIELDS + POLLUTANT_FIELDS}
+        self._masks: Dict[str, bytearray] = {name: bytearray() for name in WEATHER_FIELDS + POLLUTANT_FIELDS}
+        self._inserted = 0
+
+    def __len__(self) -> int:
+        return len(self._epochs)
 
     def save_reading(self, reading: EnvironmentalReading) -> None:
-        self.readings[reading.timestamp] = reading
+        epoch, offset = self._to_epoch(reading.timestamp)
+        row = bisect.bisect_left(self._epochs, epoch)
+
+        if row < len(self._epochs) and self._epochs[row] == epoch:
+            self.rollups.remove(self.location, epoch, self._row_values(row, MEASUREMENT_FIELDS).values())
+            self._offsets[row] = offset
+        else:
+            self._insert_row(row, epoch, offset)
+
+        self._has_weather[row] = reading.weather is not None
+        self._has_pollutants[row] = reading.pollutants is not None
+
+        for names, part in ((WEATHER_FIELDS, reading.weather), (POLLUTANT_FIELDS, reading.pollutants)):
+            for name in names:
+                value = getattr(part, name) if part is not None else None
+                self._values[name][row] = value if value is not None else 0.0
+                self._masks[name][row] = value is not None
+
+        self.rollups.add(self.location, epoch, reading_values(reading))
+
+    def save_columns(self, columns: ReadingColumns) -> None:
+        converted = [self._to_epoch(timestamp) for timestamp in columns.timestamps]
+        epochs = [epoch for epoch, _ in converted]
+
+        # a batch that is strictly ascending and newer than everything stored is appended column by column
+        appendable = all(a < b for a, b in zip(epochs, epochs[1:])) and (
+            not self._epochs or not epochs or epochs[0] > self._epochs[-1]
+        )
+        if not appendable:
+            for reading in columns.iter_readings():
+                self.save_reading(reading)
+            return
+
+        size = len(epochs)
+        self._epochs.extend(epochs)
+        self._offsets.extend(offset for _, offset in converted)
+        self._sequence.extend(range(self._inserted, self._inserted + size))
+        self._inserted += size
+
+        appended = []
+        for names, part, flags in (
+            (WEATHER_FIELDS, columns.weather, self._has_weather),
+            (POLLUTANT_FIELDS, columns.pollutants, self._has_pollutants)
+        ):
+            flags.extend(bytes([part is not None]) * size)
+            for name in names:
+                column = part[name] if part is not None else [None] * size
+                self._values[name].extend(0.0 if value is None else value for value in column)
+                self._masks[name].extend(value is not None for value in column)
+                appended.append(column)
+
+        self.rollups.add_many(self.location, zip(epochs, zip(*appended)))
 
     def get_reading_closest_to_timestamp(self, timestamp: datetime) -> Optional[EnvironmentalReading]:
-        if not self.readings:
+        if not self._epochs:
             return None
 
-        closest_timestamp = min(self.readings.keys(), key=lambda x: abs((x - timestamp).total_seconds()))
+        target = self._to_exact_epoch(timestamp)
+        row = bisect.bisect_left(self._epochs, target)
+        candidates = range(max(row - 1, 0), min(row + 1, len(self._epochs)))
 
-        return self.readings[closest_timestamp]
+        closest_row = min(candidates, key=lambda r: (abs(self._epochs[r] - target), self._sequence[r]))
+
+        return self._materialise(closest_row)
 
     def get_all_readings(self) -> List[EnvironmentalReading]:
-        return list(self.readings.values())
+        return [self._materialise(row) for row in range(len(self._epochs))]
 
     def get_paginated_readings(self, page: int = 1, per_page: int = 10) -> Tuple[List[EnvironmentalReading], int]:
-        all_readings = sorted(self.readings.values(), key=lambda r: r.timestamp, reverse=True)
-        total = len(all_readings)
+        total = len(self._epochs)
 
         start_idx = (page - 1) * per_page
         end_idx = start_idx + per_page
 
-        return all_readings[start_idx:end_idx], total
\ No newline at end of file
+        rows = range(max(total - start_idx, 0) - 1, max(total - end_idx, 0) - 1, -1)
+
+        return [self._materialise(row) for row in rows], total
+
+    def get_readings_before(self, before: datetime, limit: int = 10) -> List[EnvironmentalReading]:
+        end_row = bisect.bisect_left(self._epochs, self._to_exact_epoch(before))
+        rows = range(end_row - 1, max(end_row - limit, 0) - 1, -1)
+
+        return [self._materialise(row) for row in rows]
+
+    def get_readings_in_range(
+            self,
+            start: datetime,
+            end: datetime,
+            limit: Optional[int] = None
+    ) -> List[EnvironmentalReading]:
+        start_row = bisect.bisect_left(self._epochs, self._to_exact_epoch(start))
+        end_row = bisect.bisect_left(self._epochs, self._to_exact_epoch(end))
+        if limit is not None:
+            end_row = min(end_row, start_row + limit)
+
+        return [self._materialise(row) for row in range(start_row, end_row)]
+
+    def iter_rows(self, lo: Optional[float] = None, hi: Optional[float] = None
+                  ) -> Iterable[Tuple[int, Tuple[Optional[float], ...]]]:
+        first = bisect.bisect_left(self._epochs, lo) if lo is not None else 0
+        last = bisect.bisect_left(self._epochs, hi) if hi is not None else len(self._epochs)
+        columns = [
+            [
+                value if present else None
+                for value, present in zip(self._values[name][first:last], self._masks[name][first:last])
+            ]
+            for name in MEASUREMENT_FIELDS
+        ]
+        return zip(self._epochs[first:last], zip(*columns))
+
+    def _insert_row(self, row: int, epoch: int, offset: int) -> None:
+        if row == len(self._epochs):
+            self._epochs.append(epoch)
+            self._offsets.append(offset)
+            self._sequence.append(self._inserted)
+            self._has_weather.append(0)
+            self._has_pollutants.append(0)
+            for name in self._values:
+                self._values[name].append(0.0)
+                self._masks[name].append(0)
+        else:
+            self._epochs.insert(row, epoch)
+            self._offsets.insert(row, offset)
+            self._sequence.insert(row, self._inserted)
+            self._has_weather.insert(row, 0)
+            self._has_pollutants.insert(row, 0)
+            for name in self._values:
+                self._values[name].insert(row, 0.0)
+                self._masks[name].insert(row, 0)
+
+        self._inserted += 1
+
+    def _materialise(self, row: int) -> EnvironmentalReading:
+        timestamp = self._from_epoch(self._epochs[row], self._offsets[row])
+
+        weather = None
+        if self._has_weather[row]:
+            weather = WeatherReading(timestamp=timestamp, **self._row_values(row, WEATHER_FIELDS))
+
+        pollutants = None
+        if self._has_pollutants[row]:
+            pollutants = PollutantReading(timestamp=timestamp, **self._row_values(row, POLLUTANT_FIELDS))
+
+        return EnvironmentalReading(timestamp=timestamp, weather=weather, pollutants=pollutants)
+
+    def _row_values(self, row: int, names: Tuple[str, ...]) -> Dict[str, Optional[float]]:
+        return {name: self._values[name][row] if self._masks[name][row] else None for name in names}
+
+    @staticmethod
+    def _to_epoch(timestamp: datetime) -> Tuple[int, int]:
+        offset = timestamp.utcoffset()
+        if offset is None:
+            return (timestamp - _EPOCH) // timedelta(seconds=1), _NAIVE_OFFSET
+
+        utc = timestamp.replace(tzinfo=None) - offset
+        return (utc - _EPOCH) // timedelta(seconds=1), offset // timedelta(seconds=1)
+
+    @staticmethod
+    def _to_exact_epoch(timestamp: datetime) -> float:
+        offset = timestamp.utcoffset() or timedelta(0)
+        return (timestamp.replace(tzinfo=None) - offset - _EPOCH).total_seconds()
+
+    @staticmethod
+    def _from_epoch(epoch: int, offset: int) -> datetime:
+        timestamp = _EPOCH + timedelta(seconds=epoch)
+        if offset == _NAIVE_OFFSET:
+            return timestamp
+
+        tz = timezone(timedelta(seconds=offset))
+        return (timestamp + timedelta(seconds=offset)).replace(tzinfo=tz)
+
+
+class ColumnarRepository:
+    def __init__(self):
+        self.cache_scope = uuid.uuid4().hex
+        self._series: Dict[str, ColumnSeries] = {}
+        self.coverage = CoverageIndex()
+        self.rollups = RollupIndex()
+        self.range_index = RangeStatsIndex()
+        self._versions: Dict[str, int] = {}
+        self._modified: Dict[str, datetime] = {}
+        self._locks = KeyedRWLocks()
+
+    def __len__(self) -> int:
+        return sum(len(series) for series in list(self._series.values()))
+
+    def save_reading(self, reading: EnvironmentalReading, location: str = DEFAULT_LOCATION) -> None:
+        with self._locks.write(location):
+            self._series_for(location).save_reading(reading)
+            self.range_index.append(location, ColumnSeries._to_epoch(reading.timestamp)[0], reading_values(reading))
+            self._bump_version(location)
+
+    def save_columns(self, columns: ReadingColumns, location: str = DEFAULT_LOCATION) -> None:
+        with self._locks.write(location):
+            self._series_for(location).save_columns(columns)
+            self.range_index.invalidate(location)
+            self._bump_version(location)
+
+    def save_readings(self, readings: Iterable[EnvironmentalReading], location: str = DEFAULT_LOCATION) -> None:
+        with self._locks.write(location):
+            series = self._series_for(location)
+            for reading in readings:
+                series.save_reading(reading)
+            self.range_index.invalidate(location)
+            self._bump_version(location)
+
+    def get_locations(self) -> List[str]:
+        return list(self._series)
+
+    def get_version(self, location: str = DEFAULT_LOCATION) -> int:
+        return self._versions.get(location, 0)
+
+    def get_last_modified(self, location: str = DEFAULT_LOCATION) -> Optional[datetime]:
+        return self._modified.get(location)
+
+    def get_reading_closest_to_timestamp(
+            self,
+            timestamp: datetime,
+            location: str = DEFAULT_LOCATION
+    ) -> Optional[EnvironmentalReading]:
+        with self._locks.read(location) as known:
+            if not known:
+                return None
+            series = self._series.get(location)
+            return series.get_reading_closest_to_timestamp(timestamp) if series is not None else None
+
+    def get_all_readings(self, location: str = DEFAULT_LOCATION) -> List[EnvironmentalReading]:
+        with self._locks.read(location) as known:
+            if not known:
+                return []
+            series = self._series.get(location)
+            return series.get_all_readings() if series is not None else []
+
+    def get_paginated_readings(
+            self,
+            page: int = 1,
+            per_page: int = 10,
+            location: str = DEFAULT_LOCATION
+    ) -> Tuple[List[EnvironmentalReading], int]:
+        with self._locks.read(location) as known:
+            if not known:
+                return [], 0
+            series = self._series.get(location)
+            return series.get_paginated_readings(page, per_page) if series is not None else ([], 0)
+
+    def get_readings_before(
+            self,
+            before: datetime,
+            limit: int = 10,
+            location: str = DEFAULT_LOCATION
+    ) -> List[EnvironmentalReading]:
+        with self._locks.read(location) as known:
+            if not known:
+                return []
+            series = self._series.get(location)
+            return series.get_readings_before(before, limit) if series is not None else []
+
+    def get_readings_in_range(
+            self,
+            start: datetime,
+            end: datetime,
+            location: str = DEFAULT_LOCATION,
+            limit: Optional[int] = None
+    ) -> List[EnvironmentalReading]:
+        with self._locks.read(location) as known:
+            if not known:
+                return []
+            series = self._series.get(location)
+            return series.get_readings_in_range(start, end, limit) if series is not None else []
+
+    def get_daily_rollups(
+            self,
+            start: datetime,
+            end: datetime,
+            bucket_days: int = 1,
+            location: str = DEFAULT_LOCATION,
+            fields: Sequence[str] = MEASUREMENT_FIELDS,
+            percentiles: Sequence[float] = ()
+    ) -> List[Dict[str, Any]]:
+        with self._locks.read(location) as known:
+            if not known:
+                return []
+            series = self._series.get(location)
+            if series is None:
+                return []
+            return self.rollups.aggregate(location, start, end, bucket_days, series.iter_rows, fields, percentiles)
+
+    def get_range_stats(
+            self,
+            start: datetime,
+            end: datetime,
+            location: str = DEFAULT_LOCATION,
+            fields: Sequence[str] = MEASUREMENT_FIELDS
+    ) -> Dict[str, Dict[str, float]]:
+        with self._locks.read(location) as known:
+            if not known:
+                return {}
+            series = self._series.get(location)
+            if series is None:
+                return {}
+            return self.range_index.stats(location, start, end, fields, series.iter_rows)
+
+    def mark_covered(self, start: date, end: date, location: str = DEFAULT_LOCATION) -> None:
+        with self._locks.write(location):
+            self.coverage.mark_covered(start, end, location)
+
+    def get_missing_ranges(self, start: date, end: date, location: str = DEFAULT_LOCATION) -> List[Tuple[date, date]]:
+        with self._locks.read(location) as known:
+            if not known:
+                return [(start, end)] if start <= end else []
+            return self.coverage.get_missing_ranges(start, end, location)
+
+    def _bump_version(self, location: str) -> None:
+        self._versions[location] = self._versions.get(location, 0) + 1
+        self._modified[location] = datetime.now(timezone.utc)
+
+    def _series_for(self, location: str) -> ColumnSeries:
+        series = self._series.get(location)
+        if series is None:
+            series = self._series.setdefault(location, ColumnSeries(location, self.rollups))
+        return series
+
+
+_MEASUREMENT_COLUMNS = MEASUREMENT_FIELDS
+_READING_COLUMNS = "epoch_us, utc_offset, sequence, has_weather, has_pollutants, " + ", ".join(_MEASUREMENT_COLUMNS)
+
+_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS readings (
+    location TEXT NOT NULL,
+    epoch_us INTEGER NOT NULL,
+    utc_offset INTEGER,
+    sequence INTEGER NOT NULL,
+    has_weather INTEGER NOT NULL,
+    has_pollutants INTEGER NOT NULL,
+    {", ".join(f"{name} REAL" for name in _MEASUREMENT_COLUMNS)},
+    PRIMARY KEY (location, epoch_us)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS coverage (
+    location TEXT NOT NULL,
+    first_day INTEGER NOT NULL,
+    end_day INTEGER NOT NULL,
+    PRIMARY KEY (location, first_day)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS versions (
+    location TEXT PRIMARY KEY,
+    version INTEGER NOT NULL,
+    modified_us INTEGER
+) WITHOUT ROWID;
+"""
+
+_UPSERT = f"""
+INSERT INTO readings (location, {_READING_COLUMNS})
+VALUES (?, ?, ?, ?, ?, ?, {", ".join("?" for _ in _MEASUREMENT_COLUMNS)})
+ON CONFLICT (location, epoch_us) DO UPDATE SET
+    utc_offset = excluded.utc_offset,
+    has_weather = excluded.has_weather,
+    has_pollutants = excluded.has_pollutants,
+    {", ".join(f"{name} = excluded.{name}" for name in _MEASUREMENT_COLUMNS)}
+"""
+
+
+# readings survive restarts in a WAL-mode SQLite file; the (location, epoch_us) primary key is the time index
+# and every query is a range scan on it. Timestamps are stored as UTC microseconds plus the original offset,
+# naive ones are ordered as UTC and come back naive, like ColumnarRepository but without losing sub-seconds
+class SQLiteRepository:
+    def __init__(self, path: str):
+        self.path = path
+        # versions live in the file, so every process opening it can share cache entries
+        self.cache_scope = f"sqlite:{os.path.abspath(path)}"
+        self._local = threading.local()
+        self._sequence_lock = threading.Lock()
+        # the in-memory indexes are built from the file the first time a location is queried, then kept in step
+        # with this process's writes; a version written by another process makes the next query rebuild them
+        self.rollups = RollupIndex()
+        self.range_index = RangeStatsIndex()
+        self._rollup_versions: Dict[str, int] = {}
+        self._range_versions: Dict[str, int] = {}
+        # guards a location's index state only; database writes are committed before it is taken
+        self._index_locks = KeyedRWLocks()
+
+        connection = self._connection()
+        connection.executescript(_SCHEMA)
+        # files created before write times were recorded get the column added in place
+        if "modified_us" not in [row[1] for row in connection.execute("PRAGMA table_info(versions)")]:
+            connection.execute("ALTER TABLE versions ADD COLUMN modified_us INTEGER")
+        self._next_sequence = connection.execute("SELECT COALESCE(MAX(sequence), -1) + 1 FROM readings").fetchone()[0]
+
+    def __len__(self) -> int:
+        return self._connection().execute("SELECT COUNT(*) FROM readings").fetchone()[0]
+
+    def close(self) -> None:
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def save_reading(self, reading: EnvironmentalReading, location: str = DEFAULT_LOCATION) -> None:
+        self.save_readings([reading], location)
+
+    def save_readings(self, readings: Iterable[EnvironmentalReading], location: str = DEFAULT_LOCATION) -> None:
+        rows = []
+        for reading in readings:
+            weather, pollutants = reading.weather, reading.pollutants
+            rows.append(self._row(
+                location, reading.timestamp, weather is not None, pollutants is not None,
+                [getattr(weather, name) if weather is not None else None for name in WEATHER_FIELDS]
+                + [getattr(pollutants, name) if pollutants is not None else None for name in POLLUTANT_FIELDS]
+            ))
+        self._write(rows, location)
+
+    def save_columns(self, columns: ReadingColumns, location: str = DEFAULT_LOCATION) -> None:
+        empty = [None] * len(columns)
+        weather = [columns.weather[name] if columns.weather is not None else empty for name in WEATHER_FIELDS]
+        pollutants = [
+            columns.pollutants[name] if columns.pollutants is not None else empty for name in POLLUTANT_FIELDS
+        ]
+
+        # rows are zipped straight from the columns, no reading objects are built on the way in
+        rows = [
+            self._row(location, timestamp, columns.weather is not None, columns.pollutants is not None, list(values))
+            for timestamp, *values in zip(columns.timestamps, *weather, *pollutants)
+        ]
+        self._write(rows, location)
+
+    def get_locations(self) -> List[str]:
+        return [row[0] for row in self._connection().execute("SELECT DISTINCT location FROM readings")]
+
+    def get_version(self, location: str = DEFAULT_LOCATION) -> int:
+        row = self._connection().execute("SELECT version FROM versions WHERE location = ?", (location,)).fetchone()
+        return row[0] if row is not None else 0
+
+    def get_last_modified(self, location: str = DEFAULT_LOCATION) -> Optional[datetime]:
+        row = self._connection().execute(
+            "SELECT modified_us FROM versions WHERE location = ?", (location,)
+        ).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return (_EPOCH + timedelta(microseconds=row[0])).replace(tzinfo=timezone.utc)
+
+    def get_reading_closest_to_timestamp(
+            self,
+            timestamp: datetime,
+            location: str = DEFAULT_LOCATION
+    ) -> Optional[EnvironmentalReading]:
+        target, _ = self._to_epoch_us(timestamp)
+
+        # one index seek on each side of the target; ties go to the reading saved first, as in the other backends
+        rows = self._connection().execute(f"""
+            SELECT * FROM (SELECT {_READING_COLUMNS} FROM readings
+                           WHERE location = ? AND epoch_us <= ? ORDER BY epoch_us DESC LIMIT 1)
+            UNION ALL
+            SELECT * FROM (SELECT {_READING_COLUMNS} FROM readings
+                           WHERE location = ? AND epoch_us > ? ORDER BY epoch_us ASC LIMIT 1)
+        """, (location, target, location, target)).fetchall()
+
+        if not rows:
+            return None
+
+        return self._materialise(min(rows, key=lambda row: (abs(row[0] - target), row[2])))
+
+    def get_all_readings(self, location: str = DEFAULT_LOCATION) -> List[EnvironmentalReading]:
+        return self._query(f"SELECT {_READING_COLUMNS} FROM readings WHERE location = ? ORDER BY sequence", (location,))
+
+    def get_paginated_readings(
+            self,
+            page: int = 1,
+            per_page: int = 10,
+            location: str = DEFAULT_LOCATION
+    ) -> Tuple[List[EnvironmentalReading], int]:
+        connection = self._connection()
+        # the count and the page come from one read snapshot, so a concurrent write cannot land between them
+        connection.execute("BEGIN")
+        try:
+            total = connection.execute("SELECT COUNT(*) FROM readings WHERE location = ?", (location,)).fetchone()[0]
+            readings = self._query(
+                f"SELECT {_READING_COLUMNS} FROM readings WHERE location = ? ORDER BY epoch_us DESC LIMIT ? OFFSET ?",
+                (location, per_page, (page - 1) * per_page)
+            )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return readings, total
+
+    def get_readings_before(
+            self,
+            before: datetime,
+            limit: int = 10,
+            location: str = DEFAULT_LOCATION
+    ) -> List[EnvironmentalReading]:
+        return self._query(
+            f"SELECT {_READING_COLUMNS} FROM readings WHERE location = ? AND epoch_us < ? ORDER BY epoch_us DESC LIMIT ?",
+            (location, self._to_epoch_us(before)[0], limit)
+        )
+
+    def get_readings_in_range(
+            self,
+            start: datetime,
+            end: datetime,
+            location: str = DEFAULT_LOCATION,
+            limit: Optional[int] = None
+    ) -> List[EnvironmentalReading]:
+        return self._query(
+            f"SELECT {_READING_COLUMNS} FROM readings WHERE location = ? AND epoch_us >= ? AND epoch_us < ? "
+            "ORDER BY epoch_us LIMIT ?",
+            (location, self._to_epoch_us(start)[0], self._to_epoch_us(end)[0], -1 if limit is None else limit)
+        )
+
+    def get_daily_rollups(
+            self,
+            start: datetime,
+            end: datetime,
+            bucket_days: int = 1,
+            location: str = DEFAULT_LOCATION,
+            fields: Sequence[str] = MEASUREMENT_FIELDS,
+            percentiles: Sequence[float] = ()
+    ) -> List[Dict[str, Any]]:
+        # a location never written has no rows, and is turned away before a lock is made for it
+        if not self.get_version(location):
+            return []
+
+        with self._index_locks.write(location), self._snapshot():
+            version = self.get_version(location)
+            if self._rollup_versions.get(location) != version:
+                self.rollups.clear(location)
+                self.rollups.add_many(location, self._index_rows(location))
+                self._rollup_versions[location] = version
+            return self.rollups.aggregate(
+                location, start, end, bucket_days,
+                lambda lo, hi: self._index_rows(location, lo, hi), fields, percentiles
+            )
+
+    def get_range_stats(
+            self,
+            start: datetime,
+            end: datetime,
+            location: str = DEFAULT_LOCATION,
+            fields: Sequence[str] = MEASUREMENT_FIELDS
+    ) -> Dict[str, Dict[str, float]]:
+        if not self.get_version(location):
+            return {}
+
+        with self._index_locks.write(location), self._snapshot():
+            version = self.get_version(location)
+            if self._range_versions.get(location) != version:
+                self.range_index.invalidate(location)
+                self._range_versions[location] = version
+            return self.range_index.stats(location, start, end, fields, lambda: self._index_rows(location))
+
+    def mark_covered(self, start: date, end: date, location: str = DEFAULT_LOCATION) -> None:
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            days = self._coverage(connection, location)
+            days.add(start.toordinal(), end.toordinal() + 1)
+            connection.execute("DELETE FROM coverage WHERE location = ?", (location,))
+            connection.executemany(
+                "INSERT INTO coverage (location, first_day, end_day) VALUES (?, ?, ?)",
+                [(location, first_day, end_day) for first_day, end_day in days.intervals()]
+            )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def get_missing_ranges(self, start: date, end: date, location: str = DEFAULT_LOCATION) -> List[Tuple[date, date]]:
+        days = self._coverage(self._connection(), location)
+        return [
+            (date.fromordinal(gap_start), date.fromordinal(gap_end - 1))
+            for gap_start, gap_end in days.missing(start.toordinal(), end.toordinal() + 1)
+        ]
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections must not be shared between threads, so each thread opens its own
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _write(self, rows: List[tuple], location: str) -> None:
+        if not rows:
+            return
+
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            version = self.get_version(location)
+            # only a location whose rollups are loaded and current needs the rows about to be overwritten
+            tracked = self._rollup_versions.get(location) == version
+            previous = self._previous_values(connection, rows, location) if tracked else {}
+            connection.executemany(_UPSERT, rows)
+            connection.execute(
+                "INSERT INTO versions (location, version, modified_us) VALUES (?, 1, ?) "
+                "ON CONFLICT (location) DO UPDATE SET version = version + 1, modified_us = excluded.modified_us",
+                (location, self._to_epoch_us(datetime.now(timezone.utc))[0])
+            )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+        # the write is committed before the location's lock is taken, so it never waits on index queries. The
+        # indexes take the change only if they still stand at the version it was made on; otherwise they are
+        # left behind the database and the next query reloads them
+        with self._index_locks.write(location):
+            if tracked and self._rollup_versions.get(location) == version:
+                for row in rows:
+                    epoch_us, values = row[1], row[6:]
+                    if epoch_us in previous:
+                        self.rollups.remove(location, epoch_us / 1_000_000, previous[epoch_us])
+                    self.rollups.add(location, epoch_us / 1_000_000, values)
+                    previous[epoch_us] = values
+                self._rollup_versions[location] = version + 1
+
+            # a single new reading extends the range index in place; bulk loads leave it to be rebuilt lazily
+            if len(rows) == 1 and self._range_versions.get(location) == version:
+                self.range_index.append(location, rows[0][1] / 1_000_000, rows[0][6:])
+                self._range_versions[location] = version + 1
+
+    def _previous_values(self, connection: sqlite3.Connection, rows: List[tuple],
+                         location: str) -> Dict[int, tuple]:
+        # batches are usually contiguous, so one range scan over the batch's span is cheaper than a lookup per row
+        keys = {row[1] for row in rows}
+        return {
+            epoch_us: tuple(values)
+            for epoch_us, *values in connection.execute(
+                f"SELECT epoch_us, {', '.join(_MEASUREMENT_COLUMNS)} FROM readings "
+                "WHERE location = ? AND epoch_us >= ? AND epoch_us <= ?",
+                (location, min(keys), max(keys))
+            )
+            if epoch_us in keys
+        }
+
+    @contextmanager
+    def _snapshot(self) -> Iterator[None]:
+        # one read transaction, so an index and the version it is labelled with come from the same state of the file
+        connection = self._connection()
+        connection.execute("BEGIN")
+        try:
+            yield
+        finally:
+            connection.execute("COMMIT")
+
+    def _index_rows(self, location: str, lo: float = -math.inf,
+                    hi: float = math.inf) -> Iterable[Tuple[float, List[Optional[float]]]]:
+        return (
+            (epoch_us / 1_000_000, values)
+            for epoch_us, *values in self._connection().execute(
+                f"SELECT epoch_us, {', '.join(_MEASUREMENT_COLUMNS)} FROM readings "
+                "WHERE location = ? AND epoch_us >= ? AND epoch_us < ? ORDER BY epoch_us",
+                (location, lo * 1_000_000, hi * 1_000_000)
+            )
+        )
+
+    def _row(self, location: str, timestamp: datetime, has_weather: bool, has_pollutants: bool,
+             values: List[Optional[float]]) -> tuple:
+        epoch_us, offset = self._to_epoch_us(timestamp)
+        with self._sequence_lock:
+            sequence = self._next_sequence
+            self._next_sequence += 1
+        return (location, epoch_us, offset, sequence, has_weather, has_pollutants, *values)
+
+    def _query(self, sql: str, parameters: tuple) -> List[EnvironmentalReading]:
+        return [self._materialise(row) for row in self._connection().execute(sql, parameters)]
+
+    @staticmethod
+    def _coverage(connection: sqlite3.Connection, location: str) -> IntervalSet:
+        days = IntervalSet()
+        for first_day, end_day in connection.execute(
+                "SELECT first_day, end_day FROM coverage WHERE location = ? ORDER BY first_day", (location,)
+        ):
+            days.add(first_day, end_day)
+        return days
+
+    @staticmethod
+    def _materialise(row: tuple) -> EnvironmentalReading:
+        epoch_us, offset, _, has_weather, has_pollutants = row[:5]
+        timestamp = _EPOCH + timedelta(microseconds=epoch_us)
+        if offset is not None:
+            timestamp = (timestamp + timedelta(seconds=offset)).replace(tzinfo=timezone(timedelta(seconds=offset)))
+
+        values = row[5:]
+        weather_count = len(WEATHER_FIELDS)
+
+        return EnvironmentalReading(
+            timestamp=timestamp,
+            weather=WeatherReading(timestamp, *values[:weather_count]) if has_weather else None,
+            pollutants=PollutantReading(timestamp, *values[weather_count:]) if has_pollutants else None
+        )
+
+    @staticmethod
+    def _to_epoch_us(timestamp: datetime) -> Tuple[int, Optional[int]]:
+        offset = timestamp.utcoffset()
+        if offset is None:
+            return (timestamp - _EPOCH) // timedelta(microseconds=1), None
+
+        utc = timestamp.replace(tzinfo=None) - offset
+        return (utc - _EPOCH) // timedelta(microseconds=1), offset // timedelta(seconds=1)
@@ -0,0 +1,192 @@
+from api.models import canonical_location
+from api.services import AirQualityService
+from typing import Any, Dict, List, Optional
+from datetime import datetime, timedelta, timezone
+import threading
+import logging
+import random
+import time
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def parse_refresh_locations(value: str) -> List[str]:
+    # locations are 'latitude,longitude' themselves, so the list is separated with semicolons
+    locations = []
+    for item in value.split(";"):
+        item = item.strip()
+        if not item:
+            continue
+        location = canonical_location(item)
+        if location not in locations:
+            locations.append(location)
+    return locations
+
+
+def build_refresh_scheduler(service: AirQualityService) -> Optional["RefreshScheduler"]:
+    locations = parse_refresh_locations(os.getenv("REFRESH_LOCATIONS", ""))
+    if not locations:
+        return None
+
+    return RefreshScheduler(
+        service,
+        locations,
+        interval=float(os.getenv("REFRESH_INTERVAL", 900)),
+        lookback_hours=float(os.getenv("REFRESH_LOOKBACK_HOURS", 24)),
+        jitter=float(os.getenv("REFRESH_JITTER", 0.1)),
+        retry_delay=float(os.getenv("REFRESH_RETRY_DELAY", 30)),
+        max_backoff=float(os.getenv("REFRESH_MAX_BACKOFF", 3600))
+    )
+
+
+class _Job:
+    __slots__ = (
+        "location", "next_run", "runs", "failures", "consecutive_failures",
+        "last_attempt", "last_success", "last_error", "last_readings", "last_duration"
+    )
+
+    def __init__(self, location: str):
+        self.location = location
+        self.next_run = 0.0
+        self.runs = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.last_attempt: Optional[datetime] = None
+        self.last_success: Optional[datetime] = None
+        self.last_error: Optional[str] = None
+        self.last_readings: Optional[int] = None
+        self.last_duration: Optional[float] = None
+
+    def status(self, now: datetime, monotonic_now: float) -> Dict[str, Any]:
+        return {
+            "last_attempt": self.last_attempt.isoformat() if self.last_attempt is not None else None,
+            "last_success": self.last_success.isoformat() if self.last_success is not None else None,
+            "lag_seconds": (now - self.last_success).total_seconds() if self.last_success is not None else None,
+            "next_run_in": max(self.next_run - monotonic_now, 0.0),
+            "runs": self.runs,
+            "failures": self.failures,
+            "consecutive_failures": self.consecutive_failures,
+            "last_error": self.last_error,
+            "last_readings": self.last_readings,
+            "last_duration": self.last_duration
+        }
+
+
+class RefreshScheduler:
+    # one daemon thread re-fetches the last `lookback_hours` of every location with refresh=True, so requests
+    # for recent data are served from the repository instead of waiting on Open-Meteo. Runs are spread by
+    # +/- `jitter` of their delay, and a failing location backs off exponentially from `retry_delay`
+    def __init__(
+            self,
+            service: AirQualityService,
+            locations: List[str],
+            interval: float = 900.0,
+            lookback_hours: float = 24.0,
+            jitter: float = 0.1,
+            retry_delay: float = 30.0,
+            max_backoff: float = 3600.0
+    ):
+        self.service = service
+        self.interval = interval
+        self.lookback_hours = lookback_hours
+        self.jitter = jitter
+        self.retry_delay = retry_delay
+        self.max_backoff = max_backoff
+        self._jobs = {location: _Job(location) for location in locations}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._random = random.Random()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        if self.running:
+            return
+
+        self._stop.clear()
+        # the first runs are staggered too, so several locations (or workers) do not hit upstream together
+        now = time.monotonic()
+        with self._lock:
+            for job in self._jobs.values():
+                job.next_run = now + self._random.uniform(0, self.jitter * self.interval)
+
+        self._thread = threading.Thread(target=self._run, name="refresh-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def refresh(self, location: str) -> bool:
+        job = self._jobs[location]
+        now = datetime.now(timezone.utc)
+        started = time.monotonic()
+
+        # the API answers in the location's local time, which can already be tomorrow, so the window runs a day on
+        end = now.replace(tzinfo=None) + timedelta(days=1)
+        start = now.replace(tzinfo=None) - timedelta(hours=self.lookback_hours)
+
+        with self._lock:
+            job.last_attempt = now
+
+        try:
+            readings = self.service.fetch_and_store_air_quality_data(start, end, location, refresh=True)
+        except Exception as error:
+            logger.warning(f"Refreshing {location} failed: {error}")
+            with self._lock:
+                job.failures += 1
+                job.consecutive_failures += 1
+                job.last_error = f"{type(error).__name__}: {error}"
+                backoff = min(self.retry_delay * 2 ** (job.consecutive_failures - 1), self.max_backoff)
+                job.next_run = time.monotonic() + self._jittered(backoff)
+            return False
+
+        # fresh until shortly after the next run is due, so a late run does not open a window of upstream fetches
+        self.service.mark_refreshed(start.date(), end.date(), location, self.interval * (1 + 2 * self.jitter))
+
+        with self._lock:
+            job.runs += 1
+            job.consecutive_failures = 0
+            job.last_success = now
+            job.last_error = None
+            job.last_readings = len(readings)
+            job.last_duration = time.monotonic() - started
+            job.next_run = time.monotonic() + self._jittered(self.interval)
+        return True
+
+    def status(self) -> Dict[str, Any]:
+        now = datetime.now(timezone.utc)
+        monotonic_now = time.monotonic()
+
+        with self._lock:
+            locations = {location: job.status(now, monotonic_now) for location, job in self._jobs.items()}
+
+        lags = [status["lag_seconds"] for status in locations.values()]
+        return {
+            "running": self.running,
+            "interval": self.interval,
+            "lookback_hours": self.lookback_hours,
+            # a location that never refreshed has no lag yet, so it shows up as null rather than zero
+            "max_lag_seconds": None if None in lags else max(lags, default=None),
+            "locations": locations
+        }
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            with self._lock:
+                job = min(self._jobs.values(), key=lambda candidate: candidate.next_run)
+                delay = job.next_run - time.monotonic()
+
+            if delay > 0:
+                self._stop.wait(delay)
+                continue
+
+            self.refresh(job.location)
+
+    def _jittered(self, delay: float) -> float:
+        return delay * (1 + self._random.uniform(-self.jitter, self.jitter))
@@ -0,0 +1,116 @@
+from api.models import EnvironmentalReading, WeatherReading, PollutantReading, WEATHER_FIELDS, POLLUTANT_FIELDS
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from datetime import datetime
+import gzip
+import json
+import os
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is an optional speed-up
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - MessagePack responses are optional
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - brotli compression is optional
+    brotli = None
+
+JSON_MIMETYPE = 'application/json'
+MSGPACK_MIMETYPE = 'application/msgpack'
+
+GZIP_LEVEL = int(os.getenv("COMPRESS_GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("COMPRESS_BROTLI_QUALITY", "5"))
+
+
+# hand-unrolled equivalents of EnvironmentalReadingSchema().dump and its nested schemas;
+# tests/test_models.py checks they stay identical to marshmallow's output
+def _isoformat(value: Optional[datetime]) -> Optional[str]:
+    return value.isoformat() if value is not None else None
+
+
+def _float(value: Any) -> Optional[float]:
+    return float(value) if value is not None else None
+
+
+def dump_weather(weather: WeatherReading) -> Dict[str, Any]:
+    return {
+        "timestamp": _isoformat(weather.timestamp),
+        "temperature": _float(weather.temperature),
+        "precipitation": _float(weather.precipitation),
+        "pressure": _float(weather.pressure),
+        "wind_speed": _float(weather.wind_speed)
+    }
+
+
+def dump_pollutants(pollutants: PollutantReading) -> Dict[str, Any]:
+    return {
+        "timestamp": _isoformat(pollutants.timestamp),
+        "pm10": _float(pollutants.pm10),
+        "pm2_5": _float(pollutants.pm2_5),
+        "carbon_monoxide": _float(pollutants.carbon_monoxide),
+        "nitrogen_dioxide": _float(pollutants.nitrogen_dioxide),
+        "sulphur_dioxide": _float(pollutants.sulphur_dioxide),
+        "ozone": _float(pollutants.ozone)
+    }
+
+
+def dump_reading(reading: EnvironmentalReading) -> Dict[str, Any]:
+    weather = reading.weather
+    pollutants = reading.pollutants
+
+    return {
+        "timestamp": _isoformat(reading.timestamp),
+        "weather": dump_weather(weather) if weather is not None else None,
+        "pollutants": dump_pollutants(pollutants) if pollutants is not None else None
+    }
+
+
+def dumps(data: Any) -> bytes:
+    # compact and key-sorted like jsonify; orjson is used when installed
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_SORT_KEYS)
+    return json.dumps(data, sort_keys=True, separators=(",", ":")).encode()
+
+
+def dump_columns(readings: Iterable[EnvironmentalReading]) -> Dict[str, List[Any]]:
+    # one array per field instead of a nested object per reading; a missing weather or pollutants part shows
+    # up as nulls in its fields, and the nested timestamps are dropped because they repeat the reading's own
+    timestamps = []
+    columns: Dict[str, List[Any]] = {name: [] for name in WEATHER_FIELDS + POLLUTANT_FIELDS}
+    parts: Tuple[Tuple[str, Tuple[str, ...]], ...] = (("weather", WEATHER_FIELDS), ("pollutants", POLLUTANT_FIELDS))
+
+    for reading in readings:
+        timestamps.append(_isoformat(reading.timestamp))
+        for attribute, names in parts:
+            part = getattr(reading, attribute)
+            for name in names:
+                columns[name].append(_float(getattr(part, name)) if part is not None else None)
+
+    return {"timestamp": timestamps, **columns}
+
+
+def response_mimetypes() -> Tuple[str, ...]:
+    return (JSON_MIMETYPE, MSGPACK_MIMETYPE) if msgpack is not None else (JSON_MIMETYPE,)
+
+
+def encode(data: Any, mimetype: str = JSON_MIMETYPE) -> bytes:
+    if mimetype == MSGPACK_MIMETYPE:
+        return msgpack.packb(data)
+    return dumps(data) + b"\n"
+
+
+def content_encodings() -> Tuple[str, ...]:
+    # in order of preference when a client accepts several with the same weight
+    return ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    # a fixed mtime keeps the output identical for identical bodies
+    return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
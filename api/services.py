@@ -1,75 +1,412 @@
-from api.models import EnvironmentalReading, PollutantReading, WeatherReading
-from typing import Dict, List, Optional, Tuple
+from api.models import (
+    EnvironmentalReading,
+    ReadingColumns,
+    WEATHER_FIELDS,
+    POLLUTANT_FIELDS,
+    DEFAULT_LOCATION,
+    FIELD_BOUNDS,
+    parse_location
+)
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
 from api.repository import InMemoryRepository
-from api.client import AirQualityClient
-from datetime import datetime
+from api.aggregation import DAY, MEASUREMENT_FIELDS, aggregate_readings, bucket_range, bucket_start
+from api.client import AirQualityClient, AsyncAirQualityClient
+from api.concurrency import SingleFlight
+from api.coverage import RefreshIndex
+import asyncio
+import math
+from datetime import date, datetime, time, timedelta, timezone
+
+# days this close to today may still be revised upstream, so they are never treated as covered
+COVERAGE_SETTLE_DAYS = 2
+
+
+def _parse_api_timestamp(value: str) -> datetime:
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def _day_start(day: date) -> datetime:
+    return datetime.combine(day, time.min)
 
 
 class AirQualityService:
 
-    def __init__(self, repository: InMemoryRepository, client: AirQualityClient):
+    def __init__(self, repository: InMemoryRepository, client: AirQualityClient,
+                 refreshed: Optional[RefreshIndex] = None):
         self.repository = repository
         self.client = client
+        # services over the same repository must share this, or one would not see what the refresher keeps fresh
+        self.refreshed = refreshed if refreshed is not None else RefreshIndex()
+        # identical fetches running at the same time share one upstream call
+        self._flights = SingleFlight()
+
+    def fetch_and_store_air_quality_data(
+            self,
+            start_date: datetime,
+            end_date: datetime,
+            location: str = DEFAULT_LOCATION,
+            refresh: bool = False
+    ) -> List[EnvironmentalReading]:
+        return self._flights.do(
+            ("fetch", location, start_date, end_date, refresh),
+            lambda: self._fetch_and_store_range(start_date, end_date, location, refresh)
+        )
+
+    def stream_air_quality_data(
+            self,
+            start_date: datetime,
+            end_date: datetime,
+            location: str = DEFAULT_LOCATION,
+            refresh: bool = False
+    ) -> Iterator[EnvironmentalReading]:
+        # one client chunk at a time, so only a single window of readings is ever held in memory
+        day, last_day = start_date.date(), end_date.date()
+        while day <= last_day:
+            window_end = min(day + timedelta(days=self.client.chunk_days - 1), last_day)
+            yield from self.fetch_and_store_air_quality_data(_day_start(day), _day_start(window_end), location, refresh)
+            day = window_end + timedelta(days=1)
+
+    def _fetch_and_store_range(
+            self,
+            start_date: datetime,
+            end_date: datetime,
+            location: str,
+            refresh: bool
+    ) -> List[EnvironmentalReading]:
+        first_day, last_day = start_date.date(), end_date.date()
+        missing = self._missing_ranges(first_day, last_day, location, refresh)
+
+        # nothing stored for this range yet: fetch it in one go and return what upstream sent
+        if missing == [(first_day, last_day)]:
+            return self.fetch_and_store_air_quality_columns(start_date, end_date, location).to_readings()
+
+        for gap_start, gap_end in missing:
+            self.fetch_and_store_air_quality_columns(_day_start(gap_start), _day_start(gap_end), location)
+
+        return self._stored_range(first_day, last_day, location)
+
+    def fetch_and_store_air_quality_columns(
+            self,
+            start_date: datetime,
+            end_date: datetime,
+            location: str = DEFAULT_LOCATION
+    ) -> ReadingColumns:
+        if location != DEFAULT_LOCATION:
+            return self._fetch_and_store_locations(start_date, end_date, [location])[location]
 
-    def fetch_and_store_air_quality_data(self, start_date: datetime, end_date: datetime) -> List[EnvironmentalReading]:
         api_data = self.client.get_air_quality_data(start_date, end_date)
-        readings = self._transform_api_data(api_data)
+        columns = self._transform_api_columns(api_data)
 
-        for reading in readings:
-            self.repository.save_reading(reading)
+        self.repository.save_columns(columns, location)
+        self._mark_fetched(start_date.date(), end_date.date(), location)
 
-        return readings
+        return columns
 
-    def get_reading_closest_to_timestamp(self, timestamp: datetime) -> Optional[EnvironmentalReading]:
-        return self.repository.get_reading_closest_to_timestamp(timestamp)
+    def fetch_and_store_for_locations(
+            self,
+            start_date: datetime,
+            end_date: datetime,
+            locations: List[str],
+            refresh: bool = False
+    ) -> Dict[str, List[EnvironmentalReading]]:
+        return self._flights.do(
+            ("fetch_locations", tuple(locations), start_date, end_date, refresh),
+            lambda: self._fetch_and_store_for_locations(start_date, end_date, locations, refresh)
+        )
 
-    def save_reading(self, reading: EnvironmentalReading) -> None:
-        self.repository.save_reading(reading)
+    def _fetch_and_store_for_locations(
+            self,
+            start_date: datetime,
+            end_date: datetime,
+            locations: List[str],
+            refresh: bool
+    ) -> Dict[str, List[EnvironmentalReading]]:
+        first_day, last_day = start_date.date(), end_date.date()
 
-    def get_paginated_readings(self, page: int = 1, per_page: int = 10) -> Tuple[List[EnvironmentalReading], int]:
-        return self.repository.get_paginated_readings(page, per_page)
+        for missing, group in self._group_by_missing(first_day, last_day, locations, refresh).items():
+            for gap_start, gap_end in missing:
+                self._fetch_and_store_locations(_day_start(gap_start), _day_start(gap_end), group)
 
-    def _transform_api_data(self, api_data: Dict) -> List[EnvironmentalReading]:
-        readings = []
-
-        time_array = api_data.get("hourly", {}).get("time", [])
-        pm10_array = api_data.get("hourly", {}).get("pm10", [])
-        pm2_5_array = api_data.get("hourly", {}).get("pm2_5", [])
-        co_array = api_data.get("hourly", {}).get("carbon_monoxide", [])
-        no2_array = api_data.get("hourly", {}).get("nitrogen_dioxide", [])
-        so2_array = api_data.get("hourly", {}).get("sulphur_dioxide", [])
-        o3_array = api_data.get("hourly", {}).get("ozone", [])
-
-        for i in range(len(time_array)):
-            timestamp = datetime.fromisoformat(time_array[i].replace("Z", "+00:00"))
-
-            pollutant_reading = PollutantReading(
-                timestamp=timestamp,
-                pm10=pm10_array[i] if i < len(pm10_array) else None,
-                pm2_5=pm2_5_array[i] if i < len(pm2_5_array) else None,
-                carbon_monoxide=co_array[i] if i < len(co_array) else None,
-                nitrogen_dioxide=no2_array[i] if i < len(no2_array) else None,
-                sulphur_dioxide=so2_array[i] if i < len(so2_array) else None,
-                ozone=o3_array[i] if i < len(o3_array) else None
-            )
+        return {location: self._stored_range(first_day, last_day, location) for location in locations}
 
-            weather_reading = WeatherReading(
-                timestamp=timestamp,
-                temperature=None,
-                precipitation=None,
-                pressure=None,
-                wind_speed=None
-            )
+    def _fetch_and_store_locations(
+            self,
+            start_date: datetime,
+            end_date: datetime,
+            locations: List[str]
+    ) -> Dict[str, ReadingColumns]:
+        coordinates = [self._coordinates(location) for location in locations]
+        payloads = self.client.get_air_quality_data_for_locations(coordinates, start_date, end_date)
+
+        return self._store_location_payloads(start_date, end_date, locations, payloads)
+
+    def _coordinates(self, location: str) -> Tuple[float, float]:
+        if location == DEFAULT_LOCATION:
+            return self.client.latitude, self.client.longitude
+        return parse_location(location)
+
+    def get_data_version(self, location: str = DEFAULT_LOCATION) -> int:
+        return self.repository.get_version(location)
+
+    def get_cache_scope(self) -> str:
+        return self.repository.cache_scope
 
-            environmental_reading = EnvironmentalReading(
-                timestamp=timestamp,
-                weather=weather_reading,
-                pollutants=pollutant_reading
+    def get_last_modified(self, location: str = DEFAULT_LOCATION) -> Optional[datetime]:
+        return self.repository.get_last_modified(location)
+
+    def get_reading_closest_to_timestamp(
+            self,
+            timestamp: datetime,
+            location: str = DEFAULT_LOCATION
+    ) -> Optional[EnvironmentalReading]:
+        return self.repository.get_reading_closest_to_timestamp(timestamp, location)
+
+    def save_reading(self, reading: EnvironmentalReading, location: str = DEFAULT_LOCATION) -> None:
+        self.repository.save_reading(reading, location)
+
+    def save_readings(self, readings: List[EnvironmentalReading], location: str = DEFAULT_LOCATION) -> None:
+        self.repository.save_readings(readings, location)
+
+    def get_paginated_readings(
+            self,
+            page: int = 1,
+            per_page: int = 10,
+            location: str = DEFAULT_LOCATION
+    ) -> Tuple[List[EnvironmentalReading], int]:
+        return self.repository.get_paginated_readings(page, per_page, location)
+
+    def get_readings_before(
+            self,
+            before: datetime,
+            limit: int = 10,
+            location: str = DEFAULT_LOCATION
+    ) -> List[EnvironmentalReading]:
+        return self.repository.get_readings_before(before, limit, location)
+
+    def get_readings_in_range(
+            self,
+            start: datetime,
+            end: datetime,
+            location: str = DEFAULT_LOCATION,
+            limit: Optional[int] = None
+    ) -> List[EnvironmentalReading]:
+        return self.repository.get_readings_in_range(start, end, location, limit)
+
+    def aggregate_readings(
+            self,
+            start: datetime,
+            end: datetime,
+            bucket_seconds: int = DAY,
+            location: str = DEFAULT_LOCATION,
+            fields: Sequence[str] = MEASUREMENT_FIELDS,
+            percentiles: Sequence[float] = ()
+    ) -> List[Dict[str, Any]]:
+        # whole-day buckets merge the repository's per-day partials; shorter ones are grouped from the readings,
+        # which at the upstream's hourly resolution is no more work than there are buckets
+        if bucket_seconds % DAY == 0:
+            return self.repository.get_daily_rollups(
+                start, end, bucket_seconds // DAY, location, fields, percentiles
             )
 
-            readings.append(environmental_reading)
+        # bucket bounds are naive UTC; every backend orders naive timestamps as UTC, so aware input needs no care
+        buckets = bucket_range(start, end, bucket_seconds)
+        readings = self.repository.get_readings_in_range(
+            bucket_start(buckets.start, bucket_seconds), bucket_start(buckets.stop, bucket_seconds), location
+        )
+
+        return aggregate_readings(readings, start, end, bucket_seconds, fields, percentiles)
+
+    def get_range_stats(
+            self,
+            start: datetime,
+            end: datetime,
+            location: str = DEFAULT_LOCATION,
+            fields: Sequence[str] = MEASUREMENT_FIELDS
+    ) -> Dict[str, Dict[str, float]]:
+        return self.repository.get_range_stats(start, end, location, fields)
 
-        return readings
+    def _store_location_payloads(
+            self,
+            start_date: datetime,
+            end_date: datetime,
+            locations: List[str],
+            payloads: List[Dict[str, Any]]
+    ) -> Dict[str, ReadingColumns]:
+        stored = {}
+
+        for location, api_data in zip(locations, payloads):
+            columns = self._transform_api_columns(api_data)
+            self.repository.save_columns(columns, location)
+            self._mark_fetched(start_date.date(), end_date.date(), location)
+            stored[location] = columns
+
+        return stored
+
+    def mark_refreshed(self, first_day: date, last_day: date, location: str, ttl: float) -> None:
+        self.refreshed.mark_refreshed(first_day, last_day, location, ttl)
+
+    def _missing_ranges(self, first_day: date, last_day: date, location: str, refresh: bool) -> List[Tuple[date, date]]:
+        if refresh:
+            return [(first_day, last_day)]
+
+        missing = self.repository.get_missing_ranges(first_day, last_day, location)
+        return self.refreshed.get_stale_ranges(missing, location)
+
+    def _group_by_missing(
+            self,
+            first_day: date,
+            last_day: date,
+            locations: List[str],
+            refresh: bool
+    ) -> Dict[Tuple[Tuple[date, date], ...], List[str]]:
+        # locations with identical gaps can still share batched upstream requests
+        groups: Dict[Tuple[Tuple[date, date], ...], List[str]] = {}
+        for location in locations:
+            missing = tuple(self._missing_ranges(first_day, last_day, location, refresh))
+            groups.setdefault(missing, []).append(location)
+        return groups
+
+    def _mark_fetched(self, first_day: date, last_day: date, location: str) -> None:
+        last_settled_day = datetime.now(timezone.utc).date() - timedelta(days=COVERAGE_SETTLE_DAYS)
+        if first_day <= last_settled_day:
+            self.repository.mark_covered(first_day, min(last_day, last_settled_day), location)
+
+    def _stored_range(self, first_day: date, last_day: date, location: str) -> List[EnvironmentalReading]:
+        return self.repository.get_readings_in_range(
+            _day_start(first_day), _day_start(last_day + timedelta(days=1)), location
+        )
+
+    def _transform_api_data(self, api_data: Dict) -> List[EnvironmentalReading]:
+        return self._transform_api_columns(api_data).to_readings()
+
+    def _transform_api_columns(self, api_data: Dict) -> ReadingColumns:
+        hourly = api_data.get("hourly", {})
+        timestamps = self._parse_time_axis(hourly.get("time", []))
+        size = len(timestamps)
+
+        # ragged upstream arrays are truncated or padded with None to the length of the time axis
+        pollutants = {}
+        for name in POLLUTANT_FIELDS:
+            column = hourly.get(name, [])
+            pollutants[name] = column[:size] if len(column) >= size else column + [None] * (size - len(column))
+
+        weather = {name: [None] * size for name in WEATHER_FIELDS}
+
+        return ReadingColumns(timestamps=timestamps, weather=weather, pollutants=pollutants)
+
+    @staticmethod
+    def _parse_time_axis(time_array: List[str]) -> List[datetime]:
+        if len(time_array) < 3:
+            return [_parse_api_timestamp(value) for value in time_array]
+
+        first = _parse_api_timestamp(time_array[0])
+        step = _parse_api_timestamp(time_array[1]) - first
+        last = _parse_api_timestamp(time_array[-1])
+
+        # the hourly axis is regular, so it is rebuilt from its first value and step instead of parsing every string
+        if step > timedelta(0) and first + step * (len(time_array) - 1) == last:
+            return [first + step * i for i in range(len(time_array))]
+
+        return [_parse_api_timestamp(value) for value in time_array]
+
+
+class AsyncAirQualityService(AirQualityService):
+    # same data contract as AirQualityService, but the upstream fetch awaits instead of blocking the worker
+
+    def __init__(self, repository: InMemoryRepository, client: AsyncAirQualityClient,
+                 refreshed: Optional[RefreshIndex] = None):
+        super().__init__(repository, client, refreshed)
+
+    async def close(self) -> None:
+        await self.client.close()
+
+    async def fetch_and_store_air_quality_data(
+            self,
+            start_date: datetime,
+            end_date: datetime,
+            location: str = DEFAULT_LOCATION,
+            refresh: bool = False
+    ) -> List[EnvironmentalReading]:
+        first_day, last_day = start_date.date(), end_date.date()
+        missing = self._missing_ranges(first_day, last_day, location, refresh)
+
+        if missing == [(first_day, last_day)]:
+            columns = await self.fetch_and_store_air_quality_columns(start_date, end_date, location)
+            return columns.to_readings()
+
+        await asyncio.gather(*(
+            self.fetch_and_store_air_quality_columns(_day_start(gap_start), _day_start(gap_end), location)
+            for gap_start, gap_end in missing
+        ))
+
+        return self._stored_range(first_day, last_day, location)
+
+    async def fetch_and_store_air_quality_columns(
+            self,
+            start_date: datetime,
+            end_date: datetime,
+            location: str = DEFAULT_LOCATION
+    ) -> ReadingColumns:
+        if location != DEFAULT_LOCATION:
+            stored = await self._fetch_and_store_locations(start_date, end_date, [location])
+            return stored[location]
+
+        api_data = await self.client.get_air_quality_data(start_date, end_date)
+        columns = self._transform_api_columns(api_data)
+
+        self.repository.save_columns(columns, location)
+        self._mark_fetched(start_date.date(), end_date.date(), location)
+
+        return columns
+
+    async def fetch_and_store_for_locations(
+            self,
+            start_date: datetime,
+            end_date: datetime,
+            locations: List[str],
+            refresh: bool = False
+    ) -> Dict[str, List[EnvironmentalReading]]:
+        first_day, last_day = start_date.date(), end_date.date()
+
+        await asyncio.gather(*(
+            self._fetch_and_store_locations(_day_start(gap_start), _day_start(gap_end), group)
+            for missing, group in self._group_by_missing(first_day, last_day, locations, refresh).items()
+            for gap_start, gap_end in missing
+        ))
+
+        return {location: self._stored_range(first_day, last_day, location) for location in locations}
+
+    async def _fetch_and_store_locations(
+            self,
+            start_date: datetime,
+            end_date: datetime,
+            locations: List[str]
+    ) -> Dict[str, ReadingColumns]:
+        coordinates = [self._coordinates(location) for location in locations]
+        payloads = await self.client.get_air_quality_data_for_locations(coordinates, start_date, end_date)
+
+        return self._store_location_payloads(start_date, end_date, locations, payloads)
+
+
+def _bounded_fields() -> Tuple[Tuple[str, str, float, float], ...]:
+    fields = []
+    for part, names in (("weather", WEATHER_FIELDS), ("pollutants", POLLUTANT_FIELDS)):
+        for name in names:
+            if name not in FIELD_BOUNDS:
+                continue
+            minimum, maximum, _ = FIELD_BOUNDS[name]
+            fields.append((
+                part,
+                name,
+                float(minimum) if minimum is not None else -math.inf,
+                float(maximum) if maximum is not None else math.inf
+            ))
+    return tuple(fields)
+
+
+# FIELD_BOUNDS flattened once at import, with open ends as infinities, so every bounded field is a single
+# chained comparison; NaN fails it like any other out-of-range value
+BOUNDED_FIELDS = _bounded_fields()
 
 
 class ValidationService:
@@ -77,34 +414,26 @@ class ValidationService:
         if not reading.timestamp:
             return False
 
-        if reading.weather:
-            if reading.weather.temperature is not None and (
-                reading.weather.temperature < -100 or reading.weather.temperature > 60
-            ):
+        for part_name, name, minimum, maximum in BOUNDED_FIELDS:
+            part = getattr(reading, part_name)
+            if part is None:
+                continue
+            value = getattr(part, name)
+            if value is not None and not minimum <= value <= maximum:
                 return False
 
-            if reading.weather.pressure is not None and (
-                reading.weather.pressure < 800 or reading.weather.pressure > 1200
-            ):
-                return False
+        return True
 
-            if reading.weather.wind_speed is not None and reading.weather.wind_speed < 0:
-                return False
+    def validate_readings(self, readings: List[EnvironmentalReading]) -> List[bool]:
+        return list(map(self.validate_reading, readings))
 
-        if reading.pollutants:
-            if reading.pollutants.pm10 is not None and (
-                reading.pollutants.pm10 < 0 or reading.pollutants.pm10 > 1000
-            ):
-                return False
-
-            if reading.pollutants.pm2_5 is not None and (
-                reading.pollutants.pm2_5 < 0 or reading.pollutants.pm2_5 > 500
-            ):
-                return False
+    def validate_columns(self, columns: ReadingColumns) -> List[bool]:
+        mask = [True] * len(columns.timestamps)
 
-            if reading.pollutants.carbon_monoxide is not None and (
-                reading.pollutants.carbon_monoxide < 0 or reading.pollutants.carbon_monoxide > 50
-            ):
-                return False
+        for part_name, name, minimum, maximum in BOUNDED_FIELDS:
+            part = getattr(columns, part_name)
+            if part is None:
+                continue
+            mask = [valid and (value is None or minimum <= value <= maximum) for valid, value in zip(mask, part[name])]
 
-        return True
\ No newline at end of file
+        return mask
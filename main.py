@@ -1,8 +1,12 @@
 from flask import Flask, jsonify, request, Blueprint
 from werkzeug.exceptions import HTTPException
 from api.endpoints import bp as api_v1_bp
+from api.cache import build_cache_config
+from api.dependencies import get_air_quality_service
+from api.scheduler import build_refresh_scheduler
 from flask_caching import Cache
 import logging
+import os
 
 logging.basicConfig(
     level=logging.INFO,
@@ -17,17 +21,20 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 app.config['JSON_SORT_KEYS'] = False
 
-cache_config = {
-    'CACHE_TYPE': 'SimpleCache',
-    'CACHE_DEFAULT_TIMEOUT': 300
-}
-cache = Cache(app, config=cache_config)
+cache = Cache(app, config=build_cache_config())
 
 api_bp = Blueprint('api', __name__)
 
 api_bp.register_blueprint(api_v1_bp, url_prefix="/v1")
 app.register_blueprint(api_bp, url_prefix="/api")
 
+refresh_scheduler = build_refresh_scheduler(get_air_quality_service())
+if refresh_scheduler is not None:
+    app.extensions['refresh_scheduler'] = refresh_scheduler
+    # under a WSGI server every worker refreshes on its own; `python main.py` starts it below instead
+    if __name__ != "__main__":
+        refresh_scheduler.start()
+
 @app.errorhandler(Exception)
 def handle_exception(e):
     logger.error(f"Unhandled exception: {str(e)}", exc_info=True)
@@ -65,7 +72,7 @@ if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser(description='Run the OpenWeatherAPI application or tests.')
-    parser.add_argument('--test', type=str, help='Run tests. Use "e" for endpoints, "r" for repository, "s" for services, or "all" for all tests.')
+    parser.add_argument('--test', type=str, help='Run tests. Use "e" for endpoints, "r" for repository, "s" for services, "c" for client, "m" for models, "k" for concurrency, or "all" for all tests.')
     args = parser.parse_args()
 
     if args.test:
@@ -80,6 +87,15 @@ if __name__ == "__main__":
         elif args.test == 's':
             logger.info("Running service tests...")
             sys.exit(pytest.main(['tests/test_services.py']))
+        elif args.test == 'c':
+            logger.info("Running client tests...")
+            sys.exit(pytest.main(['tests/test_client.py']))
+        elif args.test == 'm':
+            logger.info("Running model tests...")
+            sys.exit(pytest.main(['tests/test_models.py', '-s']))
+        elif args.test == 'k':
+            logger.info("Running concurrency tests...")
+            sys.exit(pytest.main(['tests/test_concurrency.py']))
         elif args.test == 'all':
             logger.info("Running all tests...")
             sys.exit(pytest.main(['tests/']))
@@ -88,4 +104,7 @@ if __name__ == "__main__":
             sys.exit(1)
     else:
         logger.info("Starting application...")
+        # the debug reloader imports this file twice, only the serving child should refresh
+        if refresh_scheduler is not None and os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+            refresh_scheduler.start()
         app.run(host="0.0.0.0", port=8000, debug=True)
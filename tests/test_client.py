@@ -0,0 +1,367 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime, date, timedelta, timezone
+from urllib.parse import urlparse, parse_qs
+from email.utils import format_datetime
+from api.client import AirQualityClient, AsyncAirQualityClient
+import threading
+import asyncio
+import aiohttp
+import requests
+import pytest
+import json
+
+class FakeOpenMeteoHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        start = date.fromisoformat(query["start_date"][0])
+        end = date.fromisoformat(query["end_date"][0])
+
+        with self.server.lock:
+            self.server.requests.append((start, end))
+            self.server.validators.append(self.headers.get("If-None-Match"))
+            failures = self.server.failures.get(start, 0)
+            if failures:
+                self.server.failures[start] = failures - 1
+
+        if failures:
+            self.send_response(self.server.failure_status)
+            if self.server.retry_after is not None:
+                self.send_header("Retry-After", str(self.server.retry_after))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        etag = f'"{start}:{end}:{self.server.revision}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        hours = [datetime.combine(start, datetime.min.time()) + timedelta(hours=i)
+                 for i in range(((end - start).days + 1) * 24)]
+        payloads = [
+            {
+                "latitude": float(latitude),
+                "longitude": float(longitude),
+                "hourly": {
+                    "time": [hour.strftime("%Y-%m-%dT%H:%M") for hour in hours],
+                    "pm10": [float(hour.day) for hour in hours]
+                }
+            }
+            for latitude, longitude in zip(query["latitude"][0].split(","), query["longitude"][0].split(","))
+        ]
+        body = json.dumps(payloads if len(payloads) > 1 else payloads[0]).encode()
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def fake_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeOpenMeteoHandler)
+    server.lock = threading.Lock()
+    server.requests = []
+    server.failures = {}
+    server.failure_status = 503
+    server.retry_after = None
+    server.validators = []
+    server.revision = 0
+
+    thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def client(fake_server):
+    host, port = fake_server.server_address
+    return AirQualityClient(
+        latitude=52.0,
+        longitude=21.0,
+        base_url=f"http://{host}:{port}/v1/air-quality",
+        chunk_days=7,
+        max_workers=3,
+        chunk_retries=2,
+        retry_delay=0
+    )
+
+def test_split_range_into_windows(client):
+    windows = client._split_range(date(2023, 1, 1), date(2023, 1, 20))
+
+    assert windows == [
+        (date(2023, 1, 1), date(2023, 1, 7)),
+        (date(2023, 1, 8), date(2023, 1, 14)),
+        (date(2023, 1, 15), date(2023, 1, 20))
+    ]
+    assert client._split_range(date(2023, 1, 1), date(2023, 1, 1)) == [(date(2023, 1, 1), date(2023, 1, 1))]
+
+def test_chunked_fetch_merges_windows_in_order(client, fake_server):
+    data = client.get_air_quality_data(datetime(2023, 1, 1), datetime(2023, 1, 31))
+
+    assert len(fake_server.requests) == 5
+    assert data["latitude"] == 52.0
+
+    times = data["hourly"]["time"]
+    assert len(times) == 31 * 24
+    assert times[0] == "2023-01-01T00:00"
+    assert times[-1] == "2023-01-31T23:00"
+    assert times == sorted(times)
+    assert data["hourly"]["pm10"][-1] == 31.0
+
+def test_short_range_is_a_single_request(client, fake_server):
+    data = client.get_air_quality_data(datetime(2023, 1, 1), datetime(2023, 1, 2))
+
+    assert fake_server.requests == [(date(2023, 1, 1), date(2023, 1, 2))]
+    assert len(data["hourly"]["time"]) == 48
+
+def test_failed_chunk_is_retried(client, fake_server):
+    fake_server.failures[date(2023, 1, 8)] = 2
+
+    data = client.get_air_quality_data(datetime(2023, 1, 1), datetime(2023, 1, 14))
+
+    assert len(data["hourly"]["time"]) == 14 * 24
+    assert fake_server.requests.count((date(2023, 1, 8), date(2023, 1, 14))) == 3
+    assert fake_server.requests.count((date(2023, 1, 1), date(2023, 1, 7))) == 1
+
+def test_chunk_failing_past_retries_raises(client, fake_server):
+    fake_server.failures[date(2023, 1, 8)] = 100
+
+    with pytest.raises(requests.HTTPError):
+        client.get_air_quality_data(datetime(2023, 1, 1), datetime(2023, 1, 14))
+
+    # one layer of retries: the first attempt and two retries, not a transport retry loop inside each
+    assert fake_server.requests.count((date(2023, 1, 8), date(2023, 1, 14))) == 3
+
+def test_client_errors_are_not_retried(client, fake_server):
+    fake_server.failures[date(2023, 1, 1)] = 1
+    fake_server.failure_status = 400
+
+    with pytest.raises(requests.HTTPError):
+        client.get_air_quality_data(datetime(2023, 1, 1), datetime(2023, 1, 2))
+
+    assert len(fake_server.requests) == 1
+
+def test_locations_are_batched_into_few_requests(client, fake_server):
+    client.locations_per_request = 2
+    coordinates = [(50.0, 19.0), (51.0, 20.0), (52.0, 21.0)]
+
+    payloads = client.get_air_quality_data_for_locations(coordinates, datetime(2023, 1, 1), datetime(2023, 1, 10))
+
+    # two coordinate batches times two date windows
+    assert len(fake_server.requests) == 4
+    assert [payload["latitude"] for payload in payloads] == [50.0, 51.0, 52.0]
+    assert all(len(payload["hourly"]["time"]) == 10 * 24 for payload in payloads)
+    assert all(payload["hourly"]["time"][0] == "2023-01-01T00:00" for payload in payloads)
+
+def test_async_locations_are_batched(async_client, fake_server):
+    coordinates = [(50.0, 19.0), (51.0, 20.0)]
+
+    payloads = run_and_close(async_client, async_client.get_air_quality_data_for_locations(
+        coordinates, datetime(2023, 1, 1), datetime(2023, 1, 2)
+    ))
+
+    assert len(fake_server.requests) == 1
+    assert [payload["latitude"] for payload in payloads] == [50.0, 51.0]
+
+def test_retry_after_header_is_honoured(client, fake_server, mocker):
+    sleep = mocker.patch('api.client.time.sleep')
+    fake_server.failures[date(2023, 1, 1)] = 1
+    fake_server.failure_status = 429
+    fake_server.retry_after = 7
+
+    data = client.get_air_quality_data(datetime(2023, 1, 1), datetime(2023, 1, 1))
+
+    assert len(data["hourly"]["time"]) == 24
+    assert len(fake_server.requests) == 2
+    sleep.assert_called_once_with(7.0)
+
+def test_retry_after_header_is_capped(client, fake_server, mocker):
+    sleep = mocker.patch('api.client.time.sleep')
+    client.max_retry_after = 20
+    fake_server.failures[date(2023, 1, 1)] = 100
+    fake_server.retry_after = 3600
+
+    with pytest.raises(requests.HTTPError):
+        client.get_air_quality_data(datetime(2023, 1, 1), datetime(2023, 1, 1))
+
+    assert len(fake_server.requests) == 3
+    assert [call.args for call in sleep.call_args_list] == [(20,), (20,)]
+
+@pytest.mark.parametrize("retry_after", ["-5", "nan", "inf", "soon"])
+def test_unusable_retry_after_is_clamped_or_ignored(client, retry_after):
+    client.retry_delay = 0.5
+    client.max_retry_after = 20
+
+    delay = client._backoff(1, retry_after)
+
+    # a negative delay waits not at all; NaN, infinity and garbage fall back to the exponential delay
+    assert delay == (0.0 if retry_after == "-5" else 1.0)
+
+def test_retry_after_http_date_is_honoured(client):
+    client.max_retry_after = 20
+
+    soon = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=10), usegmt=True)
+    assert 8 <= client._backoff(0, soon) <= 10
+
+    past = format_datetime(datetime.now(timezone.utc) - timedelta(minutes=5), usegmt=True)
+    assert client._backoff(0, past) == 0.0
+
+    later = format_datetime(datetime.now(timezone.utc) + timedelta(hours=1), usegmt=True)
+    assert client._backoff(0, later) == 20
+
+def test_session_reuses_connections(client, fake_server):
+    client.max_workers = 1
+
+    client.get_air_quality_data(datetime(2023, 1, 1), datetime(2023, 1, 21))
+    client.get_air_quality_data(datetime(2023, 2, 1), datetime(2023, 2, 1))
+
+    stats = client.connection_stats()
+
+    assert stats["requests"] == 4
+    assert stats["new_connections"] == 1
+    assert stats["reused_connections"] == 3
+
+def test_requests_use_configured_timeouts(mocker):
+    client = AirQualityClient(latitude=52.0, longitude=21.0, connect_timeout=2, read_timeout=9)
+    get = mocker.patch.object(client.session, 'get')
+    get.return_value.json.return_value = {"hourly": {}}
+
+    client.get_air_quality_data(datetime(2023, 1, 1), datetime(2023, 1, 1))
+
+    assert get.call_args.kwargs["timeout"] == (2, 9)
+
+@pytest.fixture
+def async_client(fake_server):
+    host, port = fake_server.server_address
+    return AsyncAirQualityClient(
+        latitude=52.0,
+        longitude=21.0,
+        base_url=f"http://{host}:{port}/v1/air-quality",
+        chunk_days=7,
+        max_workers=3,
+        chunk_retries=2,
+        retry_delay=0
+    )
+
+def run_and_close(async_client, coroutine):
+    # each asyncio.run is its own loop, so the loop's session is closed before the loop goes away
+    async def run():
+        try:
+            return await coroutine
+        finally:
+            await async_client.close()
+
+    return asyncio.run(run())
+
+def test_async_calls_on_one_loop_share_a_session(async_client, fake_server, mocker):
+    sessions = mocker.spy(aiohttp, 'ClientSession')
+
+    async def fetch_gaps():
+        return await asyncio.gather(
+            async_client.get_air_quality_data(datetime(2023, 1, 1), datetime(2023, 1, 2)),
+            async_client.get_air_quality_data(datetime(2023, 1, 5), datetime(2023, 1, 6))
+        )
+
+    run_and_close(async_client, fetch_gaps())
+    run_and_close(async_client, fetch_gaps())
+
+    # one session per loop, not one per call
+    assert sessions.call_count == 2
+    assert len(fake_server.requests) == 4
+
+def test_async_chunked_fetch_merges_windows_in_order(async_client, fake_server):
+    data = run_and_close(async_client, async_client.get_air_quality_data(datetime(2023, 1, 1), datetime(2023, 1, 31)))
+
+    assert len(fake_server.requests) == 5
+    assert data["latitude"] == 52.0
+
+    times = data["hourly"]["time"]
+    assert len(times) == 31 * 24
+    assert times == sorted(times)
+    assert data["hourly"]["pm10"][-1] == 31.0
+
+def test_async_concurrent_fetches_share_one_loop(async_client, fake_server):
+    async def fetch_all():
+        return await asyncio.gather(
+            async_client.get_air_quality_data(datetime(2023, 1, 1), datetime(2023, 1, 3)),
+            async_client.get_air_quality_data(datetime(2023, 3, 1), datetime(2023, 3, 2))
+        )
+
+    first, second = run_and_close(async_client, fetch_all())
+
+    assert len(first["hourly"]["time"]) == 72
+    assert second["hourly"]["time"][0] == "2023-03-01T00:00"
+
+def test_async_failed_chunk_is_retried_after_retry_after(async_client, fake_server, mocker):
+    sleep = mocker.patch('api.client.asyncio.sleep', new=mocker.AsyncMock())
+    fake_server.failures[date(2023, 1, 8)] = 1
+    fake_server.failure_status = 429
+    fake_server.retry_after = 3
+
+    data = run_and_close(async_client, async_client.get_air_quality_data(datetime(2023, 1, 1), datetime(2023, 1, 14)))
+
+    assert len(data["hourly"]["time"]) == 14 * 24
+    assert fake_server.requests.count((date(2023, 1, 8), date(2023, 1, 14))) == 2
+    sleep.assert_awaited_once_with(3.0)
+
+def test_async_client_errors_are_not_retried(async_client, fake_server):
+    fake_server.failures[date(2023, 1, 1)] = 1
+    fake_server.failure_status = 400
+
+    with pytest.raises(aiohttp.ClientResponseError):
+        run_and_close(async_client, async_client.get_air_quality_data(datetime(2023, 1, 1), datetime(2023, 1, 2)))
+
+    assert len(fake_server.requests) == 1
+
+def test_identical_fetches_are_served_from_cache(client, fake_server):
+    first = client.get_air_quality_data(datetime(2023, 1, 1), datetime(2023, 1, 10))
+    second = client.get_air_quality_data(datetime(2023, 1, 1), datetime(2023, 1, 10))
+
+    assert len(fake_server.requests) == 2
+    assert first == second
+
+    client.get_air_quality_data(datetime(2023, 1, 1), datetime(2023, 1, 10), pollutants=["pm10"])
+    assert len(fake_server.requests) == 4
+
+def test_cache_evicts_least_recently_used(client, fake_server):
+    client.response_cache.max_entries = 2
+
+    for day in (1, 2, 1, 3, 1, 2):
+        client.get_air_quality_data(datetime(2023, 1, day), datetime(2023, 1, day))
+
+    # day 2 was the least recently used entry when day 3 arrived
+    assert [start.day for start, _ in fake_server.requests] == [1, 2, 3, 2]
+    assert len(client.response_cache) == 2
+
+def test_recent_days_are_revalidated(client, fake_server):
+    today = datetime.now(timezone.utc).replace(tzinfo=None)
+    client.cache_recent_ttl = 0
+
+    first = client.get_air_quality_data(today, today)
+    second = client.get_air_quality_data(today, today)
+
+    assert len(fake_server.requests) == 2
+    assert fake_server.validators[1] == f'"{today.date()}:{today.date()}:0"'
+    assert second == first
+    assert client.response_cache.stats()["revalidations"] == 1
+
+    fake_server.revision = 1
+    client.get_air_quality_data(today, today)
+    client.get_air_quality_data(today, today)
+
+    assert fake_server.validators[3] == f'"{today.date()}:{today.date()}:1"'
+    assert client.response_cache.stats()["revalidations"] == 2
+
+def test_historical_days_use_long_ttl(client):
+    assert client._cache_ttl(date(2023, 1, 1)) == client.cache_ttl
+    assert client._cache_ttl(datetime.now(timezone.utc).date()) == client.cache_recent_ttl
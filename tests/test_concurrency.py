@@ -0,0 +1,176 @@
+from concurrent.futures import ThreadPoolExecutor
+from api.concurrency import SingleFlight
+import threading
+import pytest
+
+def wait_for(condition):
+    deadline = threading.Event()
+    for _ in range(500):
+        if condition():
+            return
+        deadline.wait(0.01)
+    raise AssertionError("condition not reached")
+
+def test_single_flight_shares_result():
+    flights = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        release.wait(timeout=5)
+        return object()
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(flights.do, "key", compute) for _ in range(4)]
+        wait_for(lambda: flights.coalesced == 3)
+        release.set()
+        results = [future.result() for future in futures]
+
+    assert len(calls) == 1
+    assert all(result is results[0] for result in results)
+
+def test_single_flight_shares_errors_and_forgets_finished_keys():
+    flights = SingleFlight()
+    release = threading.Event()
+
+    def fail():
+        release.wait(timeout=5)
+        raise ValueError("upstream down")
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [executor.submit(flights.do, "key", fail) for _ in range(2)]
+        wait_for(lambda: flights.coalesced == 1)
+        release.set()
+        for future in futures:
+            with pytest.raises(ValueError):
+                future.result()
+
+    assert flights.do("key", lambda: 42) == 42
+
+def test_single_flight_runs_different_keys_independently():
+    flights = SingleFlight()
+
+    assert flights.do("a", lambda: 1) == 1
+    assert flights.do("b", lambda: 2) == 2
+    assert flights.coalesced == 0
+
+def test_rwlock_readers_share_and_writers_exclude():
+    from api.concurrency import RWLock
+
+    lock = RWLock()
+    both_reading = threading.Barrier(2, timeout=5)
+    events = []
+
+    def reader():
+        with lock.read():
+            # both readers must be inside at once for the barrier to open
+            both_reading.wait()
+            events.append("read")
+
+    def writer():
+        with lock.write():
+            events.append("write start")
+            threading.Event().wait(0.05)
+            events.append("write end")
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        for future in [executor.submit(reader), executor.submit(reader)]:
+            future.result()
+        futures = [executor.submit(writer), executor.submit(writer)]
+        for future in futures:
+            future.result()
+
+    assert events[:2] == ["read", "read"]
+    assert events[2:] == ["write start", "write end", "write start", "write end"]
+
+def test_rwlock_waiting_writer_blocks_new_readers():
+    from api.concurrency import RWLock
+
+    lock = RWLock()
+    order = []
+    first_reader = threading.Event()
+    release_reader = threading.Event()
+
+    def long_reader():
+        with lock.read():
+            first_reader.set()
+            release_reader.wait(timeout=5)
+        order.append("first reader")
+
+    def writer():
+        with lock.write():
+            order.append("writer")
+
+    def late_reader():
+        with lock.read():
+            order.append("late reader")
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        held = executor.submit(long_reader)
+        first_reader.wait(timeout=5)
+        pending_write = executor.submit(writer)
+        wait_for(lambda: lock._waiting_writers == 1)
+        late = executor.submit(late_reader)
+        release_reader.set()
+        for future in (held, pending_write, late):
+            future.result()
+
+    assert order.index("writer") < order.index("late reader")
+
+def test_range_index_build_does_not_block_other_locations():
+    from api.aggregation import RangeStatsIndex, MEASUREMENT_FIELDS
+    from datetime import datetime
+
+    index = RangeStatsIndex()
+    building = threading.Event()
+    release = threading.Event()
+    row = (0.0, (1.0,) * len(MEASUREMENT_FIELDS))
+
+    def slow_rows():
+        building.set()
+        release.wait(timeout=5)
+        return [row]
+
+    window = (datetime(1970, 1, 1), datetime(1970, 1, 2))
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        slow = executor.submit(index.stats, "a", *window, ["pm10"], slow_rows)
+        building.wait(timeout=5)
+
+        # while "a" is being built, "b" is built, queried and appended to without waiting for it
+        assert index.stats("b", *window, ["pm10"], lambda: [row])["pm10"]["count"] == 1
+        index.append("b", 60.0, row[1])
+        assert index.stats("b", *window, ["pm10"], lambda: [])["pm10"]["count"] == 2
+        assert not slow.done()
+
+        release.set()
+        assert slow.result()["pm10"]["count"] == 1
+
+def test_rollup_scans_do_not_block_other_locations():
+    from api.aggregation import RollupIndex, MEASUREMENT_FIELDS
+    from datetime import datetime
+
+    index = RollupIndex()
+    scanning = threading.Event()
+    release = threading.Event()
+    row = (0.0, (1.0,) * len(MEASUREMENT_FIELDS))
+    index.add_many("a", [row])
+
+    def slow_rows(lo, hi):
+        scanning.set()
+        release.wait(timeout=5)
+        return [row]
+
+    window = (datetime(1970, 1, 1), datetime(1970, 1, 2))
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        slow = executor.submit(index.aggregate, "a", *window, 1, slow_rows, ["pm10"], [50])
+        scanning.wait(timeout=5)
+
+        # a percentile scan of "a" leaves writes to and queries of "b" free to run
+        index.add_many("b", [row, (60.0, row[1])])
+        index.add("b", 120.0, row[1])
+        assert index.aggregate("b", *window, 1, lambda lo, hi: [])[0]["fields"]["pm10"]["count"] == 3
+        assert not slow.done()
+
+        release.set()
+        assert slow.result()[0]["fields"]["pm10"]["p50"] == 1.0
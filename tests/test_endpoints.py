@@ -1,6 +1,7 @@
-from api.models import EnvironmentalReading, WeatherReading, EnvironmentalReadingSchema
+from api.models import EnvironmentalReading, WeatherReading, PollutantReading, EnvironmentalReadingSchema, DEFAULT_LOCATION
 from datetime import datetime
 from api.endpoints import bp
+from api.serializers import dump_reading
 from flask import Flask
 import pytest
 import json
@@ -24,7 +25,9 @@ def client(app):
 
 @pytest.fixture
 def mock_air_quality_service(mocker):
-    return mocker.patch('api.endpoints.get_air_quality_service')
+    service = mocker.patch('api.endpoints.get_air_quality_service')
+    service.return_value.get_last_modified.return_value = None
+    return service
 
 @pytest.fixture
 def mock_validation_service(mocker):
@@ -99,7 +102,7 @@ def test_get_paginated_readings(client, mock_air_quality_service):
     response = client.get('/api/v1/readings/list?page=1&per_page=10')
 
     assert response.status_code == 200
-    mock_air_quality_service.return_value.get_paginated_readings.assert_called_once_with(1, 10)
+    mock_air_quality_service.return_value.get_paginated_readings.assert_called_once_with(1, 10, DEFAULT_LOCATION)
 
     response_data = json.loads(response.data)
     assert len(response_data['readings']) == 1
@@ -130,3 +133,601 @@ def test_fetch_data(client, mock_air_quality_service):
 
     response_data = json.loads(response.data)
     assert len(response_data['readings']) == 1
+
+def test_get_readings_before_cursor(client, mock_air_quality_service):
+    base_time = datetime(2023, 1, 1, 12, 0, 0)
+    readings = [EnvironmentalReading(timestamp=base_time.replace(hour=12 - i)) for i in range(3)]
+
+    mock_air_quality_service.return_value.get_readings_before.return_value = readings
+    response = client.get('/api/v1/readings/list?before=2023-01-01T13:00:00&per_page=2')
+
+    assert response.status_code == 200
+    mock_air_quality_service.return_value.get_readings_before.assert_called_once_with(
+        datetime(2023, 1, 1, 13, 0, 0), 3, DEFAULT_LOCATION
+    )
+    mock_air_quality_service.return_value.get_paginated_readings.assert_not_called()
+
+    response_data = json.loads(response.data)
+    assert len(response_data['readings']) == 2
+    assert response_data['pagination']['has_next'] is True
+    assert response_data['pagination']['next_before'] == '2023-01-01T11:00:00'
+
+def test_get_readings_before_invalid_timestamp(client, mock_air_quality_service):
+    response = client.get('/api/v1/readings/list?before=yesterday')
+
+    assert response.status_code == 400
+
+@pytest.fixture
+def mock_async_service(mocker):
+    service = mocker.patch('api.endpoints.get_async_air_quality_service')
+    service.return_value.close = mocker.AsyncMock()
+    return service
+
+def test_fetch_data_async(client, mock_async_service, mocker):
+    timestamp = datetime(2023, 1, 1, 12, 0, 0)
+    readings = [EnvironmentalReading(timestamp=timestamp)]
+    mock_async_service.return_value.fetch_and_store_air_quality_data = mocker.AsyncMock(return_value=readings)
+
+    response = client.get('/api/v1/fetch-data/async?start_date=2023-01-01T00:00:00Z&end_date=2023-01-02T00:00:00Z')
+
+    assert response.status_code == 200
+    mock_async_service.return_value.fetch_and_store_air_quality_data.assert_awaited_once()
+
+    response_data = json.loads(response.data)
+    assert response_data['readings'][0]['timestamp'] == '2023-01-01T12:00:00'
+    # the request's loop ends with it, so its upstream session is closed before the response goes out
+    mock_async_service.return_value.close.assert_awaited_once()
+
+def test_fetch_data_async_requires_dates(client, mock_async_service):
+    response = client.get('/api/v1/fetch-data/async?start_date=2023-01-01T00:00:00Z')
+
+    assert response.status_code == 400
+    mock_async_service.return_value.close.assert_awaited_once()
+
+def test_readings_location_parameter(client, mock_air_quality_service):
+    mock_air_quality_service.return_value.get_paginated_readings.return_value = ([], 0)
+    mock_air_quality_service.return_value.get_reading_closest_to_timestamp.return_value = None
+
+    response = client.get('/api/v1/readings/list?location=50.06465,19.94498')
+    assert response.status_code == 200
+    mock_air_quality_service.return_value.get_paginated_readings.assert_called_once_with(1, 10, "50.0647,19.9450")
+
+    response = client.get('/api/v1/readings/closest?timestamp=2023-01-01T12:00:00Z&location=50.0647,19.945')
+    assert response.status_code == 404
+    assert mock_air_quality_service.return_value.get_reading_closest_to_timestamp.call_args.args[1] == "50.0647,19.9450"
+
+def test_invalid_location_is_rejected(client, mock_air_quality_service):
+    assert client.get('/api/v1/readings/list?location=warsaw').status_code == 400
+    assert client.get('/api/v1/readings/list?location=95.0,21.0').status_code == 400
+    mock_air_quality_service.return_value.get_paginated_readings.assert_not_called()
+
+def test_configured_site_is_one_location(app, client, mocker):
+    from api.repository import InMemoryRepository
+    from api.services import AirQualityService
+
+    app.extensions = {'cache': DictCache()}
+    upstream = mocker.MagicMock(latitude=52.2297, longitude=21.0122)
+    upstream.get_air_quality_data.return_value = {"hourly": {"time": ["2023-01-01T00:00"], "pm10": [10.0]}}
+    upstream.get_air_quality_data_for_locations.side_effect = lambda coordinates, start, end: [
+        {"hourly": {"time": ["2023-01-01T00:00"], "pm10": [20.0]}} for _ in coordinates
+    ]
+    mocker.patch('api.endpoints.get_air_quality_service', return_value=AirQualityService(InMemoryRepository(), upstream))
+
+    fetch = '/api/v1/fetch-data?start_date=2023-01-01T00:00:00&end_date=2023-01-01T00:00:00'
+    assert client.get(fetch).status_code == 200
+    assert client.get(fetch + '&location=52.2297,21.0122').status_code == 200
+
+    response = client.get('/api/v1/readings/list?location=52.22970,21.01220')
+
+    # fetched once and listed under the coordinates as well as under 'default'
+    assert upstream.get_air_quality_data.call_count == 1
+    assert json.loads(response.data)['pagination']['total_items'] == 1
+
+    response = client.get(fetch + '&location=default&location=50.0647,19.945')
+
+    assert response.status_code == 200
+    assert set(json.loads(response.data)['locations']) == {'default', '50.0647,19.9450'}
+    upstream.get_air_quality_data_for_locations.assert_called_once_with(
+        [(50.0647, 19.945)], datetime(2023, 1, 1), datetime(2023, 1, 1)
+    )
+
+def test_concurrent_fetch_requests_share_one_upstream_call(app, mocker):
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    from api import dependencies
+    from api.repository import InMemoryRepository
+
+    # the real dependency path: each request asks get_air_quality_service() for its service
+    service = dependencies.get_air_quality_service()
+    mocker.patch.object(service, 'repository', InMemoryRepository())
+    release = threading.Event()
+
+    def slow_payload(start_date, end_date):
+        release.wait(timeout=5)
+        return {"hourly": {"time": ["2023-01-01T00:00"], "pm10": [10.0]}}
+
+    upstream = mocker.patch.object(service.client, 'get_air_quality_data', side_effect=slow_payload)
+    coalesced = service._flights.coalesced
+    url = '/api/v1/fetch-data?start_date=2023-01-01T00:00:00&end_date=2023-01-01T00:00:00'
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [executor.submit(app.test_client().get, url) for _ in range(2)]
+        for _ in range(500):
+            if service._flights.coalesced > coalesced:
+                break
+            threading.Event().wait(0.01)
+        release.set()
+        responses = [future.result() for future in futures]
+
+    assert [response.status_code for response in responses] == [200, 200]
+    assert upstream.call_count == 1
+    assert responses[0].data == responses[1].data
+
+def test_fetch_data_for_multiple_locations(client, mock_air_quality_service):
+    timestamp = datetime(2023, 1, 1, 12, 0, 0)
+    mock_air_quality_service.return_value.fetch_and_store_for_locations.return_value = {
+        "51.1079,17.0385": [EnvironmentalReading(timestamp=timestamp)],
+        "50.0647,19.9450": []
+    }
+
+    response = client.get(
+        '/api/v1/fetch-data?start_date=2023-01-01T00:00:00Z&end_date=2023-01-02T00:00:00Z'
+        '&location=51.1079,17.0385&location=50.0647,19.945'
+    )
+
+    assert response.status_code == 200
+    locations = mock_air_quality_service.return_value.fetch_and_store_for_locations.call_args.args[2]
+    assert locations == ["51.1079,17.0385", "50.0647,19.9450"]
+
+    response_data = json.loads(response.data)
+    assert len(response_data['locations']['51.1079,17.0385']) == 1
+    assert response_data['locations']['50.0647,19.9450'] == []
+
+def test_fetch_data_refresh_flag(client, mock_air_quality_service):
+    mock_air_quality_service.return_value.fetch_and_store_air_quality_data.return_value = []
+
+    client.get('/api/v1/fetch-data?start_date=2023-01-01T00:00:00Z&end_date=2023-01-02T00:00:00Z&refresh=1')
+
+    assert mock_air_quality_service.return_value.fetch_and_store_air_quality_data.call_args.kwargs['refresh'] is True
+
+class DictCache:
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value):
+        self.values[key] = value
+
+def test_cached_reads_are_invalidated_by_writes(app, client, mocker):
+    from api.repository import InMemoryRepository
+    from api.services import AirQualityService
+
+    app.extensions = {'cache': DictCache()}
+    service = AirQualityService(InMemoryRepository(), mocker.MagicMock())
+    mocker.patch('api.endpoints.get_air_quality_service', return_value=service)
+    mocker.patch('api.endpoints.get_validation_service').return_value.validate_reading.return_value = True
+
+    url = '/api/v1/readings/closest?timestamp=2023-01-01T12:00:00'
+    client.post('/api/v1/readings', json={"timestamp": "2023-01-01T10:00:00"})
+    assert json.loads(client.get(url).data)['timestamp'] == '2023-01-01T10:00:00'
+    assert json.loads(client.get(url).data)['timestamp'] == '2023-01-01T10:00:00'
+
+    client.post('/api/v1/readings', json={"timestamp": "2023-01-01T12:00:00"})
+    assert json.loads(client.get(url).data)['timestamp'] == '2023-01-01T12:00:00'
+
+    stats = json.loads(client.get('/api/v1/cache/stats').data)
+    assert stats['hits'] == 1
+    assert stats['misses'] == 2
+    assert stats['invalidations'] == 1
+
+def worker_responses(mocker, server, services, url):
+    import fakeredis
+
+    responses = []
+    for service in services:
+        # each worker is its own app and service, with only the redis server in common
+        worker = Flask(__name__)
+        worker.extensions = {'cache': fakeredis.FakeRedis(server=server)}
+        worker.register_blueprint(bp, url_prefix="/api/v1")
+        mocker.patch('api.endpoints.get_air_quality_service', return_value=service)
+        responses.append(worker.test_client().get(url))
+    return responses
+
+def test_workers_share_a_redis_cache_over_sqlite(mocker, tmp_path):
+    import fakeredis
+    from api.repository import SQLiteRepository
+    from api.services import AirQualityService
+
+    path = str(tmp_path / "readings.db")
+    services = [AirQualityService(SQLiteRepository(path), mocker.MagicMock()) for _ in range(2)]
+    services[0].save_reading(EnvironmentalReading(
+        timestamp=datetime(2023, 1, 1, 12, 0, 0),
+        pollutants=PollutantReading(timestamp=datetime(2023, 1, 1, 12, 0, 0), pm10=10.0)
+    ))
+    spies = [mocker.spy(service, 'get_reading_closest_to_timestamp') for service in services]
+
+    responses = worker_responses(
+        mocker, fakeredis.FakeServer(), services, '/api/v1/readings/closest?timestamp=2023-01-01T12:00:00'
+    )
+
+    # both workers read one file, so the second is answered from the entry the first one cached
+    assert [spy.call_count for spy in spies] == [1, 0]
+    assert responses[0].data == responses[1].data
+    assert responses[1].mimetype == 'application/json'
+    assert json.loads(responses[1].data)['pollutants']['pm10'] == 10.0
+
+def test_workers_with_process_local_repositories_keep_redis_entries_apart(mocker):
+    import fakeredis
+    from api.repository import InMemoryRepository
+    from api.services import AirQualityService
+
+    services = [AirQualityService(InMemoryRepository(), mocker.MagicMock()) for _ in range(2)]
+    for service, pm10 in zip(services, (10.0, 20.0)):
+        # one write each, so both workers are at the same version for the location
+        service.save_reading(EnvironmentalReading(
+            timestamp=datetime(2023, 1, 1, 12, 0, 0),
+            pollutants=PollutantReading(timestamp=datetime(2023, 1, 1, 12, 0, 0), pm10=pm10)
+        ))
+
+    responses = worker_responses(
+        mocker, fakeredis.FakeServer(), services, '/api/v1/readings/closest?timestamp=2023-01-01T12:00:00'
+    )
+
+    assert [json.loads(response.data)['pollutants']['pm10'] for response in responses] == [10.0, 20.0]
+
+@pytest.mark.parametrize("cache_type", ["SimpleCache", "FileSystemCache"])
+def test_read_endpoints_use_the_flask_caching_backend(cache_type, monkeypatch, tmp_path, mocker):
+    flask_caching = pytest.importorskip("flask_caching")
+    from api.cache import build_cache_config
+    from api.repository import InMemoryRepository
+    from api.services import AirQualityService
+
+    monkeypatch.setenv("CACHE_TYPE", cache_type)
+    monkeypatch.setenv("CACHE_DIR", str(tmp_path / "cache"))
+    service = AirQualityService(InMemoryRepository(), mocker.MagicMock())
+    service.save_reading(EnvironmentalReading(
+        timestamp=datetime(2023, 1, 1, 12, 0, 0),
+        weather=WeatherReading(datetime(2023, 1, 1, 12, 0, 0), 20.0, 0.0, 1013.0, 5.0)
+    ))
+    mocker.patch('api.endpoints.get_air_quality_service', return_value=service)
+
+    # wired the way main.py does it, so extensions['cache'] is flask-caching's own {Cache: backend} mapping
+    app = Flask(__name__)
+    flask_caching.Cache(app, config=build_cache_config())
+    app.register_blueprint(bp, url_prefix="/api/v1")
+    client = app.test_client()
+
+    dates = 'start_date=2023-01-01T00:00:00&end_date=2023-01-02T00:00:00'
+    for url in (
+        '/api/v1/readings/closest?timestamp=2023-01-01T12:00:00',
+        '/api/v1/readings/list',
+        f'/api/v1/readings/range?{dates}',
+        f'/api/v1/readings/aggregate?{dates}',
+        f'/api/v1/readings/stats?{dates}'
+    ):
+        first, second = client.get(url), client.get(url)
+        assert first.status_code == 200, url
+        assert second.data == first.data
+
+    assert json.loads(client.get('/api/v1/cache/stats').data)['hits'] == 5
+
+def test_build_cache_config(monkeypatch):
+    from api.cache import build_cache_config
+
+    monkeypatch.setenv("CACHE_TYPE", "RedisCache")
+    monkeypatch.setenv("CACHE_REDIS_URL", "redis://localhost:6379/0")
+    config = build_cache_config()
+    assert config["CACHE_TYPE"] == "RedisCache"
+    assert config["CACHE_REDIS_URL"] == "redis://localhost:6379/0"
+
+    monkeypatch.delenv("CACHE_REDIS_URL")
+    with pytest.raises(ValueError):
+        build_cache_config()
+
+    monkeypatch.setenv("CACHE_TYPE", "Memcached")
+    with pytest.raises(ValueError):
+        build_cache_config()
+
+def test_bulk_create_readings(client, mock_air_quality_service, mock_validation_service):
+    mock_validation_service.return_value.validate_readings.side_effect = lambda readings: [True] * len(readings)
+    data = [{"timestamp": f"2023-01-01T{hour:02d}:00:00"} for hour in range(3)]
+
+    response = client.post('/api/v1/readings/bulk?location=51.1079,17.0385', json=data)
+
+    assert response.status_code == 201
+    assert json.loads(response.data) == {"saved": 3, "errors": {}}
+    readings, location = mock_air_quality_service.return_value.save_readings.call_args.args
+    assert [reading.timestamp.hour for reading in readings] == [0, 1, 2]
+    assert location == "51.1079,17.0385"
+
+def test_bulk_create_reports_per_item_errors(client, mock_air_quality_service, mock_validation_service):
+    mock_validation_service.return_value.validate_readings.side_effect = lambda readings: [
+        reading.timestamp.hour != 3 for reading in readings
+    ]
+    body = "\n".join([
+        '{"timestamp": "2023-01-01T00:00:00"}',
+        '{"timestamp": "not a date"}',
+        '{"timestamp": ',
+        '',
+        '{"timestamp": "2023-01-01T03:00:00"}',
+        '{"timestamp": "2023-01-01T04:00:00", "weather": {"timestamp": "2023-01-01T04:00:00", "pressure": 5}}',
+        '{"timestamp": "2023-01-01T05:00:00"}'
+    ])
+
+    response = client.post('/api/v1/readings/bulk', data=body, content_type='application/x-ndjson')
+
+    assert response.status_code == 207
+    response_data = json.loads(response.data)
+    assert response_data["saved"] == 2
+    assert sorted(response_data["errors"]) == ["1", "2", "3", "4"]
+    assert "pressure" in response_data["errors"]["4"]["weather"]
+
+    readings, _ = mock_air_quality_service.return_value.save_readings.call_args.args
+    assert [reading.timestamp.hour for reading in readings] == [0, 5]
+
+def test_bulk_create_rejects_bad_bodies(client, mock_air_quality_service, mock_validation_service):
+    mock_validation_service.return_value.validate_readings.side_effect = lambda readings: [True] * len(readings)
+    assert client.post('/api/v1/readings/bulk', json={"timestamp": "2023-01-01T00:00:00"}).status_code == 400
+    assert client.post('/api/v1/readings/bulk', json=[]).status_code == 400
+
+    response = client.post('/api/v1/readings/bulk', json=[{"timestamp": "bad"}])
+    assert response.status_code == 400
+    mock_air_quality_service.return_value.save_readings.assert_not_called()
+
+def test_bulk_create_refuses_oversized_bodies(client, mock_air_quality_service, mock_validation_service, monkeypatch):
+    monkeypatch.setattr('api.endpoints.BULK_MAX_READINGS', 3)
+    monkeypatch.setattr('api.endpoints.BULK_MAX_BYTES', 1024)
+    mock_validation_service.return_value.validate_readings.side_effect = lambda readings: [True] * len(readings)
+    line = '{"timestamp": "2023-01-01T00:00:00"}'
+
+    # too many bytes is refused from the declared length, whatever the format
+    assert client.post('/api/v1/readings/bulk', json=[{"timestamp": "2023-01-01T00:00:00"}] * 50).status_code == 413
+    assert client.post('/api/v1/readings/bulk', data="\n".join([line] * 50),
+                       content_type='application/x-ndjson').status_code == 413
+
+    # a small body with too many lines is refused on the first line past the limit
+    response = client.post('/api/v1/readings/bulk', data="\n".join([line] * 4), content_type='application/x-ndjson')
+    assert response.status_code == 413
+    assert client.post('/api/v1/readings/bulk', data="\n".join([line] * 3),
+                       content_type='application/x-ndjson').status_code == 201
+    assert mock_air_quality_service.return_value.save_readings.call_count == 1
+
+def test_fetch_data_streams_ndjson(client, mock_air_quality_service):
+    mock_air_quality_service.return_value.stream_air_quality_data.side_effect = lambda start, end, location, refresh: iter([
+        EnvironmentalReading(timestamp=datetime(2023, 1, 1, hour)) for hour in range(3)
+    ])
+    url = '/api/v1/fetch-data?start_date=2023-01-01T00:00:00Z&end_date=2023-01-02T00:00:00Z'
+
+    for query, headers in (('&stream=1', {}), ('', {'Accept': 'application/x-ndjson'})):
+        with client.get(url + query, headers=headers) as response:
+            assert response.status_code == 200
+            assert response.mimetype == 'application/x-ndjson'
+            lines = [json.loads(line) for line in response.data.decode().splitlines()]
+            assert [line['timestamp'] for line in lines] == [f'2023-01-01T0{hour}:00:00' for hour in range(3)]
+
+    mock_air_quality_service.return_value.fetch_and_store_air_quality_data.assert_not_called()
+    assert client.get(url).mimetype == 'application/json'
+
+def test_fetch_data_streams_multiple_locations(client, mock_air_quality_service):
+    mock_air_quality_service.return_value.stream_air_quality_data.side_effect = lambda start, end, location, refresh: iter([
+        EnvironmentalReading(timestamp=datetime(2023, 1, 1))
+    ])
+
+    with client.get(
+        '/api/v1/fetch-data?start_date=2023-01-01T00:00:00Z&end_date=2023-01-01T00:00:00Z&stream=1'
+        '&location=51.1079,17.0385&location=50.0647,19.945'
+    ) as response:
+        lines = [json.loads(line) for line in response.data.decode().splitlines()]
+    assert [line['location'] for line in lines] == ["51.1079,17.0385", "50.0647,19.9450"]
+
+def test_get_readings_in_range(client, mock_air_quality_service):
+    readings = [EnvironmentalReading(timestamp=datetime(2023, 1, 1, hour)) for hour in range(3)]
+    mock_air_quality_service.return_value.get_readings_in_range.return_value = readings
+
+    response = client.get('/api/v1/readings/range?start_date=2023-01-01T00:00:00&end_date=2023-01-02T00:00:00&limit=2')
+
+    assert response.status_code == 200
+    mock_air_quality_service.return_value.get_readings_in_range.assert_called_once_with(
+        datetime(2023, 1, 1), datetime(2023, 1, 2), DEFAULT_LOCATION, 3
+    )
+    response_data = json.loads(response.data)
+    assert [reading['timestamp'] for reading in response_data['readings']] == ['2023-01-01T00:00:00', '2023-01-01T01:00:00']
+    assert response_data['next_start'] == '2023-01-01T02:00:00'
+
+    assert client.get('/api/v1/readings/range?start_date=2023-01-01&end_date=2023-01-02&limit=0').status_code == 400
+
+def test_aggregate_readings(app, client, mocker):
+    from api.repository import InMemoryRepository
+    from api.services import AirQualityService
+
+    app.extensions = {'cache': DictCache()}
+    service = AirQualityService(InMemoryRepository(), mocker.MagicMock())
+    mocker.patch('api.endpoints.get_air_quality_service', return_value=service)
+    mocker.patch('api.endpoints.get_validation_service').return_value.validate_readings.side_effect = (
+        lambda readings: [True] * len(readings)
+    )
+
+    client.post('/api/v1/readings/bulk', json=[
+        {"timestamp": f"2023-01-0{day}T{hour:02d}:00:00", "pollutants": {
+            "timestamp": f"2023-01-0{day}T{hour:02d}:00:00", "pm10": float(day * 10 + hour)
+        }}
+        for day in (1, 2) for hour in range(4)
+    ])
+
+    url = '/api/v1/readings/aggregate?start_date=2023-01-01&end_date=2023-01-03&fields=pm10&percentiles=50'
+    response = client.get(url)
+
+    assert response.status_code == 200
+    response_data = json.loads(response.data)
+    assert response_data['bucket'] == '1d'
+    assert [bucket['start'] for bucket in response_data['buckets']] == ['2023-01-01T00:00:00', '2023-01-02T00:00:00']
+    assert response_data['buckets'][1]['fields'] == {
+        'pm10': {'count': 4, 'min': 20.0, 'max': 23.0, 'mean': 21.5, 'p50': 21.5}
+    }
+
+    hourly = json.loads(client.get(url + '&bucket=2h').data)
+    assert [bucket['fields']['pm10']['mean'] for bucket in hourly['buckets']] == [10.5, 12.5, 20.5, 22.5]
+
+def test_utc_bounds_query_naive_readings(app, client, mocker):
+    from api.repository import InMemoryRepository
+    from api.services import AirQualityService
+
+    # upstream hours are stored naive, while the README's examples query with a 'Z' suffix
+    app.extensions = {'cache': DictCache()}
+    service = AirQualityService(InMemoryRepository(), mocker.MagicMock())
+    service.save_readings([
+        EnvironmentalReading(timestamp=datetime(2023, 1, 1, hour), pollutants=PollutantReading(
+            timestamp=datetime(2023, 1, 1, hour), pm10=float(hour)
+        ))
+        for hour in range(12)
+    ])
+    mocker.patch('api.endpoints.get_air_quality_service', return_value=service)
+
+    response = client.get('/api/v1/readings/range?start_date=2023-01-01T02:00:00Z&end_date=2023-01-01T05:00:00Z')
+
+    assert response.status_code == 200
+    assert [reading['timestamp'] for reading in json.loads(response.data)['readings']] == [
+        '2023-01-01T02:00:00', '2023-01-01T03:00:00', '2023-01-01T04:00:00'
+    ]
+
+    response = client.get(
+        '/api/v1/readings/aggregate?start_date=2023-01-01T00:00:00Z&end_date=2023-01-01T12:00:00Z&bucket=6h&fields=pm10'
+    )
+
+    assert response.status_code == 200
+    assert [bucket['fields']['pm10']['mean'] for bucket in json.loads(response.data)['buckets']] == [2.5, 8.5]
+
+    response = client.get('/api/v1/readings/list?before=2023-01-01T03:00:00Z&per_page=2')
+
+    assert response.status_code == 200
+    assert [reading['timestamp'] for reading in json.loads(response.data)['readings']] == [
+        '2023-01-01T02:00:00', '2023-01-01T01:00:00'
+    ]
+
+def test_aggregate_rejects_bad_parameters(client, mock_air_quality_service):
+    base = '/api/v1/readings/aggregate?start_date=2023-01-01&end_date=2023-01-03'
+
+    assert client.get(base + '&bucket=1y').status_code == 400
+    assert client.get(base + '&fields=pm10,humidity').status_code == 400
+    assert client.get(base + '&percentiles=150').status_code == 400
+    assert client.get('/api/v1/readings/aggregate?start_date=2000-01-01&end_date=2023-01-01&bucket=1h').status_code == 400
+    mock_air_quality_service.return_value.aggregate_readings.assert_not_called()
+
+def test_get_range_stats(client, mock_air_quality_service):
+    mock_air_quality_service.return_value.get_range_stats.return_value = {
+        "pm10": {"count": 2, "min": 1.0, "max": 3.0, "mean": 2.0}
+    }
+
+    response = client.get('/api/v1/readings/stats?start_date=2023-01-01&end_date=2023-01-02&fields=pm10')
+
+    assert response.status_code == 200
+    mock_air_quality_service.return_value.get_range_stats.assert_called_once_with(
+        datetime(2023, 1, 1), datetime(2023, 1, 2), DEFAULT_LOCATION, ["pm10"]
+    )
+    assert json.loads(response.data)["fields"]["pm10"]["mean"] == 2.0
+
+def test_conditional_get_skips_rendering(app, client, mocker):
+    from api.repository import InMemoryRepository
+    from api.services import AirQualityService
+
+    app.extensions = {'cache': DictCache()}
+    service = AirQualityService(InMemoryRepository(), mocker.MagicMock())
+    mocker.patch('api.endpoints.get_air_quality_service', return_value=service)
+    mocker.patch('api.endpoints.get_validation_service').return_value.validate_reading.return_value = True
+    dump = mocker.patch('api.endpoints.dump_reading', wraps=dump_reading)
+
+    client.post('/api/v1/readings', json={"timestamp": "2023-01-01T10:00:00"})
+    first = client.get('/api/v1/readings/list')
+    etag, last_modified = first.headers['ETag'], first.headers['Last-Modified']
+    assert first.status_code == 200 and etag.startswith('W/"')
+    assert dump.call_count == 1
+
+    for headers in ({'If-None-Match': etag}, {'If-Modified-Since': last_modified}):
+        response = client.get('/api/v1/readings/list', headers=headers)
+        assert response.status_code == 304
+        assert response.data == b''
+        assert response.headers['ETag'] == etag
+    assert dump.call_count == 1
+    assert json.loads(client.get('/api/v1/cache/stats').data)['hits'] == 0
+
+    client.post('/api/v1/readings', json={"timestamp": "2023-01-01T11:00:00"})
+    response = client.get('/api/v1/readings/list', headers={'If-None-Match': etag})
+
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert len(json.loads(response.data)['readings']) == 2
+
+def make_readings(count):
+    return [
+        EnvironmentalReading(
+            timestamp=datetime(2023, 1, 1, hour % 24),
+            weather=WeatherReading(datetime(2023, 1, 1, hour % 24), 20.0 + hour, 0.0, 1013.0, 5.0)
+        )
+        for hour in range(count)
+    ]
+
+def test_large_responses_are_compressed(client, mock_air_quality_service):
+    import gzip
+
+    mock_air_quality_service.return_value.fetch_and_store_air_quality_data.return_value = make_readings(200)
+    url = '/api/v1/fetch-data?start_date=2023-01-01T00:00:00&end_date=2023-01-02T00:00:00'
+
+    plain = client.get(url)
+    compressed = client.get(url, headers={'Accept-Encoding': 'gzip'})
+
+    assert 'Content-Encoding' not in plain.headers
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in compressed.headers['Vary']
+    assert gzip.decompress(compressed.data) == plain.data
+    assert len(compressed.data) * 5 < len(plain.data)
+
+    mock_air_quality_service.return_value.fetch_and_store_air_quality_data.return_value = make_readings(1)
+    assert 'Content-Encoding' not in client.get(url, headers={'Accept-Encoding': 'gzip'}).headers
+
+def test_brotli_is_preferred(client, mock_air_quality_service):
+    import brotli
+
+    mock_air_quality_service.return_value.get_paginated_readings.return_value = (make_readings(100), 100)
+    response = client.get('/api/v1/readings/list?per_page=100', headers={'Accept-Encoding': 'gzip, br'})
+
+    assert response.headers['Content-Encoding'] == 'br'
+    assert len(json.loads(brotli.decompress(response.data))['readings']) == 100
+
+def test_streamed_responses_are_not_compressed(client, mock_air_quality_service):
+    mock_air_quality_service.return_value.stream_air_quality_data.return_value = iter(make_readings(200))
+
+    with client.get('/api/v1/fetch-data?start_date=2023-01-01&end_date=2023-01-02&stream=1',
+                    headers={'Accept-Encoding': 'gzip'}) as response:
+        assert 'Content-Encoding' not in response.headers
+        assert len(response.data.splitlines()) == 200
+
+def test_columnar_and_msgpack_representations(client, mock_air_quality_service):
+    import msgpack
+
+    mock_air_quality_service.return_value.get_paginated_readings.return_value = (make_readings(3), 3)
+
+    columns = json.loads(client.get('/api/v1/readings/list?format=columns').data)['readings']
+    assert columns['timestamp'] == ['2023-01-01T00:00:00', '2023-01-01T01:00:00', '2023-01-01T02:00:00']
+    assert columns['temperature'] == [20.0, 21.0, 22.0]
+    assert columns['pm10'] == [None, None, None]
+
+    response = client.get('/api/v1/readings/list?format=columns', headers={'Accept': 'application/msgpack'})
+    assert response.mimetype == 'application/msgpack'
+    assert 'Accept' in response.headers['Vary']
+    assert msgpack.unpackb(response.data)['readings'] == columns
+
+    assert client.get('/api/v1/readings/list?format=xml').status_code == 400
+
+def test_scheduler_status(app, client, mocker):
+    assert json.loads(client.get('/api/v1/scheduler/status').data) == {"running": False, "locations": {}}
+
+    scheduler = mocker.MagicMock()
+    scheduler.status.return_value = {"running": True, "locations": {"default": {"runs": 3, "failures": 1}}}
+    app.extensions['refresh_scheduler'] = scheduler
+
+    response = client.get('/api/v1/scheduler/status')
+
+    assert response.status_code == 200
+    assert json.loads(response.data)["locations"]["default"]["failures"] == 1
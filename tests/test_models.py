@@ -0,0 +1,171 @@
+from api.models import EnvironmentalReading, WeatherReading, PollutantReading
+from datetime import datetime, timedelta
+import tracemalloc
+import timeit
+
+# dict-backed equivalents of the model classes, kept as the "before" side of the benchmark
+class DictWeatherReading:
+    def __init__(self, timestamp, temperature=None, precipitation=None, pressure=None, wind_speed=None):
+        self.timestamp = timestamp
+        self.temperature = temperature
+        self.precipitation = precipitation
+        self.pressure = pressure
+        self.wind_speed = wind_speed
+
+class DictPollutantReading:
+    def __init__(self, timestamp, pm10=None, pm2_5=None, carbon_monoxide=None,
+                 nitrogen_dioxide=None, sulphur_dioxide=None, ozone=None):
+        self.timestamp = timestamp
+        self.pm10 = pm10
+        self.pm2_5 = pm2_5
+        self.carbon_monoxide = carbon_monoxide
+        self.nitrogen_dioxide = nitrogen_dioxide
+        self.sulphur_dioxide = sulphur_dioxide
+        self.ozone = ozone
+
+class DictEnvironmentalReading:
+    def __init__(self, timestamp, weather=None, pollutants=None):
+        self.timestamp = timestamp
+        self.weather = weather
+        self.pollutants = pollutants
+
+BASE_TIME = datetime(2023, 1, 1)
+TIMESTAMPS = [BASE_TIME + timedelta(hours=i) for i in range(5000)]
+
+def build_readings(environmental_cls, weather_cls, pollutant_cls):
+    return [
+        environmental_cls(
+            timestamp=ts,
+            weather=weather_cls(timestamp=ts, temperature=20.0, precipitation=0.0, pressure=1013.0, wind_speed=5.0),
+            pollutants=pollutant_cls(timestamp=ts, pm10=15.0, pm2_5=8.0, carbon_monoxide=0.5,
+                                     nitrogen_dioxide=25.0, sulphur_dioxide=3.0, ozone=68.0)
+        )
+        for ts in TIMESTAMPS
+    ]
+
+def measure_bytes_per_reading(*classes):
+    tracemalloc.start()
+    readings = build_readings(*classes)
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return allocated / len(readings)
+
+def measure_seconds_per_reading(*classes):
+    seconds = min(timeit.repeat(lambda: build_readings(*classes), number=1, repeat=3))
+    return seconds / len(TIMESTAMPS)
+
+def test_slotted_models_have_no_instance_dict():
+    reading = build_readings(EnvironmentalReading, WeatherReading, PollutantReading)[0]
+
+    for obj in (reading, reading.weather, reading.pollutants):
+        assert not hasattr(obj, '__dict__')
+
+def test_slotted_models_keep_constructor_signatures():
+    timestamp = datetime(2023, 1, 1, 12, 0, 0)
+    weather = WeatherReading(timestamp, 20.0, 0.0, 1013.0, 5.0)
+    pollutants = PollutantReading(timestamp, 15.0, 8.0, 0.5, 25.0, 3.0, 68.0)
+    reading = EnvironmentalReading(timestamp, weather, pollutants)
+
+    assert reading.weather.wind_speed == 5.0
+    assert reading.pollutants.ozone == 68.0
+    assert EnvironmentalReading(timestamp).weather is None
+
+def test_benchmark_slotted_models_memory_and_construction():
+    dict_classes = (DictEnvironmentalReading, DictWeatherReading, DictPollutantReading)
+    slotted_classes = (EnvironmentalReading, WeatherReading, PollutantReading)
+
+    dict_bytes = measure_bytes_per_reading(*dict_classes)
+    slotted_bytes = measure_bytes_per_reading(*slotted_classes)
+    dict_seconds = measure_seconds_per_reading(*dict_classes)
+    slotted_seconds = measure_seconds_per_reading(*slotted_classes)
+
+    print(
+        f"\nper reading: dict {dict_bytes:.0f} B / {dict_seconds * 1e6:.2f} us, "
+        f"slots {slotted_bytes:.0f} B / {slotted_seconds * 1e6:.2f} us"
+    )
+
+    assert slotted_bytes < dict_bytes
+
+def test_fast_serialiser_matches_marshmallow():
+    from api.models import EnvironmentalReadingSchema
+    from api.serializers import dump_reading
+    from datetime import timezone
+    import json
+
+    schema = EnvironmentalReadingSchema()
+    timestamp = datetime(2023, 6, 1, 12, 30, 15, 250000, tzinfo=timezone(timedelta(hours=2)))
+    readings = build_readings(EnvironmentalReading, WeatherReading, PollutantReading)[:3] + [
+        EnvironmentalReading(timestamp),
+        EnvironmentalReading(timestamp, weather=WeatherReading(timestamp, temperature=21, pressure=None)),
+        EnvironmentalReading(timestamp, pollutants=PollutantReading(timestamp, pm10=0, ozone=12.5))
+    ]
+
+    for reading in readings:
+        assert json.dumps(dump_reading(reading)) == json.dumps(schema.dump(reading))
+
+def test_encoders_agree(monkeypatch):
+    from api import serializers
+    from api.serializers import dump_reading
+
+    data = {"readings": [dump_reading(r) for r in build_readings(EnvironmentalReading, WeatherReading, PollutantReading)[:50]]}
+    encoded = serializers.dumps(data)
+
+    monkeypatch.setattr(serializers, "orjson", None)
+    assert serializers.dumps(data) == encoded
+
+def test_benchmark_fast_serialiser():
+    from api.models import EnvironmentalReadingSchema
+    from api.serializers import dump_reading, dumps
+    import json
+
+    schema = EnvironmentalReadingSchema()
+    readings = build_readings(EnvironmentalReading, WeatherReading, PollutantReading) * 2
+
+    schema_seconds = min(timeit.repeat(
+        lambda: json.dumps({"readings": [schema.dump(r) for r in readings]}, sort_keys=True), number=1, repeat=3
+    ))
+    fast_seconds = min(timeit.repeat(
+        lambda: dumps({"readings": [dump_reading(r) for r in readings]}), number=1, repeat=3
+    ))
+
+    print(
+        f"\n{len(readings)} readings: marshmallow + json {schema_seconds * 1e3:.1f} ms, "
+        f"fast path {fast_seconds * 1e3:.1f} ms"
+    )
+
+    assert fast_seconds < schema_seconds
+
+def test_columns_hold_the_same_values_as_rows():
+    from api.serializers import dump_reading, dump_columns
+
+    readings = build_readings(EnvironmentalReading, WeatherReading, PollutantReading)[:20]
+    readings.append(EnvironmentalReading(datetime(2024, 1, 1)))
+    columns = dump_columns(readings)
+
+    for index, reading in enumerate(readings):
+        row = dump_reading(reading)
+        assert columns["timestamp"][index] == row["timestamp"]
+        for part in ("weather", "pollutants"):
+            for name, value in (row[part] or {}).items():
+                if name != "timestamp":
+                    assert columns[name][index] == value
+    assert all(len(column) == len(readings) for column in columns.values())
+
+def test_compact_encodings_shrink_bulk_payloads():
+    from api.serializers import dump_reading, dump_columns, encode, compress, MSGPACK_MIMETYPE
+
+    readings = build_readings(EnvironmentalReading, WeatherReading, PollutantReading)[:2000]
+    sizes = {
+        "rows": len(encode({"readings": [dump_reading(r) for r in readings]})),
+        "columns": len(encode({"readings": dump_columns(readings)}))
+    }
+    sizes["rows gzip"] = len(compress(encode({"readings": [dump_reading(r) for r in readings]}), "gzip"))
+    sizes["columns gzip"] = len(compress(encode({"readings": dump_columns(readings)}), "gzip"))
+
+    print("\n" + ", ".join(f"{name} {size / 1024:.0f} KiB" for name, size in sizes.items()))
+
+    assert sizes["columns"] * 2 < sizes["rows"]
+    assert sizes["columns gzip"] * 4 < sizes["columns"]
+
+    # MessagePack spends 9 bytes on every float, so it is smaller than the row JSON but not than short decimals
+    assert len(encode({"readings": dump_columns(readings)}, MSGPACK_MIMETYPE)) * 2 < sizes["rows"]
@@ -1,11 +1,17 @@
-from api.models import EnvironmentalReading, WeatherReading, PollutantReading
-from api.repository import InMemoryRepository
-from datetime import datetime, timedelta
+from api.models import EnvironmentalReading, WeatherReading, PollutantReading, ReadingColumns, POLLUTANT_FIELDS
+from api.repository import InMemoryRepository, ColumnarRepository, SQLiteRepository
+from datetime import date, datetime, timedelta, timezone
 import pytest
 
+@pytest.fixture(params=["memory", "columnar", "sqlite"])
+def repository_factory(request, tmp_path):
+    if request.param == "sqlite":
+        return lambda: SQLiteRepository(str(tmp_path / "readings.db"))
+    return {"memory": InMemoryRepository, "columnar": ColumnarRepository}[request.param]
+
 @pytest.fixture
-def repository():
-    repo = InMemoryRepository()
+def repository(repository_factory):
+    repo = repository_factory()
     
     base_time = datetime(2023, 1, 1, 12, 0, 0)
     
@@ -101,4 +107,566 @@ def test_get_paginated_readings(repository):
     readings_empty, total_empty = repository.get_paginated_readings(page=5, per_page=5)
     
     assert len(readings_empty) == 0
-    assert total_empty == 20
\ No newline at end of file
+    assert total_empty == 20
+
+def test_get_closest_reading_between_readings(repository):
+    target_time = datetime(2023, 1, 1, 15, 40, 0)
+    closest = repository.get_reading_closest_to_timestamp(target_time)
+
+    assert closest.timestamp == datetime(2023, 1, 1, 16, 0, 0)
+
+    before_first = repository.get_reading_closest_to_timestamp(datetime(2022, 12, 31))
+    after_last = repository.get_reading_closest_to_timestamp(datetime(2023, 1, 5))
+
+    assert before_first.timestamp == datetime(2023, 1, 1, 12, 0, 0)
+    assert after_last.timestamp == datetime(2023, 1, 2, 7, 0, 0)
+
+def test_get_closest_reading_tie_prefers_first_saved(repository_factory):
+    repo = repository_factory()
+    later = datetime(2023, 1, 1, 13, 0, 0)
+    earlier = datetime(2023, 1, 1, 12, 0, 0)
+
+    repo.save_reading(EnvironmentalReading(timestamp=later))
+    repo.save_reading(EnvironmentalReading(timestamp=earlier))
+
+    closest = repo.get_reading_closest_to_timestamp(datetime(2023, 1, 1, 12, 30, 0))
+
+    assert closest.timestamp == later
+
+def test_get_closest_reading_timezone_aware(repository_factory):
+    repo = repository_factory()
+    base_time = datetime(2023, 1, 1, 12, 0, 0, tzinfo=timezone.utc)
+
+    for i in (3, 0, 2, 1):
+        repo.save_reading(EnvironmentalReading(timestamp=base_time + timedelta(hours=i)))
+
+    target_time = datetime(2023, 1, 1, 15, 50, 0, tzinfo=timezone(timedelta(hours=2)))
+    closest = repo.get_reading_closest_to_timestamp(target_time)
+
+    assert closest.timestamp == base_time + timedelta(hours=2)
+
+def test_naive_and_aware_timestamps_are_ordered_as_utc(repository):
+    # upstream hours are stored naive, readings posted with a 'Z' suffix are aware
+    aware = datetime(2023, 1, 1, 15, 30, 0, tzinfo=timezone.utc)
+    repository.save_reading(EnvironmentalReading(timestamp=aware))
+    repository.save_reading(EnvironmentalReading(timestamp=datetime(2023, 1, 1, 16, 0, 0, tzinfo=timezone.utc)))
+
+    readings, total = repository.get_paginated_readings(page=1, per_page=50)
+    timestamps = [reading.timestamp for reading in readings]
+
+    assert total == 21
+    assert timestamps[:3] == [
+        datetime(2023, 1, 2, 7, 0, 0),
+        datetime(2023, 1, 2, 6, 0, 0),
+        datetime(2023, 1, 2, 5, 0, 0)
+    ]
+    assert timestamps.index(aware) == timestamps.index(datetime(2023, 1, 1, 15, 0, 0)) - 1
+    assert repository.get_reading_closest_to_timestamp(datetime(2023, 1, 1, 15, 40, 0)).timestamp == aware
+    assert [r.timestamp for r in repository.get_readings_before(aware, limit=1)] == [datetime(2023, 1, 1, 15, 0, 0)]
+
+def test_get_paginated_readings_last_partial_page(repository):
+    readings, total = repository.get_paginated_readings(page=3, per_page=8)
+
+    assert total == 20
+    assert [r.timestamp for r in readings] == [
+        datetime(2023, 1, 1, 15, 0, 0),
+        datetime(2023, 1, 1, 14, 0, 0),
+        datetime(2023, 1, 1, 13, 0, 0),
+        datetime(2023, 1, 1, 12, 0, 0)
+    ]
+
+def test_get_paginated_readings_out_of_order_inserts(repository_factory):
+    repo = repository_factory()
+    base_time = datetime(2023, 1, 1, 12, 0, 0)
+
+    for i in (5, 1, 3, 0, 4, 2):
+        repo.save_reading(EnvironmentalReading(timestamp=base_time + timedelta(hours=i)))
+
+    readings, total = repo.get_paginated_readings(page=1, per_page=4)
+
+    assert total == 6
+    assert [r.timestamp for r in readings] == [base_time + timedelta(hours=i) for i in (5, 4, 3, 2)]
+
+def test_get_readings_before(repository):
+    before = datetime(2023, 1, 1, 18, 0, 0)
+    readings = repository.get_readings_before(before, limit=3)
+
+    assert [r.timestamp for r in readings] == [
+        datetime(2023, 1, 1, 17, 0, 0),
+        datetime(2023, 1, 1, 16, 0, 0),
+        datetime(2023, 1, 1, 15, 0, 0)
+    ]
+
+    oldest = repository.get_readings_before(datetime(2023, 1, 1, 13, 30, 0), limit=5)
+
+    assert [r.timestamp for r in oldest] == [datetime(2023, 1, 1, 13, 0, 0), datetime(2023, 1, 1, 12, 0, 0)]
+    assert repository.get_readings_before(datetime(2023, 1, 1, 12, 0, 0), limit=5) == []
+
+def test_overwrite_reading_keeps_single_row(repository):
+    timestamp = datetime(2023, 1, 1, 14, 0, 0)
+    repository.save_reading(EnvironmentalReading(
+        timestamp=timestamp,
+        weather=None,
+        pollutants=PollutantReading(timestamp=timestamp, pm10=99.0)
+    ))
+
+    readings, total = repository.get_paginated_readings(page=1, per_page=50)
+    closest = repository.get_reading_closest_to_timestamp(timestamp)
+
+    assert total == 20
+    assert len(repository.get_all_readings()) == 20
+    assert closest.weather is None
+    assert closest.pollutants.pm10 == 99.0
+    assert closest.pollutants.ozone is None
+
+def test_columnar_repository_round_trip():
+    repo = ColumnarRepository()
+    timestamp = datetime(2023, 6, 1, 12, 0, 0, tzinfo=timezone(timedelta(hours=2)))
+
+    repo.save_reading(EnvironmentalReading(
+        timestamp=timestamp,
+        weather=WeatherReading(timestamp=timestamp, temperature=21.5, pressure=None),
+        pollutants=PollutantReading(timestamp=timestamp, pm10=0.0, pm2_5=7.25)
+    ))
+
+    reading = repo.get_all_readings()[0]
+
+    assert reading.timestamp == timestamp
+    assert reading.timestamp.utcoffset() == timedelta(hours=2)
+    assert reading.weather.timestamp == timestamp
+    assert reading.weather.temperature == 21.5
+    assert reading.weather.pressure is None
+    assert reading.pollutants.pm10 == 0.0
+    assert reading.pollutants.pm2_5 == 7.25
+    assert reading.pollutants.carbon_monoxide is None
+
+def test_columnar_repository_naive_timestamps_stay_naive():
+    repo = ColumnarRepository()
+    timestamp = datetime(2023, 1, 1, 12, 0, 0)
+
+    repo.save_reading(EnvironmentalReading(timestamp=timestamp))
+
+    reading = repo.get_reading_closest_to_timestamp(timestamp)
+
+    assert reading.timestamp == timestamp
+    assert reading.timestamp.tzinfo is None
+    assert reading.weather is None
+    assert reading.pollutants is None
+
+def make_columns(timestamps, pm10):
+    pollutants = {name: [None] * len(timestamps) for name in POLLUTANT_FIELDS}
+    pollutants["pm10"] = pm10
+    return ReadingColumns(timestamps=timestamps, weather=None, pollutants=pollutants)
+
+def test_save_columns_appends_newer_batch(repository):
+    base_time = datetime(2023, 1, 2, 8, 0, 0)
+    timestamps = [base_time + timedelta(hours=i) for i in range(3)]
+
+    repository.save_columns(make_columns(timestamps, [1.0, None, 3.0]))
+
+    readings, total = repository.get_paginated_readings(page=1, per_page=3)
+
+    assert total == 23
+    assert [r.timestamp for r in readings] == list(reversed(timestamps))
+    assert [r.pollutants.pm10 for r in readings] == [3.0, None, 1.0]
+    assert all(r.weather is None for r in readings)
+
+def test_save_columns_merges_overlapping_batch(repository):
+    base_time = datetime(2023, 1, 2, 6, 0, 0)
+    timestamps = [base_time + timedelta(hours=i) for i in range(3)]
+
+    repository.save_columns(make_columns(timestamps, [100.0, 101.0, 102.0]))
+
+    readings, total = repository.get_paginated_readings(page=1, per_page=4)
+
+    assert total == 21
+    assert [r.pollutants.pm10 for r in readings] == [102.0, 101.0, 100.0, 32.0]
+
+def test_readings_are_keyed_by_location(repository):
+    timestamp = datetime(2023, 1, 1, 12, 0, 0)
+    repository.save_reading(EnvironmentalReading(
+        timestamp=timestamp,
+        pollutants=PollutantReading(timestamp=timestamp, pm10=500.0)
+    ), "50.0647,19.9450")
+
+    default_reading = repository.get_reading_closest_to_timestamp(timestamp)
+    other_reading = repository.get_reading_closest_to_timestamp(timestamp, "50.0647,19.9450")
+
+    assert default_reading.pollutants.pm10 == 15.0
+    assert other_reading.pollutants.pm10 == 500.0
+    assert repository.get_paginated_readings(1, 10, "50.0647,19.9450")[1] == 1
+    assert repository.get_paginated_readings(1, 10)[1] == 20
+    assert len(repository.get_all_readings("50.0647,19.9450")) == 1
+    assert sorted(repository.get_locations()) == ["50.0647,19.9450", "default"]
+
+def test_unknown_location_is_empty(repository):
+    assert repository.get_reading_closest_to_timestamp(datetime(2023, 1, 1), "0.0000,0.0000") is None
+    assert repository.get_paginated_readings(1, 10, "0.0000,0.0000") == ([], 0)
+    assert repository.get_readings_before(datetime(2023, 1, 2), 10, "0.0000,0.0000") == []
+    assert repository.get_all_readings("0.0000,0.0000") == []
+
+def test_interval_set_merges_and_reports_gaps():
+    from api.coverage import IntervalSet
+    intervals = IntervalSet()
+
+    intervals.add(10, 20)
+    intervals.add(30, 40)
+    intervals.add(20, 25)
+    intervals.add(5, 8)
+
+    assert intervals.intervals() == [(5, 8), (10, 25), (30, 40)]
+    assert intervals.missing(0, 50) == [(0, 5), (8, 10), (25, 30), (40, 50)]
+    assert intervals.missing(12, 24) == []
+    assert intervals.missing(22, 33) == [(25, 30)]
+
+    intervals.add(7, 35)
+
+    assert intervals.intervals() == [(5, 40)]
+
+def test_coverage_tracks_days_per_location(repository):
+    repository.mark_covered(date(2023, 1, 1), date(2023, 1, 5))
+    repository.mark_covered(date(2023, 1, 10), date(2023, 1, 12))
+
+    assert repository.get_missing_ranges(date(2023, 1, 1), date(2023, 1, 12)) == [(date(2023, 1, 6), date(2023, 1, 9))]
+    assert repository.get_missing_ranges(date(2023, 1, 2), date(2023, 1, 4)) == []
+    assert repository.get_missing_ranges(date(2023, 1, 1), date(2023, 1, 2), "50.0647,19.9450") == [
+        (date(2023, 1, 1), date(2023, 1, 2))
+    ]
+
+def test_get_readings_in_range(repository):
+    readings = repository.get_readings_in_range(datetime(2023, 1, 1, 14, 0, 0), datetime(2023, 1, 1, 17, 0, 0))
+
+    assert [r.timestamp.hour for r in readings] == [14, 15, 16]
+
+def test_version_changes_only_for_written_location(repository):
+    timestamp = datetime(2023, 2, 1, 12, 0, 0)
+    default_version = repository.get_version()
+    other_version = repository.get_version("50.0647,19.9450")
+
+    repository.save_reading(EnvironmentalReading(
+        timestamp=timestamp,
+        pollutants=PollutantReading(timestamp=timestamp, pm10=5.0)
+    ), "50.0647,19.9450")
+
+    assert repository.get_version() == default_version
+    assert repository.get_version("50.0647,19.9450") > other_version
+
+def test_concurrent_reads_and_writes(repository_factory):
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+
+    repo = repository_factory()
+    base_time = datetime(2023, 1, 1)
+    locations = ["default", "50.0647,19.9450"]
+    writers, per_writer = 4, 200
+    done = threading.Event()
+
+    def write(worker):
+        for i in range(per_writer):
+            # writers interleave, so most saves land in the middle of the index rather than at its end
+            timestamp = base_time + timedelta(minutes=i * writers + worker)
+            repo.save_reading(EnvironmentalReading(
+                timestamp=timestamp,
+                pollutants=PollutantReading(timestamp=timestamp, pm10=float(i))
+            ), locations[i % 2])
+            if i % 50 == 0:
+                repo.mark_covered(timestamp.date(), timestamp.date(), locations[i % 2])
+
+    def read(location):
+        checks = 0
+        while not done.is_set() or checks == 0:
+            page, total = repo.get_paginated_readings(1, 20, location)
+            assert len(page) == min(total, 20)
+            assert [r.timestamp for r in page] == sorted((r.timestamp for r in page), reverse=True)
+
+            in_range = repo.get_readings_in_range(base_time, base_time + timedelta(hours=1), location)
+            assert [r.timestamp for r in in_range] == sorted(r.timestamp for r in in_range)
+
+            repo.get_reading_closest_to_timestamp(base_time + timedelta(hours=3), location)
+            repo.get_readings_before(base_time + timedelta(hours=6), 10, location)
+            repo.get_missing_ranges(base_time.date(), base_time.date(), location)
+            checks += 1
+        return checks
+
+    with ThreadPoolExecutor(max_workers=writers + 4) as executor:
+        readers = [executor.submit(read, locations[i % 2]) for i in range(4)]
+        for future in [executor.submit(write, worker) for worker in range(writers)]:
+            future.result()
+        done.set()
+        assert all(reader.result() > 0 for reader in readers)
+
+    for location in locations:
+        readings, total = repo.get_paginated_readings(1, 1000, location)
+        assert total == writers * per_writer // 2
+        assert len(repo.get_all_readings(location)) == total
+        assert len({r.timestamp for r in readings}) == total
+        assert [r.timestamp for r in readings] == sorted((r.timestamp for r in readings), reverse=True)
+
+def test_save_readings_is_one_write(repository):
+    version = repository.get_version("50.0647,19.9450")
+    timestamps = [datetime(2023, 3, 1, hour) for hour in (5, 1, 3)]
+
+    repository.save_readings([
+        EnvironmentalReading(timestamp=ts, pollutants=PollutantReading(timestamp=ts, pm10=float(ts.hour)))
+        for ts in timestamps
+    ], "50.0647,19.9450")
+
+    readings = repository.get_readings_in_range(datetime(2023, 3, 1), datetime(2023, 3, 2), "50.0647,19.9450")
+    assert [r.pollutants.pm10 for r in readings] == [1.0, 3.0, 5.0]
+    assert repository.get_version("50.0647,19.9450") > version
+
+def test_sqlite_repository_survives_restart(tmp_path):
+    path = str(tmp_path / "readings.db")
+    timestamp = datetime(2023, 1, 1, 12, 0, 0, 500000)
+
+    first = SQLiteRepository(path)
+    first.save_reading(EnvironmentalReading(
+        timestamp=timestamp,
+        pollutants=PollutantReading(timestamp=timestamp, pm10=42.0)
+    ), "50.0647,19.9450")
+    first.mark_covered(timestamp.date(), timestamp.date(), "50.0647,19.9450")
+    first.close()
+
+    second = SQLiteRepository(path)
+    reading = second.get_reading_closest_to_timestamp(timestamp, "50.0647,19.9450")
+
+    assert reading.timestamp == timestamp
+    assert reading.pollutants.pm10 == 42.0
+    assert reading.weather is None
+    assert second.get_missing_ranges(timestamp.date(), timestamp.date(), "50.0647,19.9450") == []
+    assert second.get_version("50.0647,19.9450") == 1
+
+def test_sqlite_repository_uses_wal_and_the_time_index(tmp_path):
+    repo = SQLiteRepository(str(tmp_path / "readings.db"))
+    connection = repo._connection()
+
+    assert connection.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+    plan = " ".join(row[-1] for row in connection.execute(
+        "EXPLAIN QUERY PLAN SELECT * FROM readings WHERE location = ? AND epoch_us < ? ORDER BY epoch_us DESC LIMIT 10",
+        ("default", 0)
+    ))
+    assert "PRIMARY KEY" in plan
+    assert "TEMP B-TREE" not in plan
+
+def test_get_readings_in_range_with_limit(repository):
+    readings = repository.get_readings_in_range(datetime(2023, 1, 1, 14, 0, 0), datetime(2023, 1, 2), limit=3)
+
+    assert [r.timestamp.hour for r in readings] == [14, 15, 16]
+
+def test_daily_rollups_follow_writes(repository):
+    # the fixture covers 12:00 on Jan 1 through 07:00 on Jan 2, pm10 rising from 15 to 34
+    days = repository.get_daily_rollups(datetime(2023, 1, 1), datetime(2023, 1, 3), fields=["pm10", "temperature"])
+
+    assert [day["start"] for day in days] == ["2023-01-01T00:00:00", "2023-01-02T00:00:00"]
+    assert days[0]["fields"]["pm10"] == {"count": 12, "min": 15.0, "max": 26.0, "mean": 20.5}
+    assert days[1]["fields"]["pm10"] == {"count": 8, "min": 27.0, "max": 34.0, "mean": 30.5}
+    assert days[1]["fields"]["temperature"]["max"] == 39.0
+
+    # an overwrite replaces the old value in its day instead of adding to it
+    timestamp = datetime(2023, 1, 2, 7, 0, 0)
+    repository.save_reading(EnvironmentalReading(
+        timestamp=timestamp,
+        pollutants=PollutantReading(timestamp=timestamp, pm10=100.0)
+    ))
+    repository.save_columns(make_columns([datetime(2023, 1, 2, 23, 0, 0)], [1.0]))
+
+    days = repository.get_daily_rollups(datetime(2023, 1, 2), datetime(2023, 1, 3), fields=["pm10", "temperature"])
+
+    assert days[0]["fields"]["pm10"] == {"count": 9, "min": 1.0, "max": 100.0, "mean": (27 + 28 + 29 + 30 + 31 + 32 + 33 + 100 + 1) / 9}
+    assert days[0]["fields"]["temperature"]["max"] == 38.0
+
+def test_weekly_rollups_merge_days_and_percentiles(repository):
+    weeks = repository.get_daily_rollups(
+        datetime(2023, 1, 1), datetime(2023, 1, 2), bucket_days=7, fields=["pm10"], percentiles=[0, 50, 100]
+    )
+
+    # 2023-01-01 is a Sunday, so the week bucket is the one starting on Monday 2022-12-26
+    assert [(week["start"], week["end"]) for week in weeks] == [("2022-12-26T00:00:00", "2023-01-02T00:00:00")]
+    stats = weeks[0]["fields"]["pm10"]
+    assert stats["count"] == 12
+    assert (stats["p0"], stats["p50"], stats["p100"]) == (15.0, 20.5, 26.0)
+
+def test_rollups_rebuild_a_day_whose_extremes_were_overwritten(repository):
+    # 12:00 on Jan 1 holds the day's lowest pm10 (15) and 23:00 its highest (26)
+    for hour, pm10 in ((12, 20.0), (23, 21.0)):
+        timestamp = datetime(2023, 1, 1, hour, 0, 0)
+        repository.save_reading(EnvironmentalReading(
+            timestamp=timestamp,
+            pollutants=PollutantReading(timestamp=timestamp, pm10=pm10)
+        ))
+
+    days = repository.get_daily_rollups(
+        datetime(2023, 1, 1), datetime(2023, 1, 2), fields=["pm10"], percentiles=[0, 100]
+    )
+
+    stats = days[0]["fields"]["pm10"]
+    assert (stats["count"], stats["min"], stats["max"]) == (12, 16.0, 25.0)
+    assert (stats["p0"], stats["p100"]) == (16.0, 25.0)
+    assert stats["mean"] == pytest.approx((sum(range(16, 26)) + 20 + 21) / 12)
+
+def test_sqlite_rollups_see_other_writers(tmp_path):
+    path = str(tmp_path / "readings.db")
+    first, second = SQLiteRepository(path), SQLiteRepository(path)
+    timestamp = datetime(2023, 1, 1, 12, 0, 0)
+
+    first.save_reading(EnvironmentalReading(timestamp=timestamp, pollutants=PollutantReading(timestamp=timestamp, pm10=10.0)))
+    assert first.get_daily_rollups(datetime(2023, 1, 1), datetime(2023, 1, 2))[0]["fields"]["pm10"]["mean"] == 10.0
+
+    second.save_reading(EnvironmentalReading(timestamp=timestamp, pollutants=PollutantReading(timestamp=timestamp, pm10=30.0)))
+    first.save_reading(EnvironmentalReading(
+        timestamp=timestamp + timedelta(hours=1),
+        pollutants=PollutantReading(timestamp=timestamp, pm10=20.0)
+    ))
+
+    stats = first.get_daily_rollups(datetime(2023, 1, 1), datetime(2023, 1, 2))[0]["fields"]["pm10"]
+    assert (stats["count"], stats["mean"]) == (2, 25.0)
+
+def test_sqlite_writes_commit_without_waiting_on_index_queries(tmp_path):
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+
+    repo = SQLiteRepository(str(tmp_path / "readings.db"))
+    timestamp = datetime(2023, 1, 1, 12, 0, 0)
+
+    def reading(hour, pm10):
+        at = timestamp + timedelta(hours=hour)
+        return EnvironmentalReading(timestamp=at, pollutants=PollutantReading(timestamp=at, pm10=pm10))
+
+    repo.save_reading(reading(0, 10.0), "a")
+    repo.save_reading(reading(0, 10.0), "b")
+    assert repo.get_daily_rollups(datetime(2023, 1, 1), datetime(2023, 1, 2), location="a")
+
+    # an index query on "a" holds its lock: a write to "b" is not held up, and one to "a" is committed first
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        with repo._index_locks.write("a"):
+            repo.save_reading(reading(1, 30.0), "b")
+            pending = executor.submit(repo.save_reading, reading(1, 20.0), "a")
+            deadline = threading.Event()
+            for _ in range(500):
+                if len(repo.get_all_readings("a")) == 2:
+                    break
+                deadline.wait(0.01)
+            assert len(repo.get_all_readings("a")) == 2
+            assert not pending.done()
+        pending.result()
+
+    stats = repo.get_daily_rollups(datetime(2023, 1, 1), datetime(2023, 1, 2), location="a")[0]["fields"]["pm10"]
+    assert (stats["count"], stats["mean"]) == (2, 15.0)
+    assert repo.get_daily_rollups(datetime(2023, 1, 1), datetime(2023, 1, 2), location="b")[0]["fields"]["pm10"]["count"] == 2
+    assert repo.get_daily_rollups(datetime(2023, 1, 1), datetime(2023, 1, 2), location="c") == []
+    assert "c" not in repo._index_locks._locks
+
+def test_range_stats_match_a_scan(repository):
+    def scan(start, end, name):
+        values = [
+            getattr(r.weather if name == "temperature" else r.pollutants, name)
+            for r in repository.get_readings_in_range(start, end)
+        ]
+        return {"count": len(values), "min": min(values), "max": max(values), "mean": sum(values) / len(values)}
+
+    base_time = datetime(2023, 1, 1, 12, 0, 0)
+    for lo, hi in [(0, 20), (3, 4), (5, 17), (0, 1), (19, 20)]:
+        start, end = base_time + timedelta(hours=lo), base_time + timedelta(hours=hi)
+        stats = repository.get_range_stats(start, end, fields=["pm10", "temperature"])
+        assert stats == {"pm10": scan(start, end, "pm10"), "temperature": scan(start, end, "temperature")}
+
+    assert repository.get_range_stats(datetime(2024, 1, 1), datetime(2024, 2, 1)) == {}
+
+def test_range_stats_follow_appends_overwrites_and_bulk_loads(repository):
+    def pm10(hour, value):
+        timestamp = datetime(2023, 1, 2, hour, 0, 0)
+        return EnvironmentalReading(timestamp=timestamp, pollutants=PollutantReading(timestamp=timestamp, pm10=value))
+
+    start, end = datetime(2023, 1, 1), datetime(2023, 1, 3)
+    assert repository.get_range_stats(start, end, fields=["pm10"])["pm10"]["max"] == 34.0
+
+    # appended past the newest row, then overwriting it, then a bulk load in the middle of the index
+    repository.save_reading(pm10(9, 50.0))
+    assert repository.get_range_stats(start, end, fields=["pm10"])["pm10"]["max"] == 50.0
+
+    repository.save_reading(pm10(9, 1.0))
+    stats = repository.get_range_stats(start, end, fields=["pm10"])["pm10"]
+    assert (stats["count"], stats["min"], stats["max"]) == (21, 1.0, 34.0)
+
+    repository.save_readings([pm10(8, 60.0), pm10(3, 0.5)])
+    stats = repository.get_range_stats(start, end, fields=["pm10", "ozone"])
+    assert (stats["pm10"]["count"], stats["pm10"]["min"], stats["pm10"]["max"]) == (22, 0.5, 60.0)
+    # the overwrite at 03:00 carried no ozone, so that row no longer counts for it
+    assert stats["ozone"]["count"] == 19
+
+def test_field_tree_appends_across_capacity():
+    from api.aggregation import _FieldTree
+
+    values = [None, 3.0, 1.0]
+    tree = _FieldTree(values)
+    for value in [4.0, None, 1.5, 9.0, 2.0, 6.0, 5.0, None, 3.5]:
+        tree.append(value)
+        values.append(value)
+
+    for lo in range(len(values)):
+        for hi in range(lo + 1, len(values) + 1):
+            present = [value for value in values[lo:hi] if value is not None]
+            expected = {"count": len(present), "min": min(present), "max": max(present),
+                        "mean": sum(present) / len(present)} if present else None
+            result = tree.query(lo, hi)
+            if expected is None:
+                assert result is None
+            else:
+                assert result == pytest.approx(expected)
+
+def test_last_modified_follows_writes(repository):
+    before = repository.get_last_modified("50.0647,19.9450")
+    timestamp = datetime(2023, 3, 1)
+
+    repository.save_reading(EnvironmentalReading(timestamp=timestamp), "50.0647,19.9450")
+    modified = repository.get_last_modified("50.0647,19.9450")
+
+    assert before is None
+    assert modified.tzinfo is not None
+    assert repository.get_last_modified() >= datetime(2023, 1, 1, tzinfo=modified.tzinfo)
+
+def test_sqlite_repository_adds_modified_column_to_old_files(tmp_path):
+    import sqlite3
+
+    path = str(tmp_path / "readings.db")
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE versions (location TEXT PRIMARY KEY, version INTEGER NOT NULL) WITHOUT ROWID")
+    connection.execute("INSERT INTO versions VALUES ('default', 3)")
+    connection.commit()
+    connection.close()
+
+    repo = SQLiteRepository(path)
+    assert repo.get_version() == 3
+    assert repo.get_last_modified() is None
+
+    repo.save_reading(EnvironmentalReading(timestamp=datetime(2023, 1, 1)))
+    assert repo.get_version() == 4
+    assert repo.get_last_modified() is not None
+
+@pytest.mark.parametrize("repository_class", [InMemoryRepository, ColumnarRepository])
+def test_reads_of_unknown_locations_do_not_create_locks(repository_class):
+    repo = repository_class()
+    timestamp = datetime(2023, 1, 1, 12, 0, 0)
+
+    for i in range(50):
+        location = f"{50 + i / 100:.4f},19.9450"
+        assert repo.get_all_readings(location) == []
+        assert repo.get_paginated_readings(1, 10, location) == ([], 0)
+        assert repo.get_reading_closest_to_timestamp(timestamp, location) is None
+        assert repo.get_readings_in_range(timestamp, timestamp + timedelta(days=1), location) == []
+        assert repo.get_daily_rollups(timestamp, timestamp + timedelta(days=1), location=location) == []
+        assert repo.get_range_stats(timestamp, timestamp + timedelta(days=1), location) == {}
+        assert repo.get_missing_ranges(date(2023, 1, 1), date(2023, 1, 2), location) == [
+            (date(2023, 1, 1), date(2023, 1, 2))
+        ]
+
+    assert len(repo._locks) == 0
+
+    repo.save_reading(EnvironmentalReading(
+        timestamp=timestamp,
+        pollutants=PollutantReading(timestamp=timestamp, pm10=5.0)
+    ), "50.0647,19.9450")
+
+    assert len(repo._locks) == 1
+    assert len(repo.get_all_readings("50.0647,19.9450")) == 1
@@ -1,12 +1,18 @@
-from api.models import EnvironmentalReading, WeatherReading, PollutantReading
-from api.services import AirQualityService, ValidationService
-from datetime import datetime
+from api.models import EnvironmentalReading, WeatherReading, PollutantReading, DEFAULT_LOCATION
+from api.services import AirQualityService, AsyncAirQualityService, ValidationService
+from api.repository import InMemoryRepository
+from api.aggregation import aggregate_readings
+from datetime import datetime, timedelta, timezone
+import asyncio
 import pytest
 
 # This decorator essentially allows the function to run before the test and get data from that function
 @pytest.fixture
 def mock_repository(mocker):
-    return mocker.Mock()
+    repository = mocker.Mock()
+    # an empty store: every requested day is missing
+    repository.get_missing_ranges.side_effect = lambda start, end, location: [(start, end)]
+    return repository
 
 @pytest.fixture
 def mock_client(mocker):
@@ -34,7 +40,7 @@ def test_get_reading_closest_to_timestamp(air_quality_service, mock_repository):
     result = air_quality_service.get_reading_closest_to_timestamp(timestamp)
 
     assert result is expected_reading
-    mock_repository.get_reading_closest_to_timestamp.assert_called_once_with(timestamp)
+    mock_repository.get_reading_closest_to_timestamp.assert_called_once_with(timestamp, DEFAULT_LOCATION)
 
 def test_save_reading(air_quality_service, mock_repository):
     timestamp = datetime(2023, 1, 1, 12, 0, 0)
@@ -51,7 +57,7 @@ def test_save_reading(air_quality_service, mock_repository):
     )
 
     air_quality_service.save_reading(reading)
-    mock_repository.save_reading.assert_called_once_with(reading)
+    mock_repository.save_reading.assert_called_once_with(reading, DEFAULT_LOCATION)
 
 def test_get_paginated_readings(air_quality_service, mock_repository):
     timestamp = datetime(2023, 1, 1, 12, 0, 0)
@@ -74,7 +80,7 @@ def test_get_paginated_readings(air_quality_service, mock_repository):
 
     assert result_readings == readings
     assert result_total == 1
-    mock_repository.get_paginated_readings.assert_called_once_with(1, 10)
+    mock_repository.get_paginated_readings.assert_called_once_with(1, 10, DEFAULT_LOCATION)
 
 def test_fetch_and_store_air_quality_data(air_quality_service, mock_repository, mock_client):
     start_date = datetime(2023, 1, 1)
@@ -100,7 +106,101 @@ def test_fetch_and_store_air_quality_data(air_quality_service, mock_repository,
     assert readings[0].timestamp == datetime(2023, 1, 1, 12, 0, 0, tzinfo=timezone.utc)
     assert readings[0].pollutants.pm10 == 15.0
     mock_client.get_air_quality_data.assert_called_once_with(start_date, end_date)
-    assert mock_repository.save_reading.call_count == 1
+    mock_repository.save_columns.assert_called_once()
+    assert len(mock_repository.save_columns.call_args[0][0]) == 1
+
+def test_fetch_and_store_for_locations(air_quality_service, mock_repository, mock_client):
+    start_date = datetime(2023, 1, 1)
+    end_date = datetime(2023, 1, 2)
+    mock_client.get_air_quality_data_for_locations.return_value = [
+        {"hourly": {"time": ["2023-01-01T12:00"], "pm10": [10.0]}},
+        {"hourly": {"time": ["2023-01-01T12:00"], "pm10": [20.0]}}
+    ]
+
+    stored = air_quality_service.fetch_and_store_for_locations(
+        start_date, end_date, ["52.2297,21.0122", "50.0647,19.9450"]
+    )
+
+    mock_client.get_air_quality_data_for_locations.assert_called_once_with(
+        [(52.2297, 21.0122), (50.0647, 19.945)], start_date, end_date
+    )
+    saved = {call.args[1]: call.args[0] for call in mock_repository.save_columns.call_args_list}
+    assert saved["52.2297,21.0122"].pollutants["pm10"] == [10.0]
+    assert saved["50.0647,19.9450"].pollutants["pm10"] == [20.0]
+    assert set(stored) == {"52.2297,21.0122", "50.0647,19.9450"}
+    mock_repository.get_readings_in_range.assert_called_with(
+        datetime(2023, 1, 1), datetime(2023, 1, 3), "50.0647,19.9450"
+    )
+
+def test_fetch_and_store_single_explicit_location(air_quality_service, mock_repository, mock_client):
+    mock_client.get_air_quality_data_for_locations.return_value = [
+        {"hourly": {"time": ["2023-01-01T12:00"], "pm10": [10.0]}}
+    ]
+
+    readings = air_quality_service.fetch_and_store_air_quality_data(
+        datetime(2023, 1, 1), datetime(2023, 1, 2), "50.0647,19.9450"
+    )
+
+    assert readings[0].pollutants.pm10 == 10.0
+    mock_client.get_air_quality_data.assert_not_called()
+    assert mock_repository.save_columns.call_args.args[1] == "50.0647,19.9450"
+
+def test_transform_api_data_regular_time_axis(air_quality_service):
+    api_data = {
+        "hourly": {
+            "time": ["2023-01-01T00:00", "2023-01-01T01:00", "2023-01-01T02:00", "2023-01-01T03:00"],
+            "pm10": [1.0, 2.0, 3.0, 4.0],
+            "ozone": [5.0, 6.0, 7.0, 8.0, 9.0]
+        }
+    }
+
+    readings = air_quality_service._transform_api_data(api_data)
+
+    assert [r.timestamp for r in readings] == [datetime(2023, 1, 1, hour) for hour in range(4)]
+    assert [r.pollutants.pm10 for r in readings] == [1.0, 2.0, 3.0, 4.0]
+    assert [r.pollutants.ozone for r in readings] == [5.0, 6.0, 7.0, 8.0]
+    assert all(r.pollutants.pm2_5 is None for r in readings)
+    assert all(r.weather is not None and r.weather.temperature is None for r in readings)
+
+def test_transform_api_data_ragged_and_irregular(air_quality_service):
+    api_data = {
+        "hourly": {
+            "time": ["2023-01-01T00:00Z", "2023-01-01T01:00Z", "2023-01-01T03:00Z", "2023-01-01T04:00Z"],
+            "pm10": [1.0, 2.0],
+            "pm2_5": [None, 0.5, 0.7, 0.9]
+        }
+    }
+
+    readings = air_quality_service._transform_api_data(api_data)
+
+    assert [r.timestamp for r in readings] == [
+        datetime(2023, 1, 1, hour, tzinfo=timezone.utc) for hour in (0, 1, 3, 4)
+    ]
+    assert [r.pollutants.pm10 for r in readings] == [1.0, 2.0, None, None]
+    assert [r.pollutants.pm2_5 for r in readings] == [None, 0.5, 0.7, 0.9]
+    assert readings[2].pollutants.timestamp == readings[2].timestamp
+
+def test_transform_api_data_empty(air_quality_service):
+    assert air_quality_service._transform_api_data({}) == []
+
+def test_async_fetch_and_store_air_quality_data(mock_repository, mocker):
+    mock_async_client = mocker.Mock()
+    mock_async_client.get_air_quality_data = mocker.AsyncMock(return_value={
+        "hourly": {
+            "time": ["2023-01-01T12:00", "2023-01-01T13:00"],
+            "pm10": [15.0, 16.0]
+        }
+    })
+    service = AsyncAirQualityService(mock_repository, mock_async_client)
+    start_date = datetime(2023, 1, 1)
+    end_date = datetime(2023, 1, 2)
+
+    readings = asyncio.run(service.fetch_and_store_air_quality_data(start_date, end_date))
+
+    assert [r.pollutants.pm10 for r in readings] == [15.0, 16.0]
+    assert readings[1].timestamp == datetime(2023, 1, 1, 13, 0, 0)
+    mock_async_client.get_air_quality_data.assert_awaited_once_with(start_date, end_date)
+    mock_repository.save_columns.assert_called_once()
 
 def test_validation_service():
     validation_service = ValidationService()
@@ -165,4 +265,312 @@ def test_validation_service():
     assert validation_service.validate_reading(valid_reading) is True
     assert validation_service.validate_reading(invalid_temp_reading) is False
     assert validation_service.validate_reading(invalid_pressure_reading) is False
-    assert validation_service.validate_reading(invalid_wind_reading) is False
\ No newline at end of file
+    assert validation_service.validate_reading(invalid_wind_reading) is False
+
+def hourly_payload(start_date, end_date):
+    first_day = datetime(start_date.year, start_date.month, start_date.day)
+    hours = int(((end_date - start_date).days + 1) * 24)
+    return {
+        "hourly": {
+            "time": [(first_day + timedelta(hours=i)).strftime("%Y-%m-%dT%H:%M") for i in range(hours)],
+            "pm10": [float(i) for i in range(hours)]
+        }
+    }
+
+@pytest.fixture
+def gap_aware_service(mock_client):
+    mock_client.get_air_quality_data.side_effect = hourly_payload
+    return AirQualityService(InMemoryRepository(), mock_client)
+
+def test_fetch_only_requests_missing_days(gap_aware_service, mock_client):
+    gap_aware_service.fetch_and_store_air_quality_data(datetime(2023, 1, 1), datetime(2023, 1, 5))
+    readings = gap_aware_service.fetch_and_store_air_quality_data(datetime(2023, 1, 3), datetime(2023, 1, 8))
+
+    assert mock_client.get_air_quality_data.call_args_list[1].args == (datetime(2023, 1, 6), datetime(2023, 1, 8))
+    assert len(readings) == 6 * 24
+    assert readings[0].timestamp == datetime(2023, 1, 3)
+    assert readings[-1].timestamp == datetime(2023, 1, 8, 23)
+
+def test_fetch_returns_the_stored_readings(gap_aware_service):
+    readings = gap_aware_service.fetch_and_store_air_quality_data(datetime(2023, 1, 1), datetime(2023, 1, 2))
+
+    # the memory backend keeps reading objects, so the response reuses them instead of building a second set
+    assert all(a is b for a, b in zip(readings, gap_aware_service.repository.get_all_readings()))
+    assert len(readings) == 2 * 24
+
+def test_fetch_of_covered_range_skips_upstream(gap_aware_service, mock_client):
+    gap_aware_service.fetch_and_store_air_quality_data(datetime(2023, 1, 1), datetime(2023, 1, 5))
+    readings = gap_aware_service.fetch_and_store_air_quality_data(datetime(2023, 1, 2), datetime(2023, 1, 4))
+
+    assert mock_client.get_air_quality_data.call_count == 1
+    assert len(readings) == 3 * 24
+
+def test_fetch_fills_interior_gap_only(gap_aware_service, mock_client):
+    gap_aware_service.fetch_and_store_air_quality_data(datetime(2023, 1, 1), datetime(2023, 1, 2))
+    gap_aware_service.fetch_and_store_air_quality_data(datetime(2023, 1, 6), datetime(2023, 1, 7))
+    gap_aware_service.fetch_and_store_air_quality_data(datetime(2023, 1, 1), datetime(2023, 1, 7))
+
+    assert mock_client.get_air_quality_data.call_args_list[2].args == (datetime(2023, 1, 3), datetime(2023, 1, 5))
+
+def test_refresh_and_recent_days_always_refetch(gap_aware_service, mock_client):
+    gap_aware_service.fetch_and_store_air_quality_data(datetime(2023, 1, 1), datetime(2023, 1, 2))
+    gap_aware_service.fetch_and_store_air_quality_data(datetime(2023, 1, 1), datetime(2023, 1, 2), refresh=True)
+
+    today = datetime.now(timezone.utc).replace(tzinfo=None, hour=0, minute=0, second=0, microsecond=0)
+    gap_aware_service.fetch_and_store_air_quality_data(today, today)
+    gap_aware_service.fetch_and_store_air_quality_data(today, today)
+
+    assert mock_client.get_air_quality_data.call_count == 4
+
+def test_concurrent_identical_fetches_share_one_upstream_call(mock_client):
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+
+    release = threading.Event()
+
+    def slow_payload(start_date, end_date):
+        release.wait(timeout=5)
+        return hourly_payload(start_date, end_date)
+
+    mock_client.get_air_quality_data.side_effect = slow_payload
+    service = AirQualityService(InMemoryRepository(), mock_client)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = [
+            executor.submit(service.fetch_and_store_air_quality_data, datetime(2023, 1, 1), datetime(2023, 1, 2))
+            for _ in range(8)
+        ]
+        while service._flights.coalesced < 7:
+            threading.Event().wait(0.01)
+        release.set()
+        results = [future.result() for future in futures]
+
+    assert mock_client.get_air_quality_data.call_count == 1
+    assert all(len(readings) == 48 for readings in results)
+
+def test_stream_fetches_one_window_at_a_time(gap_aware_service, mock_client):
+    mock_client.chunk_days = 7
+
+    stream = gap_aware_service.stream_air_quality_data(datetime(2023, 1, 1), datetime(2023, 1, 20))
+    first = next(stream)
+
+    assert first.timestamp == datetime(2023, 1, 1)
+    assert mock_client.get_air_quality_data.call_count == 1
+
+    rest = list(stream)
+
+    assert [call.args for call in mock_client.get_air_quality_data.call_args_list] == [
+        (datetime(2023, 1, 1), datetime(2023, 1, 7)),
+        (datetime(2023, 1, 8), datetime(2023, 1, 14)),
+        (datetime(2023, 1, 15), datetime(2023, 1, 20))
+    ]
+    assert len(rest) + 1 == 20 * 24
+    assert rest[-1].timestamp == datetime(2023, 1, 20, 23)
+
+def test_batch_validators_follow_the_bounds_table():
+    from api.models import FIELD_BOUNDS, ReadingColumns, EnvironmentalReadingSchema, WEATHER_FIELDS, POLLUTANT_FIELDS
+    from marshmallow import ValidationError
+
+    validation_service = ValidationService()
+    schema = EnvironmentalReadingSchema()
+    timestamp = datetime(2023, 1, 1)
+
+    for name, (minimum, maximum, message) in FIELD_BOUNDS.items():
+        part_class, part_name = (WeatherReading, "weather") if name in WEATHER_FIELDS else (PollutantReading, "pollutants")
+        edges = [(value, True) for value in (minimum, maximum) if value is not None]
+        edges += [(minimum - 1, False)] if minimum is not None else []
+        edges += [(maximum + 1, False)] if maximum is not None else []
+
+        readings = [
+            EnvironmentalReading(timestamp, **{part_name: part_class(timestamp, **{name: value})})
+            for value, _ in edges
+        ]
+        expected = [valid for _, valid in edges]
+        columns = ReadingColumns(
+            [timestamp] * len(edges),
+            **{
+                part_name: {
+                    field: [value if field == name else None for value, _ in edges]
+                    for field in (WEATHER_FIELDS if part_name == "weather" else POLLUTANT_FIELDS)
+                }
+            }
+        )
+
+        assert [validation_service.validate_reading(reading) for reading in readings] == expected
+        assert validation_service.validate_readings(readings) == expected
+        assert validation_service.validate_columns(columns) == expected
+
+        for value, valid in edges:
+            payload = {"timestamp": "2023-01-01T00:00:00", part_name: {"timestamp": "2023-01-01T00:00:00", name: value}}
+            if valid:
+                schema.load(payload)
+            else:
+                with pytest.raises(ValidationError) as error:
+                    schema.load(payload)
+                assert error.value.messages[part_name][name] == [message]
+
+def test_validate_columns_ignores_missing_parts():
+    from api.models import ReadingColumns
+
+    columns = ReadingColumns([datetime(2023, 1, 1)] * 2, weather=None, pollutants={
+        "pm10": [5.0, 2000.0], "pm2_5": [None, None], "carbon_monoxide": [None, None],
+        "nitrogen_dioxide": [None, None], "sulphur_dioxide": [None, None], "ozone": [None, None]
+    })
+
+    assert ValidationService().validate_columns(columns) == [True, False]
+
+def test_aggregate_whole_days_uses_repository_rollups(air_quality_service, mock_repository):
+    mock_repository.get_daily_rollups.return_value = []
+
+    air_quality_service.aggregate_readings(
+        datetime(2023, 1, 1), datetime(2023, 1, 15), 7 * 86400, "50.0647,19.9450", ["pm10"], [95]
+    )
+
+    mock_repository.get_daily_rollups.assert_called_once_with(
+        datetime(2023, 1, 1), datetime(2023, 1, 15), 7, "50.0647,19.9450", ["pm10"], [95]
+    )
+    mock_repository.get_readings_in_range.assert_not_called()
+
+def test_aggregate_sub_day_buckets_match_rollups():
+    service = AirQualityService(InMemoryRepository(), None)
+    base_time = datetime(2023, 1, 1)
+    service.save_readings([
+        EnvironmentalReading(
+            timestamp=base_time + timedelta(hours=i),
+            pollutants=PollutantReading(timestamp=base_time + timedelta(hours=i), pm10=float(i % 7), ozone=float(i))
+        )
+        for i in range(48)
+    ])
+
+    hours = service.aggregate_readings(datetime(2023, 1, 1, 1, 30), datetime(2023, 1, 1, 5), 3600, fields=["ozone"])
+    assert [(bucket["start"], bucket["fields"]["ozone"]["mean"]) for bucket in hours] == [
+        ("2023-01-01T01:00:00", 1.0), ("2023-01-01T02:00:00", 2.0),
+        ("2023-01-01T03:00:00", 3.0), ("2023-01-01T04:00:00", 4.0)
+    ]
+
+    # a 24h bucket grouped from readings agrees with the incrementally kept day partials
+    start, end = datetime(2023, 1, 1), datetime(2023, 1, 3)
+    rollups = service.aggregate_readings(start, end, 86400, percentiles=[25, 90])
+    grouped = aggregate_readings(service.get_readings_in_range(start, end), start, end, 86400, percentiles=[25, 90])
+
+    assert rollups == grouped
+    assert [bucket["fields"]["ozone"]["max"] for bucket in rollups] == [23.0, 47.0]
+
+def test_default_service_is_shared_between_requests():
+    from api.dependencies import get_air_quality_service
+
+    # identical fetches from different requests can only coalesce if they reach the same SingleFlight
+    assert get_air_quality_service() is get_air_quality_service()
+    assert get_air_quality_service(InMemoryRepository()) is not get_air_quality_service()
+
+def test_refreshed_recent_days_are_served_from_repository(gap_aware_service, mock_client, mocker):
+    today = datetime.now(timezone.utc).replace(tzinfo=None, hour=0, minute=0, second=0, microsecond=0)
+    gap_aware_service.fetch_and_store_air_quality_data(today - timedelta(days=1), today, refresh=True)
+    gap_aware_service.mark_refreshed((today - timedelta(days=1)).date(), today.date(), DEFAULT_LOCATION, 60)
+
+    readings = gap_aware_service.fetch_and_store_air_quality_data(today - timedelta(days=1), today)
+
+    assert mock_client.get_air_quality_data.call_count == 1
+    assert len(readings) == 2 * 24
+
+    # once the refresher falls behind, recent days are fetched on the request path again
+    mocker.patch('api.coverage.monotonic', return_value=float("inf"))
+    gap_aware_service.fetch_and_store_air_quality_data(today - timedelta(days=1), today)
+
+    assert mock_client.get_air_quality_data.call_count == 2
+
+def test_async_service_sees_days_refreshed_through_the_shared_service(gap_aware_service, mocker):
+    from api.dependencies import get_air_quality_service, get_async_air_quality_service
+
+    # request handlers build a new async service each time, so freshness must live outside the service
+    assert get_async_air_quality_service().refreshed is get_air_quality_service().refreshed
+
+    today = datetime.now(timezone.utc).replace(tzinfo=None, hour=0, minute=0, second=0, microsecond=0)
+    gap_aware_service.fetch_and_store_air_quality_data(today - timedelta(days=1), today, refresh=True)
+    gap_aware_service.mark_refreshed((today - timedelta(days=1)).date(), today.date(), DEFAULT_LOCATION, 60)
+
+    mock_async_client = mocker.Mock()
+    mock_async_client.get_air_quality_data = mocker.AsyncMock(return_value=hourly_payload(today, today))
+    service = AsyncAirQualityService(gap_aware_service.repository, mock_async_client, gap_aware_service.refreshed)
+
+    readings = asyncio.run(service.fetch_and_store_air_quality_data(today - timedelta(days=1), today))
+
+    mock_async_client.get_air_quality_data.assert_not_awaited()
+    assert len(readings) == 2 * 24
+
+@pytest.fixture
+def refresh_scheduler(gap_aware_service):
+    from api.scheduler import RefreshScheduler
+
+    return RefreshScheduler(gap_aware_service, [DEFAULT_LOCATION], interval=60, jitter=0, retry_delay=10, max_backoff=25)
+
+def test_scheduler_refresh_keeps_recent_hours_fresh(refresh_scheduler, gap_aware_service, mock_client):
+    assert refresh_scheduler.refresh(DEFAULT_LOCATION) is True
+
+    start, end = mock_client.get_air_quality_data.call_args.args
+    assert end - start == timedelta(days=1, hours=24)
+
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    gap_aware_service.fetch_and_store_air_quality_data(now - timedelta(hours=6), now)
+    assert mock_client.get_air_quality_data.call_count == 1
+
+    status = refresh_scheduler.status()["locations"][DEFAULT_LOCATION]
+    assert status["runs"] == 1
+    assert status["failures"] == 0
+    # whole days from yesterday through tomorrow, which is where the local day may already be
+    assert status["last_readings"] == 3 * 24
+    assert 0 <= status["lag_seconds"] < 5
+    assert 55 <= status["next_run_in"] <= 60
+
+def test_scheduler_failures_back_off_and_are_reported(refresh_scheduler, mock_client):
+    mock_client.get_air_quality_data.side_effect = ConnectionError("upstream down")
+
+    delays = []
+    for _ in range(3):
+        assert refresh_scheduler.refresh(DEFAULT_LOCATION) is False
+        delays.append(refresh_scheduler.status()["locations"][DEFAULT_LOCATION]["next_run_in"])
+
+    assert [round(delay) for delay in delays] == [10, 20, 25]
+
+    status = refresh_scheduler.status()
+    assert status["max_lag_seconds"] is None
+    assert status["locations"][DEFAULT_LOCATION]["consecutive_failures"] == 3
+    assert status["locations"][DEFAULT_LOCATION]["last_error"] == "ConnectionError: upstream down"
+
+    mock_client.get_air_quality_data.side_effect = hourly_payload
+    assert refresh_scheduler.refresh(DEFAULT_LOCATION) is True
+
+    status = refresh_scheduler.status()["locations"][DEFAULT_LOCATION]
+    assert status["consecutive_failures"] == 0
+    assert status["failures"] == 3
+    assert status["last_error"] is None
+
+def test_scheduler_thread_refreshes_until_stopped(gap_aware_service, mock_client):
+    import threading
+    from api.scheduler import RefreshScheduler
+
+    refreshed = threading.Event()
+    mock_client.get_air_quality_data.side_effect = lambda *args: (refreshed.set(), hourly_payload(*args))[1]
+    scheduler = RefreshScheduler(gap_aware_service, [DEFAULT_LOCATION, "52.0,21.0"], interval=0.05, jitter=0.5)
+
+    scheduler.start()
+    assert refreshed.wait(5)
+    scheduler.stop(5)
+
+    assert not scheduler.running
+    assert scheduler.status()["running"] is False
+    assert sum(status["runs"] for status in scheduler.status()["locations"].values()) >= 1
+
+def test_build_refresh_scheduler_reads_environment(gap_aware_service, monkeypatch):
+    from api.scheduler import build_refresh_scheduler
+
+    monkeypatch.delenv("REFRESH_LOCATIONS", raising=False)
+    assert build_refresh_scheduler(gap_aware_service) is None
+
+    monkeypatch.setenv("REFRESH_LOCATIONS", "default; 50.0647,19.945 ;52.2297,21.0122")
+    monkeypatch.setenv("REFRESH_INTERVAL", "300")
+    scheduler = build_refresh_scheduler(gap_aware_service)
+
+    # the configured site's own coordinates are the default location, not a second one
+    assert list(scheduler.status()["locations"]) == [DEFAULT_LOCATION, "50.0647,19.9450"]
+    assert scheduler.interval == 300.0